@@ -0,0 +1,114 @@
+"""
+Load test of concurrent connection handling.
+Runs the server in each mode, opens many slow clients that trickle their requests in,
+and measures the latency of fast /calculate-next requests sent at the same time.
+"""
+import argparse
+import asyncio
+import time
+
+from server_process import get_free_port, start_server
+
+SLOW_REQUEST = b"GET /calculate-next?num=1 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+FAST_REQUEST = b"GET /calculate-next?num=41 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+# how many pieces a slow client splits its request to, and how long it takes to send all of them
+SLOW_CLIENT_PIECES = 10
+SLOW_CLIENT_DURATION = 1.0
+# a fast request that takes longer than this is counted as failed
+FAST_REQUEST_TIMEOUT = 5.0
+
+
+async def slow_client(port: int):
+    """
+    Sends a single request in small pieces over SLOW_CLIENT_DURATION seconds, then reads the response.
+    """
+    try:
+        reader, writer = await asyncio.open_connection("localhost", port)
+        piece_size = -(-len(SLOW_REQUEST) // SLOW_CLIENT_PIECES)
+        for start in range(0, len(SLOW_REQUEST), piece_size):
+            writer.write(SLOW_REQUEST[start:start + piece_size])
+            await writer.drain()
+            await asyncio.sleep(SLOW_CLIENT_DURATION / SLOW_CLIENT_PIECES)
+        await reader.read()
+        writer.close()
+    except OSError:
+        pass
+
+
+async def fast_client(port: int, deadline: float, latencies: list[float]) -> int:
+    """
+    Sends fast requests, each on a new connection, until the deadline, appending the latency of each one.
+    Returns the amount of requests that failed or timed out.
+    """
+    failures = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection("localhost", port), FAST_REQUEST_TIMEOUT)
+            writer.write(FAST_REQUEST)
+            response = await asyncio.wait_for(reader.read(), FAST_REQUEST_TIMEOUT)
+            if not response.endswith(b"\r\n\r\n42"):
+                raise ValueError("unexpected response")
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            failures += 1
+        finally:
+            if writer is not None:
+                writer.close()
+    return failures
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Returns the value below which the given fraction of the values are (nearest-rank method).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_load(port: int, slow_clients: int, fast_clients: int, duration: float) -> tuple[list[float], int]:
+    """
+    Runs the slow clients and the fast clients together for the given duration.
+    Returns the latencies of the fast requests and the amount of fast requests that failed.
+    """
+    slow_tasks = [asyncio.create_task(slow_client(port))
+                  for _ in range(slow_clients)]
+    await asyncio.sleep(0.1)  # let the slow clients connect first
+    latencies = []
+    deadline = time.perf_counter() + duration
+    failures = await asyncio.gather(*(fast_client(port, deadline, latencies) for _ in range(fast_clients)))
+    for task in slow_tasks:
+        task.cancel()
+    await asyncio.gather(*slow_tasks, return_exceptions=True)
+    return latencies, sum(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["serial", "async"])
+    parser.add_argument("--slow-clients", type=int, default=1000)
+    parser.add_argument("--fast-clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=5.0)
+    arguments = parser.parse_args()
+    print(f"{arguments.slow_clients} slow clients, {arguments.fast_clients} fast clients, "
+          f"{arguments.duration}s per mode")
+    for mode in arguments.modes:
+        port = get_free_port()
+        server = start_server(mode, port)
+        try:
+            latencies, failures = asyncio.run(run_load(
+                port, arguments.slow_clients, arguments.fast_clients, arguments.duration))
+        finally:
+            server.kill()
+            server.wait()
+        if latencies:
+            print(f"{mode:>8}: {len(latencies):6} ok, {failures:5} failed, "
+                  f"p50 {percentile(latencies, 0.5) * 1000:9.2f} ms, p99 {percentile(latencies, 0.99) * 1000:9.2f} ms")
+        else:
+            print(f"{mode:>8}: no request succeeded, {failures} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark of persistent connections (keep-alive).
+Runs the server locally and measures the requests per second for the index page,
+once opening a new connection for each request and once reusing a single connection for all of them.
+"""
+import http.client
+import os
+import sys
+import threading
+import time
+
+# the server is in the parent directory, and serves the webroot relative to it
+REPOSITORY_DIRECTORY = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+os.chdir(REPOSITORY_DIRECTORY)
+
+import web_server  # noqa: E402
+
+REQUEST_COUNT = 2000
+REQUEST_PATH = "/index.html"
+
+
+def start_server() -> int:
+    """
+    Starts the server on a free port, in a background thread.
+    Returns the port it listens on.
+    """
+    server = web_server.HttpServer("localhost", 0, web_server.CLIENT_TIMEOUT,
+                                   web_server.MAX_HEADER_SIZE, web_server.MAX_HEADER_COUNT,
+                                   web_server.MAX_BODY_SIZE, web_server.HEADER_TIMEOUT,
+                                   web_server.BODY_TIMEOUT, web_server.MIN_BODY_RATE, web_server.LISTEN_BACKLOG)
+    threading.Thread(target=web_server.serve_clients,
+                     args=(server,), daemon=True).start()
+    return server.get_port()
+
+
+def requests_per_second(port: int, reuse_connection: bool) -> float:
+    """
+    Sends REQUEST_COUNT requests for the index page and returns how many requests per second were served.
+    """
+    connection = http.client.HTTPConnection("localhost", port)
+    start = time.perf_counter()
+    for _ in range(REQUEST_COUNT):
+        if not reuse_connection:
+            connection.close()
+            connection = http.client.HTTPConnection("localhost", port)
+        connection.request("GET", REQUEST_PATH)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return REQUEST_COUNT / elapsed
+
+
+def main():
+    port = start_server()
+    without_reuse = requests_per_second(port, reuse_connection=False)
+    with_reuse = requests_per_second(port, reuse_connection=True)
+    print(f"{REQUEST_PATH}, {REQUEST_COUNT} requests")
+    print(f"new connection per request: {without_reuse:10.1f} requests/s")
+    print(f"reused connection:          {with_reuse:10.1f} requests/s")
+    print(f"speedup:                    {with_reuse / without_reuse:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Reproducible load test of the server hot paths.
+Runs the server locally as a subprocess, and drives every scenario with a dependency-free asyncio load generator:
+a fixed amount of clients send requests on persistent connections (reconnecting when the server closes them)
+for a fixed time, after a short warm up that isn't measured.
+The scenarios are small static files, jquery.min.js, a large uploaded image (sent with sendfile),
+/calculate-next, /calculate-area, multipart /upload of several sizes, and /calculate-next while slow-loris
+clients hold connections open by sending their headers a byte at a time.
+Reports the throughput, the p50/p95/p99 latency and the RSS of the server for every scenario.
+The results are written as JSON, and can be compared with the results of an earlier run (a baseline):
+    python benchmarks/load_test.py --output baseline.json
+    ... change the server ...
+    python benchmarks/load_test.py --baseline baseline.json
+The exit code is 1 if a scenario got slower than the baseline by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from server_process import REPOSITORY_DIRECTORY, get_free_port, start_server, stop_server
+
+UPLOADS_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, "webroot", "uploaded_imgs")
+# every file the load test creates in the uploads directory starts with this prefix, and is removed at the end
+GENERATED_FILE_PREFIX = "load-test-"
+LARGE_IMAGE_NAME = GENERATED_FILE_PREFIX + "large.jpg"
+LARGE_IMAGE_SIZE = 4 * 1024 * 1024
+UPLOAD_SIZES = {"upload_16k": 16 * 1024,
+                "upload_1m": 1024 * 1024, "upload_8m": 8 * 1024 * 1024}
+UPLOAD_BOUNDARY = "----LoadTestBoundary7MA4YWxkTrZu0gW"
+# the contents of generated files come from a seeded generator, so every run sends the same bytes
+RANDOM_SEED = 1234
+# the headers a browser sends with every request
+BROWSER_HEADERS = (b"Host: localhost\r\n"
+                   b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+                   b"Accept: */*\r\n"
+                   b"Accept-Language: en-US,en;q=0.5\r\n"
+                   b"Accept-Encoding: gzip, deflate, br\r\n")
+SMALL_STATIC_PATHS = ("/js/box.js", "/css/doremon.css",
+                      "/imgs/favicon.ico", "/imgs/loading.gif")
+# slow-loris clients send a byte of their headers every interval, and never finish them
+SLOWLORIS_CONNECTIONS = 50
+SLOWLORIS_INTERVAL = 0.5
+SLOWLORIS_REQUEST = b"GET /calculate-next?num=1 HTTP/1.1\r\n" + BROWSER_HEADERS + b"X-Padding: " + b"a" * 1000
+# a request that takes longer than this is counted as an error
+REQUEST_TIMEOUT = 10.0
+WARM_UP_DURATION = 1.0
+
+
+def get_request(path: str) -> bytes:
+    return b"GET " + path.encode() + b" HTTP/1.1\r\n" + BROWSER_HEADERS + b"\r\n"
+
+
+def get_upload_request(file_name: str, size: int) -> bytes:
+    """
+    Returns a multipart /upload request of a file with the given name and size (with seeded random contents).
+    """
+    content = random.Random(RANDOM_SEED).randbytes(size)
+    body = (f"--{UPLOAD_BOUNDARY}\r\n"
+            f"Content-Disposition: form-data; name=\"file\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{UPLOAD_BOUNDARY}--\r\n".encode()
+    head = (b"POST /upload HTTP/1.1\r\n" + BROWSER_HEADERS +
+            f"Content-Type: multipart/form-data; boundary={UPLOAD_BOUNDARY}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode())
+    return head + body
+
+
+def get_scenarios() -> dict[str, tuple[list[bytes], int]]:
+    """
+    Returns the scenarios by name, each one is the requests the clients send in turns and the expected status code.
+    """
+    scenarios = {
+        "small_static": ([get_request(path) for path in SMALL_STATIC_PATHS], 200),
+        "jquery": ([get_request("/js/jquery.min.js")], 200),
+        "large_image": ([get_request(f"/image?image-name={LARGE_IMAGE_NAME}")], 200),
+        "calculate_next": ([get_request("/calculate-next?num=41")], 200),
+        "calculate_area": ([get_request("/calculate-area?height=12&width=30")], 200),
+    }
+    for name, size in UPLOAD_SIZES.items():
+        scenarios[name] = (
+            [get_upload_request(f"{GENERATED_FILE_PREFIX}{name}.bin", size)], 201)
+    # the slow-loris clients are started by run_scenario, the measured clients send fast requests between them
+    scenarios["slowloris"] = ([get_request("/calculate-next?num=41")], 200)
+    return scenarios
+
+
+def create_generated_files():
+    with open(os.path.join(UPLOADS_DIRECTORY, LARGE_IMAGE_NAME), "wb") as large_image:
+        large_image.write(random.Random(
+            RANDOM_SEED).randbytes(LARGE_IMAGE_SIZE))
+
+
+def remove_generated_files():
+    for file_name in os.listdir(UPLOADS_DIRECTORY):
+        if file_name.startswith(GENERATED_FILE_PREFIX):
+            os.remove(os.path.join(UPLOADS_DIRECTORY, file_name))
+
+
+def get_process_tree(pid: int) -> list[int]:
+    """
+    Returns the pid and the pids of all its descendants (the worker processes), using /proc.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                # the parent pid is the second field after the command, which is in parentheses
+                parent_pid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):  # the process exited
+            continue
+        children.setdefault(parent_pid, []).append(int(entry))
+    pids = [pid]
+    for current_pid in pids:
+        pids += children.get(current_pid, [])
+    return pids
+
+
+def get_memory_usage(pid: int) -> dict[str, int] | None:
+    """
+    Returns the current and the peak RSS (in KiB) of the server and its workers together,
+    or None if they can't be read (there's no /proc).
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    usage = {"rss_kib": 0, "peak_rss_kib": 0}
+    for process_id in get_process_tree(pid):
+        try:
+            with open(f"/proc/{process_id}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmRSS:"):
+                        usage["rss_kib"] += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        usage["peak_rss_kib"] += int(line.split()[1])
+        except OSError:  # the process exited
+            continue
+    return usage
+
+
+class ScenarioStatistics:
+    """
+    Collects the latencies of the measured requests of a scenario, and the amount of errors.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes_recieved = 0
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, bool, int]:
+    """
+    Reads a response from the connection.
+    Returns its status code, whether the server keeps the connection open, and the amount of bytes read.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status_code = int(lines[0].split(" ")[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body_length = int(headers.get("content-length", "0"))
+    await reader.readexactly(body_length)
+    return status_code, headers.get("connection", "").lower() != "close", len(head) + body_length
+
+
+async def load_client(port: int, requests: list[bytes], expected_status: int, first_request: int,
+                      measure_from: float, deadline: float, statistics: ScenarioStatistics):
+    """
+    Sends the requests in turns on a persistent connection until the deadline, reconnecting when it's closed.
+    The requests that start after measure_from are recorded in statistics.
+    """
+    request_index = first_request
+    connection = None
+    while time.perf_counter() < deadline:
+        request = requests[request_index % len(requests)]
+        request_index += 1
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection("localhost", port)
+            reader, writer = connection
+            writer.write(request)
+            status_code, keep_alive, byte_count = await asyncio.wait_for(read_response(reader), REQUEST_TIMEOUT)
+            succeeded = status_code == expected_status
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            succeeded, keep_alive, byte_count = False, False, 0
+        end = time.perf_counter()
+        if start >= measure_from:
+            if succeeded:
+                statistics.latencies.append(end - start)
+                statistics.bytes_recieved += byte_count
+            else:
+                statistics.errors += 1
+        if not keep_alive and connection is not None:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def slowloris_client(port: int, deadline: float) -> bool:
+    """
+    Holds a connection open until the deadline by sending the head of a request a byte at a time.
+    Returns True if the server closed the connection before the deadline.
+    """
+    try:
+        reader, writer = await asyncio.open_connection("localhost", port)
+    except OSError:
+        return True
+    try:
+        for byte_index in range(len(SLOWLORIS_REQUEST)):
+            if time.perf_counter() >= deadline:
+                return False
+            writer.write(SLOWLORIS_REQUEST[byte_index:byte_index + 1])
+            await writer.drain()
+            # the server may respond (408) and close the connection while waiting
+            try:
+                await asyncio.wait_for(reader.read(65536), SLOWLORIS_INTERVAL)
+                return True
+            except asyncio.TimeoutError:
+                pass
+        return False
+    except OSError:
+        return True
+    finally:
+        writer.close()
+
+
+def get_percentile(sorted_values: list[float], percentile: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+async def run_scenario(name: str, requests: list[bytes], expected_status: int, port: int, concurrency: int,
+                       duration: float) -> dict:
+    """
+    Runs a scenario and returns its results.
+    """
+    statistics = ScenarioStatistics()
+    start = time.perf_counter()
+    measure_from = start + WARM_UP_DURATION
+    deadline = measure_from + duration
+    slowloris_tasks = []
+    if name == "slowloris":
+        slowloris_tasks = [asyncio.create_task(slowloris_client(port, deadline))
+                           for _ in range(SLOWLORIS_CONNECTIONS)]
+    await asyncio.gather(*(load_client(port, requests, expected_status, client_index, measure_from, deadline,
+                                       statistics) for client_index in range(concurrency)))
+    closed_slowloris_connections = sum(await asyncio.gather(*slowloris_tasks))
+    measured_duration = time.perf_counter() - measure_from
+    latencies = sorted(statistics.latencies)
+    results = {
+        "requests": len(latencies),
+        "errors": statistics.errors,
+        "throughput_rps": len(latencies) / measured_duration,
+        "throughput_mib_s": statistics.bytes_recieved / measured_duration / 1024 / 1024,
+        "p50_ms": None, "p95_ms": None, "p99_ms": None,
+    }
+    for percentile in (50, 95, 99):
+        latency = get_percentile(latencies, percentile)
+        results[f"p{percentile}_ms"] = latency * 1000 if latency is not None else None
+    if name == "slowloris":
+        results["slowloris_connections"] = SLOWLORIS_CONNECTIONS
+        results["slowloris_connections_closed"] = closed_slowloris_connections
+    return results
+
+
+def format_value(value, digits: int = 2) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+
+def print_results(scenario_results: dict[str, dict]):
+    print(f"{'scenario':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'MiB/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rss KiB':>10}{'peak KiB':>10}")
+    for name, results in scenario_results.items():
+        print(f"{name:<16}{results['requests']:>10}{results['errors']:>8}"
+              f"{format_value(results['throughput_rps'], 0):>10}{format_value(results['throughput_mib_s']):>9}"
+              f"{format_value(results['p50_ms']):>9}{format_value(results['p95_ms']):>9}"
+              f"{format_value(results['p99_ms']):>9}{format_value(results.get('rss_kib')):>10}"
+              f"{format_value(results.get('peak_rss_kib')):>10}")
+        if "slowloris_connections" in results:
+            print(f"{'':<16}slow-loris connections closed by the server: "
+                  f"{results['slowloris_connections_closed']}/{results['slowloris_connections']}")
+
+
+def get_percent_change(current, baseline) -> float | None:
+    if current is None or baseline is None or baseline == 0:
+        return None
+    return (current - baseline) / baseline * 100
+
+
+def compare_with_baseline(scenario_results: dict[str, dict], baseline_results: dict[str, dict],
+                          tolerance: float) -> list[str]:
+    """
+    Prints the change of the throughput and the p99 latency of every scenario from the baseline.
+    Returns the names of the scenarios that got worse than the baseline by more than tolerance percent.
+    """
+    regressions = []
+    print(f"\n{'scenario':<16}{'req/s change':>14}{'p99 change':>12}")
+    for name, results in scenario_results.items():
+        if name not in baseline_results:
+            continue
+        throughput_change = get_percent_change(
+            results["throughput_rps"], baseline_results[name]["throughput_rps"])
+        p99_change = get_percent_change(
+            results["p99_ms"], baseline_results[name]["p99_ms"])
+        regressed = (throughput_change is not None and throughput_change < -tolerance) or (
+            p99_change is not None and p99_change > tolerance)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<16}{format_value(throughput_change, 1) + '%':>14}{format_value(p99_change, 1) + '%':>12}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIRECTORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    scenarios = get_scenarios()
+    parser = argparse.ArgumentParser(description="Load test of the server")
+    parser.add_argument("--mode", default="async",
+                        help="server mode (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server worker processes (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="clients per scenario (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="measured seconds per scenario (default: %(default)s)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(scenarios), default=list(scenarios),
+                        help="scenarios to run (default: all of them)")
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percent of slow down from the baseline that isn't a regression (default: %(default)s)")
+    arguments = parser.parse_args()
+
+    port = get_free_port()
+    create_generated_files()
+    server = start_server(arguments.mode, port, arguments.workers)
+    scenario_results = {}
+    try:
+        for name in arguments.scenarios:
+            requests, expected_status = scenarios[name]
+            results = asyncio.run(run_scenario(
+                name, requests, expected_status, port, arguments.concurrency, arguments.duration))
+            # the memory is measured after every scenario, the peak is since the server started
+            results.update(get_memory_usage(server.pid) or {})
+            scenario_results[name] = results
+    finally:
+        stop_server(server)
+        remove_generated_files()
+
+    print_results(scenario_results)
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(), "commit": get_git_commit(),
+                        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+        "settings": {"mode": arguments.mode, "workers": arguments.workers, "concurrency": arguments.concurrency,
+                     "duration": arguments.duration, "warm_up_duration": WARM_UP_DURATION},
+        "scenarios": scenario_results,
+    }
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["settings"] != report["settings"]:
+            print("\nwarning: the baseline was measured with different settings:",
+                  baseline["settings"])
+        if compare_with_baseline(scenario_results, baseline["scenarios"], arguments.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
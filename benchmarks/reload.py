@@ -0,0 +1,175 @@
+"""
+Test of the graceful reload under load.
+Runs the server as a subprocess, keeps clients sending requests to it without a pause (half of them on new connections,
+half on persistent ones), and reloads it with SIGHUP a few times meanwhile. Every reload starts a new server process
+that takes over the listening socket, while the old one finishes its requests and exits.
+Counts the requests that failed: the exit code is 1 if any did, or if a replaced process didn't exit.
+A persistent connection that the server closed while it was idle is reopened and the request is sent again,
+like HTTP clients do (the server never started handling that request), so that isn't counted as a failure.
+Any error on a new connection is a failure, since that's what a refused or reset connection looks like.
+    python benchmarks/reload.py --mode serial --workers 2 --reloads 5
+"""
+import argparse
+import http.client
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from server_process import SERVER_START_TIMEOUT, get_free_port, start_server
+
+# how long a request may take before it's counted as failed
+REQUEST_TIMEOUT = 10
+REQUEST_PATHS = ["/index.html", "/calculate-next?num=41", "/calculate-area?height=3&width=4"]
+# the line the server logs when it hands the listening socket to a new process
+HANDOVER_LINE_PATTERN = re.compile(r"reload: process (\d+) handed the listening socket to process (\d+)")
+
+
+class LoadClient:
+    """
+    A client that sends requests until it's stopped, on new connections or on a persistent connection,
+    and counts the requests that succeeded and failed (with the last error).
+    """
+
+    def __init__(self, port: int, persistent: bool):
+        self.port = port
+        self.persistent = persistent
+        self.stopped = False
+        self.succeeded = 0
+        self.failed = 0
+        self.last_error = None
+
+    def run(self):
+        connection = None
+        request_number = 0
+        while not self.stopped:
+            path = REQUEST_PATHS[request_number % len(REQUEST_PATHS)]
+            request_number += 1
+            reused = connection is not None
+            if connection is None:
+                connection = http.client.HTTPConnection("localhost", self.port, timeout=REQUEST_TIMEOUT)
+            try:
+                self.send_request(connection, path)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                if not reused:
+                    self.count_failure(e)
+                    connection = None
+                    continue
+                # the server closed the idle connection, so the request never reached it: send it again
+                connection = http.client.HTTPConnection("localhost", self.port, timeout=REQUEST_TIMEOUT)
+                try:
+                    self.send_request(connection, path)
+                except (OSError, http.client.HTTPException) as e:
+                    self.count_failure(e)
+                    connection.close()
+                    connection = None
+                    continue
+            except (OSError, http.client.HTTPException) as e:
+                self.count_failure(e)
+                connection.close()
+                connection = None
+                continue
+            if not self.persistent or connection.sock is None:  # the server may close it after the response
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def send_request(self, connection: http.client.HTTPConnection, path: str):
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise http.client.HTTPException(f"{path} got status {response.status}")
+        if response.getheader("Connection", "").lower() == "close":
+            connection.close()
+        self.succeeded += 1
+
+    def count_failure(self, error: Exception):
+        self.failed += 1
+        self.last_error = repr(error)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # a process that exited but wasn't waited for yet is a zombie
+    with open(f"/proc/{pid}/stat") as stat_file:
+        return stat_file.read().rsplit(")", 1)[1].split()[0] != "Z"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test of the graceful reload under load")
+    parser.add_argument("--mode", default="serial", choices=["serial", "async"],
+                        help="how the server serves clients (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="amount of server worker processes (default: %(default)s)")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="amount of concurrent clients (default: %(default)s)")
+    parser.add_argument("--reloads", type=int, default=3,
+                        help="how many times to reload the server (default: %(default)s)")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between reloads (default: %(default)s)")
+    arguments = parser.parse_args()
+    port = get_free_port()
+    process = start_server(arguments.mode, port, arguments.workers, ["--no-metrics"],
+                           stderr=subprocess.PIPE, text=True)
+    # the server log is read in the background, to follow the handovers
+    handovers = []
+    handover_arrived = threading.Condition()
+
+    def read_server_log():
+        for line in process.stderr:
+            sys.stderr.write(line)
+            match = HANDOVER_LINE_PATTERN.search(line)
+            if match is not None:
+                with handover_arrived:
+                    handovers.append((int(match.group(1)), int(match.group(2))))
+                    handover_arrived.notify()
+    threading.Thread(target=read_server_log, daemon=True).start()
+    clients = [LoadClient(port, persistent=index % 2 == 1) for index in range(arguments.clients)]
+    client_threads = [threading.Thread(target=client.run) for client in clients]
+    for thread in client_threads:
+        thread.start()
+    server_pid = process.pid
+    replaced_pids = []
+    try:
+        for _ in range(arguments.reloads):
+            time.sleep(arguments.interval)
+            os.kill(server_pid, signal.SIGHUP)
+            with handover_arrived:
+                if not handover_arrived.wait_for(lambda: len(handovers) > len(replaced_pids), SERVER_START_TIMEOUT):
+                    raise RuntimeError("The server didn't reload")
+                old_pid, server_pid = handovers[-1]
+            replaced_pids.append(old_pid)
+        time.sleep(arguments.interval)
+    finally:
+        for client in clients:
+            client.stopped = True
+        for thread in client_threads:
+            thread.join()
+        os.kill(server_pid, signal.SIGTERM)
+    process.wait()  # the first process was replaced, it should have exited long ago
+    time.sleep(1)
+    still_running = [pid for pid in replaced_pids[1:] if is_running(pid)]
+    succeeded = sum(client.succeeded for client in clients)
+    failed = sum(client.failed for client in clients)
+    print(f"{arguments.mode} mode, {arguments.workers} workers, {arguments.clients} clients, "
+          f"{len(replaced_pids)} reloads")
+    print(f"  requests: {succeeded} succeeded, {failed} failed")
+    for client in clients:
+        if client.last_error is not None:
+            print(f"  last error: {client.last_error}")
+    if still_running:
+        print(f"  replaced processes still running: {still_running}")
+    sys.exit(1 if failed > 0 or still_running else 0)
+
+
+if __name__ == "__main__":
+    main()
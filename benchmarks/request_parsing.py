@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of request parsing, in requests per second.
+Each request head is parsed the way ClientConnection.recieve_request parses it (parse_request_head, the
+Content-Length lookup and the HttpRequest), and then used the way the server uses a static file request
+(the headers the server looks at), or the way an api endpoint uses it (the query parameters too).
+Nothing is recieved or sent, so only the parsing is measured. The best of a few rounds is reported.
+"""
+import os
+import sys
+import time
+
+# the server is in the parent directory
+REPOSITORY_DIRECTORY = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+import web_server  # noqa: E402
+
+REQUEST_COUNT = 100000
+ROUNDS = 15
+# a request like the ones browsers send for the static files, without the empty line that ends it
+STATIC_REQUEST_HEAD = (b"GET /js/jquery.min.js HTTP/1.1\r\n"
+                       b"Host: localhost:8080\r\n"
+                       b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+                       b"Accept: */*\r\n"
+                       b"Accept-Language: en-US,en;q=0.5\r\n"
+                       b"Accept-Encoding: gzip, deflate, br\r\n"
+                       b"Referer: http://localhost:8080/\r\n"
+                       b"Connection: keep-alive\r\n"
+                       b"Sec-Fetch-Dest: script\r\n"
+                       b"Sec-Fetch-Mode: no-cors\r\n"
+                       b"Sec-Fetch-Site: same-origin")
+API_REQUEST_HEAD = (b"GET /calculate-area?height=12&width=30 HTTP/1.1\r\n"
+                    b"Host: localhost:8080\r\n"
+                    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+                    b"Accept: */*\r\n"
+                    b"Connection: keep-alive")
+# the headers the server reads for a static file request
+STATIC_HEADERS = ("Connection", "If-None-Match", "If-Modified-Since", "Range", "Accept-Encoding")
+
+
+def parse_request(request_head: bytes) -> web_server.HttpRequest:
+    """
+    Parses a request head like ClientConnection.recieve_request does (the requests have no body).
+    """
+    method, request_path, http_version, query_string, headers = web_server.parse_request_head(
+        request_head, web_server.MAX_HEADER_COUNT)
+    web_server.get_content_length(headers, web_server.MAX_BODY_SIZE)
+    return web_server.HttpRequest(method, request_path, http_version, query_string, headers, None)
+
+
+def use_static_request(request: web_server.HttpRequest):
+    headers = request.get_headers()
+    for header in STATIC_HEADERS:
+        headers.get(header)
+
+
+def use_api_request(request: web_server.HttpRequest):
+    request.get_headers().get("Connection")
+    request.get_query_parameters()["height"]
+    request.get_query_parameters()["width"]
+
+
+def measure(request_head: bytes, use_request) -> float:
+    """
+    Parses and uses the request REQUEST_COUNT times, ROUNDS times.
+    Returns the requests per second of the fastest round.
+    """
+    best_elapsed = None
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        for _ in range(REQUEST_COUNT):
+            use_request(parse_request(request_head))
+        elapsed = time.process_time() - start
+        if best_elapsed is None or elapsed < best_elapsed:
+            best_elapsed = elapsed
+    return REQUEST_COUNT / best_elapsed
+
+
+def main():
+    print(f"{REQUEST_COUNT} requests, best of {ROUNDS} rounds")
+    print(f"  static file request: {measure(STATIC_REQUEST_HEAD, use_static_request):9.0f} requests/s")
+    print(f"  api request:         {measure(API_REQUEST_HEAD, use_api_request):9.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
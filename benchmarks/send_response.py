@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of sending small responses (like the ones of /calculate-next).
+Compares the current ClientConnection.send_response with the old way of sending the status line, every header,
+the empty line and the body in separate send calls. Measures the send system calls per response,
+and the latency of a request on a persistent connection.
+"""
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+# the server is in the parent directory, and serves the webroot relative to it
+REPOSITORY_DIRECTORY = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+os.chdir(REPOSITORY_DIRECTORY)
+
+import web_server  # noqa: E402
+
+REQUEST_COUNT = 5000
+REQUEST = b"GET /calculate-next?num=41 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+SEND_FUNCTIONS = ("send", "sendall", "sendmsg", "sendfile")
+
+
+class CountingSocket:
+    """
+    Wraps a socket and counts the calls to its sending functions (each one is at least one system call).
+    """
+
+    def __init__(self, sock):
+        self.__socket = sock
+        self.send_calls = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__socket, name)
+        if name not in SEND_FUNCTIONS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.send_calls += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def send_response_per_header(conn, response):
+    """
+    The old send_response: a separate send for the status line, each header, the empty line and the body.
+    """
+    sock = conn._ClientConnection__socket
+    sock.send(
+        f"{web_server.HTTP_VERSION} {response.get_status_code()} {response.get_reason_phrase()}\r\n".encode())
+    for header, value in response.get_headers().items():
+        sock.send(f"{header}: {value}\r\n".encode())
+    sock.send(b"\r\n")
+    sock.send(response.get_body())
+
+
+def serve(server_socket, send_function, sockets):
+    """
+    Serves REQUEST_COUNT keep-alive requests of one client with the given send function.
+    """
+    client_socket, _ = server_socket.accept()
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    counting_socket = CountingSocket(client_socket)
+    sockets.append(counting_socket)
+    conn = web_server.ClientConnection(counting_socket, web_server.CLIENT_TIMEOUT,
+                                       web_server.MAX_HEADER_SIZE, web_server.MAX_HEADER_COUNT,
+                                       web_server.MAX_BODY_SIZE, web_server.HEADER_TIMEOUT,
+                                       web_server.BODY_TIMEOUT, web_server.MIN_BODY_RATE)
+    for _ in range(REQUEST_COUNT):
+        request = conn.recieve_request()
+        response = web_server.handle_request(request)
+        response.get_headers()["Connection"] = "keep-alive"
+        send_function(conn, response)
+    conn.close()
+
+
+def measure(send_function) -> tuple[float, list[float]]:
+    """
+    Sends REQUEST_COUNT requests over one connection, served with the given send function.
+    Returns the send calls per response and the latency of each request.
+    """
+    server_socket = socket.create_server(("localhost", 0))
+    sockets = []
+    server_thread = threading.Thread(target=serve, args=(
+        server_socket, send_function, sockets))
+    server_thread.start()
+    client = socket.create_connection(server_socket.getsockname())
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    latencies = []
+    for _ in range(REQUEST_COUNT):
+        start = time.perf_counter()
+        client.sendall(REQUEST)
+        response = b""
+        while not response.endswith(b"\r\n\r\n42"):
+            response += client.recv(65536)
+        latencies.append(time.perf_counter() - start)
+    server_thread.join()
+    client.close()
+    server_socket.close()
+    return sockets[0].send_calls / REQUEST_COUNT, latencies
+
+
+def main():
+    print(f"/calculate-next, {REQUEST_COUNT} requests on one connection")
+    for name, send_function in (("per header sends", send_response_per_header),
+                                ("send_response", web_server.ClientConnection.send_response)):
+        send_calls, latencies = measure(send_function)
+        latencies.sort()
+        print(f"{name:>17}: {send_calls:5.2f} send calls/response, "
+              f"mean {statistics.mean(latencies) * 1e6:7.1f} us, "
+              f"p50 {latencies[len(latencies) // 2] * 1e6:7.1f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Helpers that run the server as a subprocess for the benchmarks that load it over the network.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# the server is in the parent directory, and serves the webroot relative to it
+REPOSITORY_DIRECTORY = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPOSITORY_DIRECTORY, "web_server.py")
+SERVER_START_TIMEOUT = 10.0
+
+
+def get_free_port() -> int:
+    """
+    Returns a port that is currently free on localhost.
+    """
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode: str, port: int, workers: int = 1, arguments: list[str] = (),
+                 **popen_arguments) -> subprocess.Popen:
+    """
+    Starts the server as a subprocess and waits until it accepts connections.
+    The extra arguments are passed to the server, and the keyword arguments to subprocess.Popen.
+    """
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--mode", mode, "--workers", str(workers),
+                                "--port", str(port), *arguments], cwd=REPOSITORY_DIRECTORY, **popen_arguments)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except ConnectionRefusedError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("The server didn't start")
+            time.sleep(0.05)
+
+
+def stop_server(process: subprocess.Popen):
+    """
+    Stops the server gracefully, and kills it if it doesn't exit in time.
+    """
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
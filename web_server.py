@@ -1,26 +1,88 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import datetime
+import email.utils
+import gzip
+import io
+import ipaddress
+import json
+import math
+import select
+import signal
 import socket
 import os
+import queue
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+
+try:  # brotli compression is optional, gzip is used without it
+    import brotli
+except ImportError:
+    brotli = None
+try:  # the batch endpoints compute with numpy if it's installed, and in pure python otherwise
+    import numpy
+except ImportError:
+    numpy = None
 
 
 CONTENT_TYPE_BY_EXTENSION = {"html": "text/html", "css": "text/css", "js": "application/javascript", "jpg": "image/jpeg",
-                             "gif": "image/gif", "png": "image/png", "ico": "image/x-icon"}
+                             "gif": "image/gif", "png": "image/png", "ico": "image/x-icon", "avif": "image/avif"}
+# content types whose formats are compressed already, so compressing them again would only waste time
+COMPRESSED_CONTENT_TYPES = {"image/jpeg", "image/gif", "image/png", "image/avif"}
 PLAINTEXT_CONTENT_TYPE = "text/plain"
+JSON_CONTENT_TYPE = "application/json"
 HTTP_VERSION = "HTTP/1.1"
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+# how many bytes to recieve from a client socket at once
+RECIEVE_CHUNK_SIZE = 65536
 
 OK_STATUS_CODE = 200
 OK_REASON_PHRASE = "OK"
 CREATED_STATUS_CODE = 201
 CREATED_REASON_PHRASE = "Created"
+PARTIAL_CONTENT_STATUS_CODE = 206
+PARTIAL_CONTENT_REASON_PHRASE = "Partial Content"
+NOT_MODIFIED_STATUS_CODE = 304
+NOT_MODIFIED_REASON_PHRASE = "Not Modified"
 BAD_REQUEST_STATUS_CODE = 400
 BAD_REQUEST_REASON_PHRASE = "Bad Request"
 FORBIDDEN_STATUS_CODE = 403
 FORBIDDEN_REASON_PHRASE = "Forbidden"
 NOT_FOUND_STATUS_CODE = 404
 NOT_FOUND_REASON_PHRASE = "Not Found"
+METHOD_NOT_ALLOWED_STATUS_CODE = 405
+METHOD_NOT_ALLOWED_REASON_PHRASE = "Method Not Allowed"
 REQUEST_TIMEOUT_STATUS_CODE = 408
 REQUEST_TIMEOUT_REASON_PHRASE = "Request Timeout"
+CONFLICT_STATUS_CODE = 409
+CONFLICT_REASON_PHRASE = "Conflict"
+PAYLOAD_TOO_LARGE_STATUS_CODE = 413
+PAYLOAD_TOO_LARGE_REASON_PHRASE = "Payload Too Large"
+RANGE_NOT_SATISFIABLE_STATUS_CODE = 416
+RANGE_NOT_SATISFIABLE_REASON_PHRASE = "Range Not Satisfiable"
 INTERNAL_SERVER_ERROR_STATUS_CODE = 500
 INTERNAL_SERVER_ERROR_REASON_PHRASE = "Internal Server Error"
+NOT_IMPLEMENTED_STATUS_CODE = 501
+NOT_IMPLEMENTED_REASON_PHRASE = "Not Implemented"
+SERVICE_UNAVAILABLE_STATUS_CODE = 503
+SERVICE_UNAVAILABLE_REASON_PHRASE = "Service Unavailable"
+
+
+class ClientDisconnected(Exception):
+    """
+    This class is an exception that will be thrown when the client closes the connection in the middle of a request.
+    There is no one to send a response to, so the server should just close the connection.
+    """
 
 
 class BadRequest(Exception):
@@ -34,6 +96,32 @@ class BadRequest(Exception):
         self.message = message
 
 
+class UnsupportedTransferCoding(Exception):
+    """
+    This class is an exception that will be thrown when the request body is sent with a transfer coding the server
+    doesn't know (anything but chunked). The body can't be read, so the server should return the
+    501 Not Implemented response and close the connection (rfc 7230 3.3.1).
+    """
+
+
+class ServiceUnavailable(Exception):
+    """
+    This class is an exception that will be thrown when the server is too busy to handle the request now.
+    The server should return the 503 Service Unavailable response, asking the client to retry after retry_after seconds.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class PayloadTooLarge(Exception):
+    """
+    This class is an exception that will be thrown when the request body is bigger than the server allows.
+    The server should return the 413 Payload Too Large response and close the connection.
+    """
+
+
 def try_retrieve_from_dictionary(dictionary: dict, key, error_message: str):
     """
     Returns dictionary[key] if key is in dictionary, and raises BadRequest with the given error_message otherwise.
@@ -61,46 +149,279 @@ def trim_linear_whitespaces(string: str) -> str:
     return string.strip(" \t")
 
 
-def parse_header(header_line: str) -> tuple[str, str]:
+def decode_header_bytes(header_bytes: bytes) -> str:
     """
-    Gets a header line and splits it to the header name and value.
-    Returns a pair of header name, header value
+    Decodes the bytes of the request line or headers to a string.
+    Raises BadRequest if they aren't a valid encoding.
     """
-    header_splitter = header_line.find(':')
-    if header_splitter == -1:
-        raise BadRequest("Missing colon in header")
-    header_value = trim_linear_whitespaces(header_line[header_splitter + 2:])
-    return header_line[:header_splitter], header_value
+    try:
+        return header_bytes.decode()
+    except UnicodeDecodeError:
+        raise BadRequest("Invalid characters in request headers")
 
 
-def parse_request_path(path: str) -> tuple[str, dict[str, str]]:
+def parse_query_string(query_string: str) -> dict[str, str]:
     """
-    This methods parses a request url, giving the actual url and the query parameters.
-    It gets a full query url (path), and returns a pair of actual url and a dictionary containing the query parameters.
+    This methods parses the query string of a request url (the part after the question mark).
+    Returns a dictionary containing the query parameters.
     Each entry in the dictionary has the parameter name as the key and the parameter value as value (None if no value).
+    Names and values are percent-decoded, and + is decoded to a space (like forms encode them).
     """
-    path_question_mark_index = path.find('?')
-    if path_question_mark_index == -1:  # no url parameters
-        return (path, {})
-    # before the question mark
-    actual_path = path[:path_question_mark_index]
-    # after the question mark
-    parameters_string = path[path_question_mark_index + 1:]
-    parameters_string_seperated = parameters_string.split('&')
     parameters = {}
-    for parameter_string in parameters_string_seperated:
-        equal_sign_index = parameter_string.find(
-            '=')  # seperates name and value
-        if equal_sign_index == -1:  # no value
-            key = parameter_string
-            value = None
-        else:
-            # before equal sign - name
-            key = parameter_string[:equal_sign_index]
-            # after equal sign - value
-            value = parameter_string[equal_sign_index + 1:]
-        parameters[key] = value
-    return (actual_path, parameters)
+    if query_string == "":
+        return parameters
+    for parameter_string in query_string.split('&'):
+        # the equal sign seperates name and value
+        key, equal_sign, value = parameter_string.partition('=')
+        parameters[decode_query_component(key)] = decode_query_component(
+            value) if equal_sign != "" else None
+    return parameters
+
+
+def get_query_parameter_values(query_string: str, name: str) -> list[str]:
+    """
+    Returns all the values of a query parameter that may be repeated in the query string, in their order
+    (parse_query_string keeps only the last one). A parameter without a value has an empty value.
+    """
+    values = []
+    if query_string == "":
+        return values
+    for parameter_string in query_string.split('&'):
+        key, _, value = parameter_string.partition('=')
+        if decode_query_component(key) == name:
+            values.append(decode_query_component(value))
+    return values
+
+
+def decode_query_component(component: str) -> str:
+    """
+    Percent-decodes a name or value of a query parameter, and decodes + to a space.
+    Most components have nothing encoded, so they're returned as is without decoding.
+    """
+    if "%" not in component and "+" not in component:
+        return component
+    return urllib.parse.unquote_plus(component)
+
+
+class RequestHeaders:
+    """
+    This class holds the headers of a request (or of a part of a form data body).
+    They are kept as the raw bytes that were recieved, and decoded and validated on the first access.
+    The headers are never split to a dictionary: each header is found in the text by its name when it's looked up,
+    since the server looks at only a few of the headers a client sends.
+    Header names are case-insensitive (rfc 7230 3.2), so they can be looked up in any case.
+    It's used like a read only dictionary of header name (string) to header value (string).
+    Raises BadRequest on the first access if the headers are invalid.
+    """
+    __slots__ = ("__raw_headers", "__headers_text", "__lower_case_headers_text")
+
+    def __init__(self, raw_headers: bytes):
+        self.__raw_headers = raw_headers
+        self.__headers_text = None
+        self.__lower_case_headers_text = None
+
+    def __decode(self):
+        """
+        Decodes and validates the headers.
+        Every line in the text starts with \r\n (including the first one), so a header is found by \r\n{name}:
+        """
+        headers_text = decode_header_bytes(self.__raw_headers)
+        # every header line is a header name, a colon and a value
+        if headers_text != "" and not all(":" in header_line for header_line in headers_text.split("\r\n")):
+            raise BadRequest("Missing colon in header")
+        self.__headers_text = "\r\n" + headers_text
+        self.__lower_case_headers_text = self.__headers_text.lower()
+
+    def get(self, name: str, default=None):
+        """
+        Returns the value of the header with the given name, or default if there's no such header.
+        If the header appears more than once, the last value is returned.
+        """
+        if self.__headers_text is None:
+            self.__decode()
+        header_start = "\r\n" + name.lower() + ":"
+        value_start = self.__lower_case_headers_text.rfind(header_start)
+        if value_start == -1:
+            return default
+        headers_text = self.__headers_text
+        value_start += len(header_start)
+        value_end = headers_text.find("\r\n", value_start)
+        # trim the linear whitespaces around the value (like trim_linear_whitespaces)
+        if value_end == -1:  # the last header
+            return headers_text[value_start:].strip(" \t")
+        return headers_text[value_start:value_end].strip(" \t")
+
+    def get_all(self, name: str) -> list[str]:
+        """
+        Returns the values of all the headers with the given name, in the order they appear
+        (an empty list if there's no such header).
+        """
+        if self.__headers_text is None:
+            self.__decode()
+        header_start = "\r\n" + name.lower() + ":"
+        headers_text = self.__headers_text
+        values = []
+        value_start = self.__lower_case_headers_text.find(header_start)
+        while value_start != -1:
+            value_start += len(header_start)
+            value_end = headers_text.find("\r\n", value_start)
+            if value_end == -1:  # the last header
+                value_end = len(headers_text)
+            values.append(headers_text[value_start:value_end].strip(" \t"))
+            value_start = self.__lower_case_headers_text.find(header_start, value_end)
+        return values
+
+    def __getitem__(self, name: str) -> str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+
+class RequestBody:
+    """
+    This class represents the body of a request, which is recieved from the client only when it's read.
+    It gets the length of the body (from Content-Length) and a function that recieves up to a given amount of bytes
+    from the connection (at least one, raising ClientDisconnected if the client closed the connection).
+    Reading never returns more than the length of the body, so the next request on the connection isn't touched.
+    """
+
+    def __init__(self, length: int, recieve_some):
+        self.__length = length
+        self.__remaining_length = length
+        self.__recieve_some = recieve_some
+
+    def get_length(self) -> int:
+        return self.__length
+
+    def get_remaining_length(self) -> int:
+        return self.__remaining_length
+
+    def get_recieved_length(self) -> int:
+        return self.__length - self.__remaining_length
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to size bytes of the body (all of the rest if size is negative), at least one unless the body ended.
+        Returns an empty byte string at the end of the body.
+        """
+        if size < 0 or size > self.__remaining_length:
+            size = self.__remaining_length
+        if size == 0:
+            return b""
+        trace = get_request_trace()
+        start = time.perf_counter() if trace is not None else 0.0
+        content = self.__recieve_some(size)
+        self.__remaining_length -= len(content)
+        if trace is not None:
+            trace.add_stage("read_body", start)
+        return content
+
+    def read_all(self) -> bytes:
+        """
+        Reads the rest of the body and returns it as one byte string.
+        """
+        content = bytearray()
+        while self.__remaining_length > 0:
+            content += self.read(RECIEVE_CHUNK_SIZE)
+        return bytes(content)
+
+    def discard(self):
+        """
+        Reads the rest of the body without keeping it, so the connection is ready for the next request.
+        """
+        while self.__remaining_length > 0:
+            self.read(RECIEVE_CHUNK_SIZE)
+
+
+class ChunkedRequestBody:
+    """
+    This class represents a request body sent with the chunked transfer coding (rfc 7230 4.1), which is recieved
+    from the client only when it's read, like RequestBody. Its length isn't known until the last chunk arrives.
+    It gets a function that recieves up to a given amount of bytes from the connection (like RequestBody),
+    a function that recieves a line (without its \r\n), and the biggest body the server accepts.
+    Chunk extensions and trailer fields are ignored.
+    Raises BadRequest if the chunks are invalid, and PayloadTooLarge when the body grows beyond max_body_size.
+    """
+
+    def __init__(self, recieve_some, recieve_line, max_body_size: int):
+        self.__recieve_some = recieve_some
+        self.__recieve_line = recieve_line
+        self.__max_body_size = max_body_size
+        self.__recieved_length = 0
+        self.__chunk_remaining_length = 0
+        self.__ended = False
+
+    def get_length(self) -> None:
+        """
+        The length of a chunked body isn't known in advance.
+        """
+        return None
+
+    def get_recieved_length(self) -> int:
+        return self.__recieved_length
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to size bytes of the body (all of the rest if size is negative), at least one unless the body ended.
+        Returns an empty byte string at the end of the body.
+        """
+        if size < 0:
+            return self.read_all()
+        trace = get_request_trace()
+        start = time.perf_counter() if trace is not None else 0.0
+        if self.__chunk_remaining_length == 0 and not self.__ended:
+            self.__start_chunk()
+        if self.__ended or size == 0:
+            return b""
+        content = self.__recieve_some(
+            min(size, self.__chunk_remaining_length))
+        self.__chunk_remaining_length -= len(content)
+        self.__recieved_length += len(content)
+        if self.__chunk_remaining_length == 0 and self.__recieve_line() != "":  # every chunk ends with \r\n
+            raise BadRequest("Invalid chunk")
+        if trace is not None:
+            trace.add_stage("read_body", start)
+        return content
+
+    def read_all(self) -> bytes:
+        """
+        Reads the rest of the body and returns it as one byte string.
+        """
+        content = bytearray()
+        chunk = self.read(RECIEVE_CHUNK_SIZE)
+        while chunk != b"":
+            content += chunk
+            chunk = self.read(RECIEVE_CHUNK_SIZE)
+        return bytes(content)
+
+    def discard(self):
+        """
+        Reads the rest of the body without keeping it, so the connection is ready for the next request.
+        """
+        while self.read(RECIEVE_CHUNK_SIZE) != b"":
+            pass
+
+    def __start_chunk(self):
+        """
+        Recieves the size line of the next chunk. After the last chunk (of size 0), recieves the trailer fields.
+        """
+        # the size is in hex, and may be followed by extensions after a semicolon
+        size_text = self.__recieve_line().partition(";")[0].strip()
+        if size_text == "" or any(char not in HEX_DIGITS for char in size_text):
+            raise BadRequest("Invalid chunk size")
+        size = int(size_text, 16)
+        if size == 0:
+            while self.__recieve_line() != "":  # the trailer fields end with an empty line
+                pass
+            self.__ended = True
+            return
+        if self.__recieved_length + size > self.__max_body_size:
+            raise PayloadTooLarge()
+        self.__chunk_remaining_length = size
 
 
 class HttpRequest:
@@ -109,18 +430,34 @@ class HttpRequest:
     It has:
     method - string of the request method (GET/POST)
     request_path - the requested path as string
-    query_parameters - a dictionary of the query parameters (key - header name (string), value - header value (string))
-    headers - a dictionary of the request headers.
-    The key is header name (string), the value is header value (string)
-    body - a byte string of the request body.
+    http_version - the HTTP version of the request as string, for example HTTP/1.1
+    query_string - the part of the url after the question mark, as string. get_query_parameters parses it
+    (on the first call) to a dictionary of the query parameters (key - parameter name, value - parameter value)
+    headers - the RequestHeaders of the request, which is used like a dictionary.
+    The key is header name (string, in any case), the value is header value (string)
+    body - a RequestBody (or ChunkedRequestBody) to stream the request body from (None if there's no body).
+    get_body reads all of it and returns it as a byte string.
+    path_parameters - a dictionary of the parts of the path matched by the parameters of the route,
+    set by the router (key - parameter name (string), value - the matching part of the path (string))
+    head_size - the amount of bytes of the request line and headers, as they were recieved
+    client_address - the IP address of the client that sent the request (as string, empty if it's unknown)
     """
+    __slots__ = ("__method", "__request_path", "__http_version", "__query_string", "__query_parameters",
+                 "__headers", "__body", "__body_content", "__path_parameters", "__head_size", "__client_address")
 
-    def __init__(self, method, request_path, query_parameters, headers, body):
+    def __init__(self, method, request_path, http_version, query_string, headers, body, head_size=0,
+                 client_address=""):
         self.__method = method
         self.__request_path = request_path
-        self.__query_parameters = query_parameters
+        self.__http_version = http_version
+        self.__query_string = query_string
+        self.__query_parameters = None
         self.__headers = headers
         self.__body = body
+        self.__body_content = None
+        self.__path_parameters = {}
+        self.__head_size = head_size
+        self.__client_address = client_address
 
     def get_method(self):
         return self.__method
@@ -128,15 +465,42 @@ class HttpRequest:
     def get_request_path(self):
         return self.__request_path
 
+    def get_http_version(self):
+        return self.__http_version
+
+    def get_query_string(self):
+        return self.__query_string
+
     def get_query_parameters(self):
+        if self.__query_parameters is None:
+            self.__query_parameters = parse_query_string(self.__query_string)
         return self.__query_parameters
 
     def get_headers(self):
         return self.__headers
 
     def get_body(self):
+        if self.__body is None:
+            return None
+        if self.__body_content is None:
+            self.__body_content = self.__body.read_all()
+        return self.__body_content
+
+    def get_body_stream(self):
         return self.__body
 
+    def get_path_parameters(self):
+        return self.__path_parameters
+
+    def set_path_parameters(self, path_parameters):
+        self.__path_parameters = path_parameters
+
+    def get_head_size(self):
+        return self.__head_size
+
+    def get_client_address(self):
+        return self.__client_address
+
 
 class HttpResponse:
     """
@@ -146,17 +510,28 @@ class HttpResponse:
     reason_phrase - response reason phrase as string, for example OK or Not Found
     headers - a dictionary of the response headers.
     The key is header name (string), the value is header value (string)
-    body - a byte string of the request body.
+    body - a byte string of the request body, a FileBody, or an iterator (like a generator) of byte strings for a body
+    that is streamed while it's generated. A streamed body is sent in chunks (with Transfer-Encoding: chunked),
+    so it doesn't have to be in memory at once and its start is sent before the rest is generated.
+    serialized_headers - optional header lines that were already serialized (each ending with \r\n),
+    sent after the headers in the dictionary. When given, the Content-Length header isn't added automatically,
+    so they have to include it (unless the response must not have one, like 304 Not Modified).
     """
+    __slots__ = ("__status_code", "__reason_phrase", "__headers", "__body", "__serialized_headers")
 
-    def __init__(self, status_code, reason_phrase, headers, body):
+    def __init__(self, status_code, reason_phrase, headers, body, serialized_headers=b""):
         self.__status_code = status_code
         self.__reason_phrase = reason_phrase
         self.__headers = headers
         self.__body = body
+        self.__serialized_headers = serialized_headers
 
-        # Add the Content-Length header to match the body
-        self.__headers["Content-Length"] = len(body)
+        # Add the Content-Length header to match the body. the length of a streamed body isn't known in advance
+        if serialized_headers == b"":
+            if isinstance(body, collections.abc.Iterator):
+                self.__headers["Transfer-Encoding"] = "chunked"
+            else:
+                self.__headers["Content-Length"] = len(body)
 
     def get_status_code(self):
         return self.__status_code
@@ -170,6 +545,159 @@ class HttpResponse:
     def get_body(self):
         return self.__body
 
+    def get_serialized_headers(self):
+        return self.__serialized_headers
+
+
+def parse_request_head(header_block: bytes, max_header_count: int) -> tuple[str, str, str, str, RequestHeaders]:
+    """
+    Parses the head of a request: the request line and the headers, without the \r\n\r\n that ends them.
+    Only the request line is parsed here, the headers are parsed by RequestHeaders when they're used.
+    Raises BadRequest if there are more than max_header_count headers.
+    Returns a tuple of method, actual path, http version, query string and headers.
+    """
+    request_line, _, raw_headers = header_block.partition(b"\r\n")
+    # every header is on its own line
+    if raw_headers != b"" and raw_headers.count(b"\r\n") + 1 > max_header_count:
+        raise BadRequest("Too many request headers")
+    # handling first line of request: method and path
+    first_line_splitted = decode_header_bytes(request_line).split(' ')
+    if len(first_line_splitted) < 2:  # not enough elements in the first line
+        raise BadRequest("Invalid first request line")
+    method = first_line_splitted[0]
+    request_path = first_line_splitted[1]
+    # HTTP/0.9 style request lines have no version, and HTTP/1.0 is the closest version to treat them as
+    http_version = first_line_splitted[2] if len(
+        first_line_splitted) > 2 else "HTTP/1.0"
+    # seperate the actual path from the query string, which is parsed only if it's used
+    actual_path, _, query_string = request_path.partition('?')
+    return method, actual_path, http_version, query_string, RequestHeaders(raw_headers)
+
+
+def get_content_length(headers: RequestHeaders, max_body_size: int) -> int | None:
+    """
+    Returns the length of the request body according to the Content-Length header, or None if there's no body.
+    Raises BadRequest if the header isn't a valid length, and PayloadTooLarge if it's more than max_body_size.
+    A valid length is only ASCII digits (rfc 7230 3.3.2): int() also accepts forms like "+10", "1_0" or other digits,
+    which a proxy in front of the server could read differently, so they raise BadRequest.
+    The header may be repeated (or be a list) only with the same value, since with different values it's unclear where
+    the body ends, so that raises BadRequest too.
+    """
+    content_lengths = {trim_linear_whitespaces(value) for header_value in headers.get_all("Content-Length")
+                       for value in header_value.split(",")}
+    if len(content_lengths) == 0:
+        return None
+    if len(content_lengths) > 1:
+        raise BadRequest("Conflicting Content-Length values")
+    content_length = content_lengths.pop()
+    if not (content_length.isascii() and content_length.isdigit()):
+        raise BadRequest("Content-Length isn't integer")
+    length = int(content_length)
+    if length > max_body_size:
+        raise PayloadTooLarge()
+    return length
+
+
+def is_chunked_request(headers: RequestHeaders) -> bool:
+    """
+    Checks if the request body is sent with the chunked transfer coding, according to the Transfer-Encoding header.
+    The codings of all the Transfer-Encoding headers are taken together, as one list in order (rfc 7230 3.2.2).
+    Raises BadRequest if the request has both Transfer-Encoding and Content-Length, since they could disagree about
+    where the body ends (rfc 7230 3.3.3), and if chunked isn't the last coding or appears more than once (then
+    the end of the body can't be found). Raises UnsupportedTransferCoding if chunked isn't the only transfer coding.
+    """
+    transfer_encodings = headers.get_all("Transfer-Encoding")
+    if len(transfer_encodings) == 0:
+        return False
+    if "Content-Length" in headers:
+        raise BadRequest("Both Transfer-Encoding and Content-Length")
+    # empty list elements are allowed, and ignored (rfc 7230 7)
+    codings = [coding for coding in (trim_linear_whitespaces(coding).lower()
+                                     for transfer_encoding in transfer_encodings
+                                     for coding in transfer_encoding.split(",")) if coding != ""]
+    if len(codings) == 0:
+        raise BadRequest("Invalid Transfer-Encoding")
+    if "chunked" in codings and (codings[-1] != "chunked" or codings.count("chunked") > 1):
+        raise BadRequest("Chunked isn't the last transfer coding")
+    if codings != ["chunked"]:
+        raise UnsupportedTransferCoding()
+    return True
+
+
+def serialize_response_head(response: HttpResponse) -> bytes:
+    """
+    Returns the status line and headers of the response as they are sent, including the empty line that ends them.
+    """
+    lines = [f"{HTTP_VERSION} {response.get_status_code()} {response.get_reason_phrase()}\r\n"]
+    for header, value in response.get_headers().items():
+        lines.append(f"{header}: {value}\r\n")
+    # a single join allocates the whole head once
+    return "".join(lines).encode() + response.get_serialized_headers() + b"\r\n"
+
+
+def serialize_chunk(chunk: bytes) -> list[bytes]:
+    """
+    Returns the buffers that send a chunk of a streamed body in the chunked transfer coding (rfc 7230 4.1):
+    its size in hex, the chunk and \r\n.
+    """
+    return [b"%x\r\n" % len(chunk), chunk, b"\r\n"]
+
+
+# ends a body sent in chunks: the last chunk (of size 0) and an empty trailer
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+def prepare_streamed_response(request: HttpRequest | None, response: HttpResponse) -> bool:
+    """
+    Makes a response with a streamed body fit the client: HTTP/1.0 clients don't know the chunked transfer coding,
+    so they get the body as is and it ends when the connection is closed.
+    Returns False if the connection has to be closed after the response.
+    """
+    if request is not None and request.get_http_version() != "HTTP/1.0":
+        return True
+    del response.get_headers()["Transfer-Encoding"]
+    return False
+
+
+def remove_response_body(response: HttpResponse) -> HttpResponse:
+    """
+    Returns the response to a HEAD request: the given response without its body, but with all of its headers
+    (including the Content-Length or Transfer-Encoding the body would have had, as rfc 7231 4.3.2 requires).
+    A FileBody is closed without sending it, and a streamed body is stopped without generating it.
+    """
+    body = response.get_body()
+    if hasattr(body, "close"):  # FileBody and generators
+        body.close()
+    headers = response.get_headers()
+    framing_headers = {header: headers[header] for header in ("Content-Length", "Transfer-Encoding")
+                       if header in headers}
+    head_response = HttpResponse(response.get_status_code(), response.get_reason_phrase(), headers, b"",
+                                 response.get_serialized_headers())
+    # the empty body set Content-Length: 0
+    headers.pop("Content-Length", None)
+    headers.update(framing_headers)
+    return head_response
+
+
+def get_next_chunk(body) -> bytes | None:
+    """
+    Generates the next chunk of a streamed body, skipping empty ones (an empty chunk would end the body).
+    Returns None at the end of the body.
+    If generating the body fails, the head of the response was sent already, so instead of an error response
+    the connection is aborted with ConnectionError (the body ends without the last chunk, so the client knows it's
+    incomplete). It's a bug in the server, so the error is logged.
+    """
+    try:
+        for chunk in body:
+            if len(chunk) > 0:
+                return chunk
+    except ConnectionError:  # the body can't be completed (like a file that shrank), which isn't a bug
+        raise
+    except Exception as e:
+        traceback.print_exception(e)
+        raise ConnectionError("Streamed body failed") from e
+    return None
+
 
 class ClientConnection:
     """
@@ -178,224 +706,1192 @@ class ClientConnection:
     It allows to recieve a HttpRequest instance and send a HttpResponse instance.
     """
 
-    def __init__(self, sock):
+    def __init__(self, sock, client_timeout: float, max_header_size: int, max_header_count: int, max_body_size: int,
+                 header_timeout: float, body_timeout: float, min_body_rate: int, client_address: str = ""):
         self.__socket = sock
+        self.__client_address = client_address
+        self.__client_timeout = client_timeout
+        self.__max_header_size = max_header_size
+        self.__max_header_count = max_header_count
+        self.__max_body_size = max_body_size
+        self.__header_timeout = header_timeout
+        self.__body_timeout = body_timeout
+        self.__min_body_rate = min_body_rate
+        # every recv waits up to the client timeout, but not past the deadline (time.monotonic) of the part of the
+        # request that is being recieved, so a client can't hold the connection by sending a byte at a time.
+        self.__deadline = None
+        # while a body is recieved, every byte that arrives moves the deadline by 1 / min_body_rate seconds
+        self.__recieving_body = False
+        self.__socket_timeout = client_timeout
+        # bytes that were recieved from the socket but weren't consumed yet.
+        # kept between requests, so pipelined requests that arrived in the same read aren't lost.
+        self.__buffer = bytearray()
+        # a reusable chunk the socket recieves into, to avoid allocating a new bytes object for every recv
+        self.__recieve_chunk = memoryview(bytearray(RECIEVE_CHUNK_SIZE))
+
+    def __fill_buffer(self):
+        """
+        Recieves the next chunk of bytes from the socket and appends it to the buffer.
+        Raises ClientDisconnected if the client closed the connection, and socket.timeout if the deadline passed.
+        """
+        if self.__deadline is not None:
+            remaining_time = self.__deadline - time.monotonic()
+            if remaining_time <= 0:
+                raise socket.timeout("Request deadline passed")
+            self.__set_socket_timeout(min(self.__client_timeout, remaining_time))
+        recieved_length = self.__socket.recv_into(self.__recieve_chunk)
+        if recieved_length == 0:  # recv returns nothing only when the other side closed the connection
+            raise ClientDisconnected()
+        if self.__recieving_body:  # the client gets more time only for the bytes it actually sent
+            self.__deadline += recieved_length / self.__min_body_rate
+        self.__buffer += self.__recieve_chunk[:recieved_length]
+
+    def get_client_address(self) -> str:
+        return self.__client_address
+
+    def __set_socket_timeout(self, timeout: float):
+        """
+        Sets the timeout of the socket, unless it's set already (setting it is a system call).
+        """
+        if timeout != self.__socket_timeout:
+            self.__socket.settimeout(timeout)
+            self.__socket_timeout = timeout
+
+    def wait_for_request(self, idle_timeout: float) -> bool:
+        """
+        Waits up to idle_timeout seconds for the client to start sending another request on the connection.
+        Returns True if there's a new request to recieve, or False if the client stayed idle or closed the connection.
+        """
+        if len(self.__buffer) > 0:  # a pipelined request already arrived
+            return True
+        self.__deadline = None
+        self.__recieving_body = False
+        self.__set_socket_timeout(idle_timeout)
+        try:
+            self.__fill_buffer()
+        except (socket.timeout, ClientDisconnected):
+            return False
+        return True
+
+    def recieve_until(self, delimiter: bytes, max_size: int, error_message: str) -> bytes:
+        """
+        Recieves all bytes until the delimiter, and consumes the delimiter as well.
+        Returns the bytes before the delimiter.
+        Raises BadRequest with the given error_message if the delimiter doesn't appear in the first max_size bytes.
+        """
+        search_start = 0
+        delimiter_pos = self.__buffer.find(delimiter)
+        while delimiter_pos == -1:
+            if len(self.__buffer) > max_size:
+                raise BadRequest(error_message)
+            # only scan the new bytes, but the delimiter might start at the end of the bytes that were already scanned
+            search_start = max(0, len(self.__buffer) - len(delimiter) + 1)
+            self.__fill_buffer()
+            delimiter_pos = self.__buffer.find(delimiter, search_start)
+        if delimiter_pos > max_size:
+            raise BadRequest(error_message)
+        content = bytes(self.__buffer[:delimiter_pos])
+        del self.__buffer[:delimiter_pos + len(delimiter)]
+        return content
+
+    def recieve_some(self, max_size: int) -> bytes:
+        """
+        Recieves at least one and up to max_size bytes, from the buffer if there are any there and from the socket otherwise.
+        Returns the bytes recieved.
+        """
+        if len(self.__buffer) == 0:
+            self.__fill_buffer()
+        content = bytes(self.__buffer[:max_size])
+        del self.__buffer[:max_size]
+        return content
 
     def recieve_line(self) -> str:
         """
         Recieves a single line, which means all characters until \r\n.
         Returns the line recieved.
         """
-        cur_text = []
-        while cur_text[-2:] != ["\r", "\n"]:  # recieve another character until meeting \r\n
-            cur_text.append(self.__socket.recv(1).decode())
-        cur_text = cur_text[:-2]  # remove \r\n in the end
-        return ''.join(cur_text)
+        line = self.recieve_until(
+            b"\r\n", self.__max_header_size, "Line too long")
+        return decode_header_bytes(line)
 
     def recieve_request(self) -> HttpRequest:
         """
         Recieves a request from the client.
         Parses the request and returns it as a HttpRequest instance.
+        The head has to arrive within the header timeout, and the body (which is recieved when it's read) within
+        the body timeout plus a second for every min_body_rate bytes that arrived of it, whatever length the client
+        declared. So a client that sends the body slower than min_body_rate is cut off with socket.timeout.
         """
-        # handling first line of request: method and path
-        first_line = self.recieve_line()
-        first_line_splitted = first_line.split(' ')
-        if len(first_line_splitted) < 2:  # not enough elements in the first line
-            raise BadRequest("Invalid first request line")
-        method = first_line_splitted[0]
-        request_path = first_line_splitted[1]
-        # parse the request path to actual path and query parameters
-        actual_path, query_parameters = parse_request_path(request_path)
-        # receive headers
-        headers = {}
-        cur_line = self.recieve_line()  # start by reading the next line
-        while cur_line != "":  # continue until \r\n\r\n (empty line)
-            # parse the current line as header
-            header, value = parse_header(cur_line)
-            headers[header] = value
-            cur_line = self.recieve_line()  # read the next line
-        # receive content
+        self.__deadline = time.monotonic() + self.__header_timeout
+        self.__recieving_body = False
+        # recieve the whole header block (request line and headers) at once, until \r\n\r\n (empty line)
+        header_block = b""
+        while header_block == b"":  # ignore empty lines before the request line, as mentioned in rfc 7230 3.5
+            header_block = self.recieve_until(
+                b"\r\n\r\n", self.__max_header_size, "Request headers too large").lstrip(b"\r\n")
+        method, request_path, http_version, query_string, headers = parse_request_head(
+            header_block, self.__max_header_count)
+        # the content is recieved only when the request handler reads it
         body = None  # start by body as None in case of no body
-        if "Content-Length" in headers:  # if there's a content-length header, there is a request body
-            # try to parse content-length as int
-            length = try_parse_int(
-                headers["Content-Length"], "Content-Length isn't integer")
-            # recieve the value of bytes mentioned in content-length
-            body = self.__socket.recv(length)
-        return HttpRequest(method, actual_path, query_parameters, headers, body)
+        if is_chunked_request(headers):
+            body = ChunkedRequestBody(self.recieve_some, self.recieve_line, self.__max_body_size)
+        else:
+            length = get_content_length(headers, self.__max_body_size)
+            if length is not None:  # if there's a content-length header, there is a request body
+                body = RequestBody(length, self.recieve_some)
+        if body is not None:
+            self.__deadline = time.monotonic() + self.__body_timeout
+            self.__recieving_body = True
+        # the head is followed by \r\n\r\n
+        return HttpRequest(method, request_path, http_version, query_string, headers, body, len(header_block) + 4,
+                           self.__client_address)
+
+    def __send_all(self, buffers: list, flags: int = 0):
+        """
+        Sends all the given buffers (bytes-like objects), in order, with the given send flags.
+        They are sent together with scatter-gather sendmsg, so there's no need to join them into one buffer,
+        and partial writes are continued until everything is sent.
+        """
+        if not hasattr(self.__socket, "sendmsg"):  # sendmsg isn't available on every platform
+            self.__socket.sendall(b"".join(buffers), flags)
+            return
+        buffers = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+        while buffers:
+            sent = self.__socket.sendmsg(buffers, [], flags)
+            # drop the buffers that were sent completely, and the sent part of the first one that wasn't
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent > 0:
+                buffers[0] = buffers[0][sent:]
+
+    def __send_streamed_body(self, head: bytes, body, chunked: bool) -> int:
+        """
+        Sends the head of a response and its streamed body, every chunk as soon as it's generated
+        (a send waits while the client doesn't keep up, so the body isn't generated faster than it's sent).
+        The head is sent with the first chunk. Returns the amount of bytes sent.
+        """
+        buffers = [head]
+        sent_byte_count = 0
+        try:
+            chunk = get_next_chunk(body)
+            while chunk is not None:
+                buffers += serialize_chunk(chunk) if chunked else [chunk]
+                self.__send_all(buffers)
+                sent_byte_count += sum(len(buffer) for buffer in buffers)
+                buffers = []
+                chunk = get_next_chunk(body)
+        finally:
+            if hasattr(body, "close"):  # stops a generator that wasn't exhausted
+                body.close()
+        if chunked:
+            buffers.append(LAST_CHUNK)
+        self.__send_all(buffers)
+        return sent_byte_count + sum(len(buffer) for buffer in buffers)
 
-    def send_response(self, response: HttpResponse):
+    def send_response(self, response: HttpResponse) -> int:
         """
         This method sends a HTTP response for the client.
         It gets the response as HttpResponse object and sends it according to the protocol.
+        The status line and headers are sent together with the body, in as few system calls as possible.
+        Streamed bodies are sent in chunks, unless prepare_streamed_response removed the Transfer-Encoding header.
+        Returns the amount of bytes sent.
         """
-        # send first line
-        first_line = f"{HTTP_VERSION} {response.get_status_code()} {response.get_reason_phrase()}\r\n"
-        self.__socket.send(first_line.encode())
-        # send the headers
-        headers = response.get_headers()
-        for header, value in headers.items():
-            header_line = f"{header}: {value}\r\n"
-            self.__socket.send(header_line.encode())
-        # send the body
-        # additional \r\n (empty line) to seperate the body
-        self.__socket.send(b"\r\n")
-        self.__socket.send(response.get_body())
+        # the deadline of the request doesn't apply to the response, every send waits up to the client timeout
+        self.__set_socket_timeout(self.__client_timeout)
+        head = serialize_response_head(response)
+        body = response.get_body()
+        if isinstance(body, collections.abc.Iterator):
+            return self.__send_streamed_body(head, body, "Transfer-Encoding" in response.get_headers())
+        if isinstance(body, FileBody):
+            try:
+                # tell the kernel more data follows, so the head goes in the same packet as the start of the file
+                self.__send_all([head], getattr(socket, "MSG_MORE", 0))
+                # the kernel copies the file to the socket directly, without passing it through python
+                sent = self.__socket.sendfile(
+                    body.get_file(), body.get_offset(), len(body))
+            finally:
+                body.close()
+            if sent < len(body):  # the file got shorter, the client can't know where the response ends
+                raise ConnectionError("File shrank while sending it")
+        else:
+            self.__send_all([head, body])
+        return len(head) + len(body)
 
     def close(self):
         self.__socket.close()
 
 
+def create_listening_socket(host: str, port: int, reuse_port: bool, backlog: int) -> socket.socket:
+    """
+    Creates a server socket that listens on the given host and port.
+    If reuse_port is True, SO_REUSEPORT is set so several processes can bind their own socket to the same port,
+    and the kernel balances the incoming connections between them.
+    Up to backlog connections wait to be accepted (the kernel may limit it further, e.g. by net.core.somaxconn),
+    the clients of the connections beyond it are made to retry.
+    """
+    server_socket = socket.socket(
+        socket.AF_INET, socket.SOCK_STREAM)  # create the server socket
+    if os.name == "posix":  # allow binding again right after a restart, while old connections are in TIME_WAIT
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # bind to the given host and port
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)  # start listening for clients
+    return server_socket
+
+
+# how often a waiting accept wakes up to check whether the server should stop
+ACCEPT_POLL_INTERVAL = 1
+
+
 class HttpServer:
     """
     This class represents a HTTP Server.
     It maintains a server socket, and allows to accept a client (and returns it as a ClientConnection object)
     Gets host address, port and timeout for clients as parameters.
+    Also gets the limits on the size of the request headers (in bytes) and on their amount, and on the size of the body,
+    the total time to recieve the request head, and to recieve the body (see ClientConnection.recieve_request).
+    Optionally gets an already listening socket to accept clients from, instead of binding a new one
+    (otherwise a socket is bound, with the given listen backlog).
     """
 
-    def __init__(self, host: str, port: int, client_timeout: float):
-        self.__server_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)  # create the server socket
-        # bind to the given host and port
-        self.__server_socket.bind((host, port))
-        self.__server_socket.listen()  # start listening for clients
+    def __init__(self, host: str, port: int, client_timeout: float, max_header_size: int, max_header_count: int,
+                 max_body_size: int, header_timeout: float, body_timeout: float, min_body_rate: int, backlog: int,
+                 listening_socket: socket.socket | None = None):
+        if listening_socket is None:
+            listening_socket = create_listening_socket(
+                host, port, False, backlog)
+        self.__server_socket = listening_socket
+        # accept wakes up periodically, so a drain request is noticed even when no client arrives
+        self.__server_socket.settimeout(ACCEPT_POLL_INTERVAL)
+        self.__draining = False
         self.client_timeout = client_timeout
+        self.max_header_size = max_header_size
+        self.max_header_count = max_header_count
+        self.max_body_size = max_body_size
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.min_body_rate = min_body_rate
+
+    def drain(self):
+        """
+        Asks the server to stop: no more clients are accepted, and the current connection is closed after its current request.
+        """
+        self.__draining = True
+
+    def is_draining(self) -> bool:
+        return self.__draining
+
+    def get_port(self) -> int:
+        """
+        Returns the port the server listens on (useful when binding to port 0, which picks a free port).
+        """
+        return self.__server_socket.getsockname()[1]
 
     def accept_client(self) -> ClientConnection:
         """
         Accepts a client and returns ClientConnection object to allow interaction with it.
+        Raises socket.timeout if no client arrived within ACCEPT_POLL_INTERVAL seconds.
         """
-        client_socket, _ = self.__server_socket.accept()
+        client_socket, client_address = self.__server_socket.accept()
         client_socket.settimeout(self.client_timeout)
-        return ClientConnection(client_socket)
+        # responses are complete when they are written, so Nagle's algorithm would only delay
+        # the last segment of each one until the client acknowledges the previous ones.
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return ClientConnection(client_socket, self.client_timeout, self.max_header_size, self.max_header_count,
+                                self.max_body_size, self.header_timeout, self.body_timeout, self.min_body_rate,
+                                client_address[0])
 
 
 def get_file_content(file_path: str) -> bytes:
     """
     This method reads the file in file_path and returns its contents as byte string
     """
+    trace = get_request_trace()
+    start = time.perf_counter() if trace is not None else 0.0
     file = open(file_path, "rb")
     content = file.read()
     file.close()
+    if trace is not None:
+        trace.add_stage("read_file", start)
     return content
 
 
-def write_to_file(file_path: str, content: bytes):
+class CachedFile:
     """
-    This method writes a byte-string content to the file in file_path
+    This class represents what the file cache knows about a single path.
+    It has:
+    is_file - True if the path is a file (and not a directory)
+    is_directory - True if the path is a directory
+    content - the file contents as byte string, or None if the path isn't a file or the file is too big to keep in memory
+    content_type - the content type to send the file with
+    inode, mtime, size - the inode, modification time (in nanoseconds) and size of the file, to notice when it changes
+    etag, last_modified - the values of the ETag and Last-Modified headers of the file
+    validator_headers - the ETag and Last-Modified header lines, ready to be sent
+    serialized_headers - the Content-Type, Content-Length, Accept-Ranges, ETag and Last-Modified header lines, ready to be sent
+    validated_at - the time (time.monotonic) the entry was last checked to match the file
+    compressed_contents - the contents compressed by each content encoding so far
+    (None for an encoding that doesn't make the file smaller)
     """
-    file = open(file_path, "wb")
-    file.write(content)
-    file.close()
 
+    def __init__(self, is_file, is_directory, content, content_type, inode, mtime, size, validated_at):
+        self.is_file = is_file
+        self.is_directory = is_directory
+        self.content = content
+        self.content_type = content_type
+        self.inode = inode
+        self.mtime = mtime
+        self.size = size
+        self.validated_at = validated_at
+        self.compressed_contents = {}
+        self.etag = None
+        self.last_modified = None
+        self.validator_headers = b""
+        self.serialized_headers = b""
+        if is_file:
+            # the etag changes whenever the file is replaced (new inode) or modified
+            self.etag = f'"{inode:x}-{mtime:x}-{size:x}"'
+            self.last_modified = email.utils.formatdate(
+                mtime // 10 ** 9, usegmt=True)
+            self.validator_headers = f"ETag: {self.etag}\r\nLast-Modified: {self.last_modified}\r\n".encode()
+        if content is not None:
+            self.serialized_headers = (f"Content-Type: {content_type}\r\nContent-Length: {len(content)}\r\n"
+                                       "Accept-Ranges: bytes\r\n").encode() + self.validator_headers
 
-def parse_header_value_parameters(header_value_str: str) -> tuple[str, dict[str, str]]:
-    """
-    This method parses parameters given in header values.
-    It gets a string of the unparsed header value, and seperates it to the main value and a dictionary of parameters.
-    Each entry has the parameter name (string) as key and parameter value (string) as value.
-    Returns a pair of the main value (string) and parameters (dictionary)
-    """
-    value_parts = header_value_str.split(';')
-    # the first value is the main value, before any semicolon
-    main_value = trim_linear_whitespaces(value_parts[0])
-    parameters = {}
-    for parameter_str in value_parts[1:]:
-        # trim spaces in the beginning and the end of the value
-        parameter_str = trim_linear_whitespaces(parameter_str)
-        # find the seperator between the name and value
-        name_value_splitter = parameter_str.find('=')
-        if name_value_splitter == -1:  # in case it doesn't exist, raise BadRequest
-            raise BadRequest("Invalid header parameter syntax")
-        name = parameter_str[:name_value_splitter]  # before the equal sign
-        value = parameter_str[name_value_splitter + 1:]  # after the equal sign
-        if value[0] == "\"":  # if value is a quoted-string, remove the quotes and unescape
-            value = value.removeprefix("\"").removesuffix(
-                "\"")  # remove start and end quotes
-            # Handle escaping. the rule is to replace \<char> with <char>.
-            value_after_escaping = ""
-            i = 0
-            while i < len(value):  # iterate over the string
-                if value[i] == '\\':  # if metting a backslash add only the next character and skip it
-                    # there can't be a backslash at the end of the string because it escapes nothing.
-                    if i == (len(value) - 1):
-                        raise BadRequest(
-                            "Invalid backslash at the end of string")
-                    value_after_escaping += value[i + 1]
-                    i += 2
-                else:  # otherwise add the current one normally
-                    value_after_escaping += value[i]
-                    i += 1
-            value = value_after_escaping
-        parameters[name] = value
-    return main_value, parameters
+    def get_cost(self) -> int:
+        """
+        Returns how many bytes of the cache's budget the entry takes.
+        Entries without contents (of files too big to keep in memory) are charged a fixed amount, so they're bounded too.
+        """
+        cost = FILE_CACHE_ENTRY_OVERHEAD
+        if self.content is not None:
+            cost += len(self.content)
+        for compressed_content in self.compressed_contents.values():
+            if compressed_content is not None:
+                cost += len(compressed_content)
+        return cost
 
 
-def parse_form_data(request_body: bytes, request_headers: dict[str, str]) -> tuple[dict[str, str], bytes]:
+class FileCache:
     """
-    This method parses a single form data instance from a request headers and body.
-    It retrieves the headers and the actual body.
-    It returns the headers as a dictionary.
-    Each entry has the header name (string) as key and header value (string) as value.
-    The body is returned as a byte string.
-    It returns a pair of (headers, body).
+    This class is an in-memory LRU cache of files, keyed by their normalized path.
+    It keeps up to max_bytes bytes of file contents (of files up to max_file_size, bigger ones are only described),
+    and also remembers paths that don't exist or are directories, so repeated 404s don't touch the disk.
+    Those are kept in a separate LRU of up to max_missing_entries entries, so requests for many missing paths
+    (like a scan) only evict each other and never the files.
+    An entry is trusted for revalidate_interval seconds, then its mtime and size are checked with a single stat,
+    and the file is read again only if they changed.
+    The compressed versions of the contents are kept with them, so every version of a file is compressed only once.
+    It's safe to use from several threads.
     """
-    if request_body is None:  # verify that there is a request body.
-        raise BadRequest("Missing request body")
-    # extract the boundary from the content-type header as parameter
-    content_type_header = try_retrieve_from_dictionary(
-        request_headers, "Content-Type", "Missing Content-Type header")
-    _, content_type_params = parse_header_value_parameters(content_type_header)
-    boundary = try_retrieve_from_dictionary(
-        content_type_params, "boundary", "Missing boundary in Content-Type header")
-    # remove first and last boundary
-    prefix = f"--{boundary}\r\n"
-    suffix = f"\r\n--{boundary}--\r\n"
-    request_body = request_body.removeprefix(
-        prefix.encode()).removesuffix(suffix.encode())
-    # seperate headers and body
-    # the seperator is an empty line, which means \r\n\r\n
-    headers_body_seperator_pos = request_body.find(b"\r\n\r\n")
-    if headers_body_seperator_pos == -1:
-        raise BadRequest("Invalid body structure")
-    # before the seperator
-    headers_str = request_body[:headers_body_seperator_pos]
-    # after the seperator (of length 4)
-    content = request_body[headers_body_seperator_pos + 4:]
-    # parse headers
-    headers_splitted = headers_str.split(b"\r\n")
-    headers = {}
-    for header_str in headers_splitted:
-        header, value = parse_header(header_str.decode())
-        headers[header] = value
-    return headers, content
 
+    def __init__(self, max_bytes: int, max_file_size: int, revalidate_interval: float, max_missing_entries: int):
+        self.__max_bytes = max_bytes
+        self.__max_file_size = max_file_size
+        self.__revalidate_interval = revalidate_interval
+        self.__max_missing_entries = max_missing_entries
+        self.__entries = collections.OrderedDict()  # least recently used first
+        self.__missing_entries = collections.OrderedDict()  # the paths that aren't files, least recently used first
+        self.__total_bytes = 0
+        self.__lock = threading.Lock()
+        self.__statistics = {"hits": 0, "misses": 0,
+                             "revalidations": 0, "evictions": 0, "compressions": 0}
 
-ROOT_DIRECTORY = "webroot"
-UPLOADS_PATH = "/uploaded_imgs"
+    def get(self, file_path: str) -> CachedFile:
+        """
+        Returns the CachedFile of the given path, from memory if it's still valid and from the disk otherwise.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entries = self.__entries if file_path in self.__entries else self.__missing_entries
+            entry = entries.get(file_path)
+            if entry is not None and now - entry.validated_at < self.__revalidate_interval:
+                entries.move_to_end(file_path)
+                self.__statistics["hits"] += 1
+                return entry
+        # the entry is missing or too old, check the file on the disk (without holding the lock)
+        file_stat = get_file_stat(file_path)
+        if entry is not None and is_same_file_version(entry, file_stat):
+            with self.__lock:
+                entry.validated_at = now
+                self.__statistics["revalidations"] += 1
+            return entry
+        entry = load_cached_file(
+            file_path, file_stat, self.__max_file_size, now)
+        with self.__lock:
+            self.__statistics["misses"] += 1
+            self.__store(file_path, entry)
+        return entry
 
+    def get_compressed_content(self, file_path: str, entry: CachedFile, encoding: str) -> bytes | None:
+        """
+        Returns the contents of a cache entry (which must have its contents) compressed by the given content encoding.
+        The contents are compressed on the first request and kept in the entry for the next ones.
+        Returns None if compressing doesn't make the contents smaller.
+        """
+        with self.__lock:
+            if encoding in entry.compressed_contents:
+                return entry.compressed_contents[encoding]
+        # compress without holding the lock, two threads compressing the same file at once just do it twice
+        compressed_content = compress_content(entry.content, encoding)
+        if len(compressed_content) >= len(entry.content):
+            compressed_content = None
+        with self.__lock:
+            if encoding in entry.compressed_contents:
+                return entry.compressed_contents[encoding]
+            self.__statistics["compressions"] += 1
+            is_stored = self.__entries.get(file_path) is entry
+            if is_stored:  # the entry takes more of the budget now
+                self.__total_bytes -= entry.get_cost()
+            entry.compressed_contents[encoding] = compressed_content
+            if is_stored:
+                self.__total_bytes += entry.get_cost()
+                self.__evict()
+        return compressed_content
 
-def calculate_next(request: HttpRequest) -> HttpResponse:
+    def store_pending(self, file_path: str, content: bytes) -> CachedFile:
+        """
+        Stores the contents of a file that is about to be written (by the UPLOAD_WRITER), so it's served from memory
+        before it's on the disk. The entry isn't checked against the disk until finish_pending replaces it.
+        Returns the entry, for finish_pending.
+        """
+        entry = CachedFile(True, False, content, get_content_type(file_path), 0, time.time_ns(), len(content),
+                           math.inf)
+        with self.__lock:
+            self.__store(file_path, entry)
+        return entry
+
+    def finish_pending(self, file_path: str, pending_entry: CachedFile, file_stat: os.stat_result | None):
+        """
+        Replaces an entry of store_pending once its file was written (with the file's stat),
+        or removes it if writing the file failed (file_stat is None).
+        Does nothing if the entry was replaced since (by a newer version of the file) or evicted.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            if self.__entries.get(file_path) is not pending_entry:
+                return
+            if file_stat is None:
+                self.__total_bytes -= self.__entries.pop(file_path).get_cost()
+                return
+            # the contents are already in memory, but big files are sent from the disk like any other big file
+            content = pending_entry.content if pending_entry.size <= self.__max_file_size else None
+            self.__store(file_path, CachedFile(True, False, content, pending_entry.content_type, file_stat.st_ino,
+                                               file_stat.st_mtime_ns, file_stat.st_size, now))
+
+    def invalidate(self, file_path: str):
+        """
+        Removes the entry of the given path (if there is one), so the next get reads it from the disk.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(file_path, None)
+            if entry is not None:
+                self.__total_bytes -= entry.get_cost()
+            self.__missing_entries.pop(file_path, None)
+
+    def get_statistics(self) -> dict[str, int]:
+        """
+        Returns the counters of the cache (hits, misses, revalidations, evictions, compressions), and its current size.
+        """
+        with self.__lock:
+            statistics = dict(self.__statistics)
+            statistics["entries"] = len(self.__entries)
+            statistics["missing_entries"] = len(self.__missing_entries)
+            statistics["bytes"] = self.__total_bytes
+        return statistics
+
+    def __store(self, file_path: str, entry: CachedFile):
+        """
+        Stores the entry in the cache, evicting the least recently used entries to stay within the budget.
+        An entry of a path that isn't a file goes to the LRU of missing entries, which is limited by its count.
+        Must be called with the lock held.
+        """
+        old_entry = self.__entries.pop(file_path, None)
+        if old_entry is not None:
+            self.__total_bytes -= old_entry.get_cost()
+        self.__missing_entries.pop(file_path, None)
+        if not entry.is_file:
+            self.__missing_entries[file_path] = entry
+            if len(self.__missing_entries) > self.__max_missing_entries:
+                self.__missing_entries.popitem(last=False)
+                self.__statistics["evictions"] += 1
+            return
+        if entry.get_cost() > self.__max_bytes:
+            return
+        self.__entries[file_path] = entry
+        self.__total_bytes += entry.get_cost()
+        self.__evict()
+
+    def __evict(self):
+        """
+        Evicts the least recently used entries until the cache is within its budget.
+        Must be called with the lock held.
+        """
+        while self.__total_bytes > self.__max_bytes:
+            _, evicted_entry = self.__entries.popitem(last=False)
+            self.__total_bytes -= evicted_entry.get_cost()
+            self.__statistics["evictions"] += 1
+
+
+def compress_content(content: bytes, encoding: str) -> bytes:
     """
-    Used for the /calculate-next endpoint.
-    Gets a HttpRequest, gets an integer num as a query parameter.
-    Returns num + 1 (as a HttpResponse)
+    Compresses content by the given content encoding ("gzip" or "br"), with the best compression,
+    since every version of a file is compressed once.
     """
-    parameters = request.get_query_parameters()
-    num_str = try_retrieve_from_dictionary(
-        parameters, "num", "Missing num")  # get num from the query parameters
-    num = try_parse_int(num_str, "num isn't integer")  # convert it to int
-    response_body = str(num + 1).encode()
-    response_headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
-    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
+    trace = get_request_trace()
+    start = time.perf_counter() if trace is not None else 0.0
+    if encoding == "br":
+        compressed_content = brotli.compress(content, quality=11)
+    else:
+        # mtime=0 keeps the output the same for the same content
+        compressed_content = gzip.compress(content, compresslevel=9, mtime=0)
+    if trace is not None:
+        trace.add_stage("compress", start)
+    return compressed_content
 
 
-def calculate_area(request: HttpRequest) -> HttpResponse:
+def get_file_stat(file_path: str) -> os.stat_result | None:
     """
-    Used for the /calculate-area endpoint.
-    Gets a HttpRequest, gets integers height and width as query parameters.
-    Returns the area of a triangle with the given height and width (in a HttpRespones).
-    That is, height * width / 2
+    Returns the stat of the given path, or None if it doesn't exist.
+    """
+    try:
+        return os.stat(file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def is_same_file_version(entry: CachedFile, file_stat: os.stat_result | None) -> bool:
+    """
+    Checks if a cache entry still matches the path's current stat.
+    """
+    if file_stat is None:
+        return not entry.is_file and not entry.is_directory
+    if stat.S_ISDIR(file_stat.st_mode):
+        return entry.is_directory
+    return (entry.is_file and entry.inode == file_stat.st_ino and entry.mtime == file_stat.st_mtime_ns
+            and entry.size == file_stat.st_size)
+
+
+def load_cached_file(file_path: str, file_stat: os.stat_result | None, max_file_size: int, now: float) -> CachedFile:
+    """
+    Creates the cache entry of a path from the disk, given its current stat.
+    The contents are read only for regular files up to max_file_size bytes,
+    other files are described without their contents (and are sent with get_file_body).
+    """
+    if file_stat is None:  # the file doesn't exist
+        return CachedFile(False, False, None, None, 0, 0, 0, now)
+    if stat.S_ISDIR(file_stat.st_mode):
+        return CachedFile(False, True, None, None, 0, 0, 0, now)
+    content = None
+    if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size <= max_file_size:
+        try:
+            content = get_file_content(file_path)
+        except (FileNotFoundError, NotADirectoryError):  # deleted since the stat
+            return CachedFile(False, False, None, None, 0, 0, 0, now)
+    return CachedFile(True, False, content, get_content_type(file_path), file_stat.st_ino, file_stat.st_mtime_ns,
+                      file_stat.st_size, now)
+
+
+class WebrootIndex:
+    """
+    This class is an in-memory index of everything under the root directory, by request path (like "/index.html"),
+    so finding a static file takes a single dict lookup and no system calls.
+    Only normalized paths are in the index, so a path that is found can't be a directory traversal attempt.
+    The entries are CachedFile instances like the ones of the FileCache, with their headers serialized already,
+    and the contents of files up to max_file_size while they fit in max_bytes (other files are sent from the disk).
+    The index is built by walking the root directory, and kept current by walking it again every poll_interval seconds
+    in a background thread (see start_watching), which reads only the files whose inode, mtime or size changed.
+    Paths that aren't in the index should be looked up the usual way, since the file might be newer than the last walk.
+    """
+
+    def __init__(self, root_directory: str, max_bytes: int, max_file_size: int, poll_interval: float):
+        self.__root_directory = os.path.normpath(root_directory)
+        self.__max_bytes = max_bytes
+        self.__max_file_size = max_file_size
+        self.__poll_interval = poll_interval
+        self.__entries = {}  # request path to (file path, CachedFile). replaced as a whole by every walk
+        self.__lock = threading.Lock()
+        self.__invalidated_paths = set()  # request paths invalidated during the current walk
+        self.__stop_watching = threading.Event()
+        self.__watcher = None
+
+    def get(self, request_path: str) -> tuple[str, CachedFile] | None:
+        """
+        Returns the file path and the CachedFile of the given request path, or None if it isn't in the index.
+        """
+        return self.__entries.get(request_path)
+
+    def get_file(self, file_path: str) -> CachedFile | None:
+        """
+        Returns the CachedFile of a normalized file path (like "webroot/index.html"), or None if it isn't in the index.
+        """
+        if not file_path.startswith(self.__root_directory + os.sep):
+            return None
+        entry = self.__entries.get(self.__get_request_path(file_path))
+        return entry[1] if entry is not None else None
+
+    def invalidate(self, file_path: str):
+        """
+        Removes the entry of a normalized file path that the server is changing, so it's looked up the usual way until
+        the next walk finds the new version.
+        """
+        request_path = self.__get_request_path(file_path)
+        with self.__lock:
+            self.__invalidated_paths.add(request_path)
+            self.__entries.pop(request_path, None)
+
+    def refresh(self):
+        """
+        Walks the root directory and replaces the index with what's there now.
+        The entries of files that didn't change are kept as they are (with their compressed contents).
+        """
+        with self.__lock:
+            self.__invalidated_paths.clear()
+        old_entries = self.__entries
+        entries = {}
+        total_bytes = 0
+        now = time.monotonic()
+        for file_path, file_stat in self.__walk(self.__root_directory, set()):
+            request_path = self.__get_request_path(file_path)
+            old_entry = old_entries.get(request_path)
+            try:
+                if old_entry is not None and is_same_file_version(old_entry[1], file_stat):
+                    cached_file = old_entry[1]
+                else:
+                    # the contents are kept only while they fit in the budget
+                    max_file_size = self.__max_file_size if total_bytes < self.__max_bytes else -1
+                    cached_file = load_cached_file(file_path, file_stat, max_file_size, now)
+                if cached_file.content is not None and total_bytes + len(cached_file.content) > self.__max_bytes:
+                    cached_file = load_cached_file(file_path, file_stat, -1, now)
+            except OSError:  # like a file that can't be read. it's left out, and looked up the usual way
+                continue
+            if cached_file.content is not None:
+                total_bytes += len(cached_file.content)
+            if cached_file.is_file or cached_file.is_directory:
+                entries[request_path] = (file_path, cached_file)
+        with self.__lock:
+            # the files that changed during the walk might have been read before they changed
+            for request_path in self.__invalidated_paths:
+                entries.pop(request_path, None)
+            self.__entries = entries
+
+    def start_watching(self):
+        """
+        Starts the thread that walks the root directory every poll_interval seconds, until stop_watching is called.
+        It has to be started in every process that uses the index, since threads don't survive fork.
+        """
+        self.__stop_watching.clear()
+        self.__watcher = threading.Thread(target=self.__watch, daemon=True)
+        self.__watcher.start()
+
+    def stop_watching(self):
+        self.__stop_watching.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
+            self.__watcher = None
+
+    def __watch(self):
+        while not self.__stop_watching.wait(self.__poll_interval):
+            try:
+                self.refresh()
+            except Exception:  # the index stays as it was, the next walk tries again
+                traceback.print_exc()
+
+    def __get_request_path(self, file_path: str) -> str:
+        """
+        Returns the request path of a normalized file path under the root directory.
+        """
+        return file_path[len(self.__root_directory):].replace(os.sep, "/") or "/"
+
+    def __walk(self, directory_path: str, visited_directories: set[tuple[int, int]]):
+        """
+        Yields the path and stat of the given directory and of everything under it.
+        Symbolic links are followed like the server follows them, but every directory is walked once
+        (visited_directories has the (device, inode) of the ones walked already), so a link loop doesn't repeat it.
+        Paths that are deleted during the walk or can't be read (like a directory without permission) are skipped,
+        and so are the temporary files of uploads.
+        """
+        try:
+            directory_stat = get_file_stat(directory_path)
+        except OSError:
+            return
+        if directory_stat is None or (directory_stat.st_dev, directory_stat.st_ino) in visited_directories:
+            return
+        visited_directories.add((directory_stat.st_dev, directory_stat.st_ino))
+        yield directory_path, directory_stat
+        try:
+            with os.scandir(directory_path) as directory_entries:
+                paths = [directory_entry.path for directory_entry in directory_entries]
+        except OSError:
+            return
+        for path in paths:
+            if is_upload_temporary_file(path):
+                continue
+            try:
+                file_stat = get_file_stat(path)
+            except OSError:  # like a link loop or a broken permission
+                continue
+            if file_stat is None:
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                yield from self.__walk(path, visited_directories)
+            else:
+                yield path, file_stat
+
+
+class FileBody:
+    """
+    This class represents a response body that is sent straight from an open file, without reading it to memory.
+    It has the file, and the offset and length of the part to send. len() of it is the length.
+    The file is closed when the body is sent.
+    """
+
+    def __init__(self, file, offset: int, length: int):
+        self.__file = file
+        self.__offset = offset
+        self.__length = length
+
+    def __len__(self):
+        return self.__length
+
+    def get_file(self):
+        return self.__file
+
+    def get_offset(self):
+        return self.__offset
+
+    def read(self) -> bytes:
+        """
+        Reads the part of the file the body represents to memory (for when it can't be sent on its own), and closes the file.
+        """
+        with self.__file:
+            self.__file.seek(self.__offset)
+            return self.__file.read(self.__length)
+
+    def close(self):
+        self.__file.close()
+
+
+class ByteRangesBody:
+    """
+    This class represents a multipart/byteranges response body of several ranges of an open file.
+    It's streamed: it's an iterator of the byte strings of the body, and every range is read from the file a chunk
+    (of BYTE_RANGES_CHUNK_SIZE) at a time while it's sent, so the ranges are never in memory at once.
+    It has the file, the parts as (part head, offset, length) tuples, and the closing boundary that ends the body.
+    The file is closed when the body ends or is closed, even if it was never started.
+    """
+
+    def __init__(self, file, parts: list[tuple[bytes, int, int]], closing_boundary: bytes):
+        self.__file = file
+        self.__chunks = self.__generate_chunks(parts, closing_boundary)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self.__chunks)
+
+    def __generate_chunks(self, parts: list[tuple[bytes, int, int]], closing_boundary: bytes):
+        with self.__file:
+            for part_head, offset, length in parts:
+                yield part_head
+                end_offset = offset + length
+                while offset < end_offset:
+                    chunk = os.pread(self.__file.fileno(), min(BYTE_RANGES_CHUNK_SIZE, end_offset - offset), offset)
+                    if chunk == b"":  # the file got shorter, the client can't know where the part ends
+                        raise ConnectionError("File shrank while sending it")
+                    offset += len(chunk)
+                    yield chunk
+            yield closing_boundary
+
+    def close(self):
+        self.__chunks.close()
+        self.__file.close()
+
+
+def get_file_body(file_path: str, offset: int = 0, length: int = -1) -> bytes | FileBody | None:
+    """
+    Opens a file to send as a response body: length bytes from offset (to the end of the file if length is negative).
+    Returns None if the file doesn't exist.
+    A regular file is returned as a FileBody, so it's sent with sendfile and its length is taken from fstat.
+    Other files (like pipes or devices) have no meaningful size, so they are read to memory and returned as a byte string.
+    """
+    try:
+        file = open(file_path, "rb")
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+    file_stat = os.fstat(file.fileno())
+    if stat.S_ISREG(file_stat.st_mode):
+        available_length = max(0, file_stat.st_size - offset)
+        if length < 0 or length > available_length:
+            length = available_length
+        return FileBody(file, offset, length)
+    with file:
+        content = file.read()
+    return content[offset:] if length < 0 else content[offset:offset + length]
+
+
+def parse_header_value_parameters(header_value_str: str) -> tuple[str, dict[str, str]]:
+    """
+    This method parses parameters given in header values.
+    It gets a string of the unparsed header value, and seperates it to the main value and a dictionary of parameters.
+    Each entry has the parameter name (string) as key and parameter value (string) as value.
+    Returns a pair of the main value (string) and parameters (dictionary)
+    """
+    value_parts = header_value_str.split(';')
+    # the first value is the main value, before any semicolon
+    main_value = trim_linear_whitespaces(value_parts[0])
+    parameters = {}
+    for parameter_str in value_parts[1:]:
+        # trim spaces in the beginning and the end of the value
+        parameter_str = trim_linear_whitespaces(parameter_str)
+        # find the seperator between the name and value
+        name_value_splitter = parameter_str.find('=')
+        if name_value_splitter == -1:  # in case it doesn't exist, raise BadRequest
+            raise BadRequest("Invalid header parameter syntax")
+        name = parameter_str[:name_value_splitter]  # before the equal sign
+        value = parameter_str[name_value_splitter + 1:]  # after the equal sign
+        if value.startswith("\""):  # if value is a quoted-string, remove the quotes and unescape
+            value = value.removeprefix("\"").removesuffix(
+                "\"")  # remove start and end quotes
+            # Handle escaping. the rule is to replace \<char> with <char>.
+            value_after_escaping = ""
+            i = 0
+            while i < len(value):  # iterate over the string
+                if value[i] == '\\':  # if metting a backslash add only the next character and skip it
+                    # there can't be a backslash at the end of the string because it escapes nothing.
+                    if i == (len(value) - 1):
+                        raise BadRequest(
+                            "Invalid backslash at the end of string")
+                    value_after_escaping += value[i + 1]
+                    i += 2
+                else:  # otherwise add the current one normally
+                    value_after_escaping += value[i]
+                    i += 1
+            value = value_after_escaping
+        parameters[name] = value
+    return main_value, parameters
+
+
+def get_form_data_boundary(request_headers: RequestHeaders) -> str:
+    """
+    This method extracts the boundary of a form data body from the request headers (a parameter of Content-Type).
+    """
+    content_type_header = try_retrieve_from_dictionary(
+        request_headers, "Content-Type", "Missing Content-Type header")
+    _, content_type_params = parse_header_value_parameters(content_type_header)
+    return try_retrieve_from_dictionary(
+        content_type_params, "boundary", "Missing boundary in Content-Type header")
+
+
+class FormDataReader:
+    """
+    This class parses a form data (multipart) body while it is recieved, part after part.
+    It gets the RequestBody to read from and the boundary between the parts.
+    The content of each part is returned in chunks, so the body is never held in memory as a whole.
+    """
+
+    def __init__(self, body: RequestBody, boundary: str):
+        self.__body = body
+        # every boundary comes after a line break. the body starts with the first boundary, so a line break is
+        # added before it to find all of them the same way.
+        self.__delimiter = f"\r\n--{boundary}".encode()
+        self.__buffer = bytearray(b"\r\n")
+        # the preamble before the first boundary is skipped like the content of a part
+        self.__in_part = True
+        self.__finished = False
+
+    def __fill_buffer(self):
+        """
+        Reads the next chunk of the body into the buffer.
+        Raises BadRequest if the body ended before the closing boundary.
+        """
+        content = self.__body.read(RECIEVE_CHUNK_SIZE)
+        if content == b"":
+            raise BadRequest("Invalid body structure")
+        self.__buffer += content
+
+    def __skip_to_delimiter(self):
+        """
+        Drops everything up to the next boundary and the boundary itself.
+        """
+        while self.read_part_content(RECIEVE_CHUNK_SIZE) != b"":
+            pass
+
+    def next_part(self) -> RequestHeaders | None:
+        """
+        Moves to the next part of the body (skipping the rest of the current one).
+        Returns the headers of the part as RequestHeaders (used like a dictionary of header name to header value),
+        or None if there are no more parts.
+        """
+        if self.__finished:
+            return None
+        self.__skip_to_delimiter()
+        # the boundary is followed by -- after the last part, and by a line break otherwise
+        while len(self.__buffer) < 2:
+            self.__fill_buffer()
+        if self.__buffer.startswith(b"--"):
+            self.__finished = True
+            return None
+        if not self.__buffer.startswith(b"\r\n"):
+            raise BadRequest("Invalid body structure")
+        # the headers end with an empty line. the line break after the boundary is kept, so a part without
+        # headers (the boundary followed by an empty line) ends with \r\n\r\n as well.
+        headers_end = self.__buffer.find(b"\r\n\r\n")
+        while headers_end == -1:
+            if len(self.__buffer) > MAX_HEADER_SIZE:
+                raise BadRequest("Form data headers too large")
+            self.__fill_buffer()
+            headers_end = self.__buffer.find(b"\r\n\r\n")
+        headers_block = bytes(self.__buffer[2:headers_end])
+        del self.__buffer[:headers_end + 4]
+        self.__in_part = True
+        return RequestHeaders(headers_block)
+
+    def read_part_content(self, size: int) -> bytes:
+        """
+        Reads up to size bytes of the content of the current part.
+        Returns an empty byte string at the end of the part.
+        """
+        if not self.__in_part:
+            return b""
+        while True:
+            delimiter_pos = self.__buffer.find(self.__delimiter)
+            if delimiter_pos == 0:  # the part ended
+                del self.__buffer[:len(self.__delimiter)]
+                self.__in_part = False
+                return b""
+            if delimiter_pos != -1:
+                content_length = min(delimiter_pos, size)
+            else:
+                # the end of the buffer might be the beginning of a boundary, so it's kept until the next read
+                content_length = min(
+                    len(self.__buffer) - len(self.__delimiter) + 1, size)
+            if content_length > 0:
+                content = bytes(self.__buffer[:content_length])
+                del self.__buffer[:content_length]
+                return content
+            self.__fill_buffer()
+
+
+class Route:
+    """
+    This class represents an endpoint registered in the router.
+    It has:
+    handler - the function that generates the response for the endpoint, with the route's middleware around it
+    inline - True if the handler never blocks (no disk access), so the async server may call it on the event loop
+    path - the path the route was registered with (like /{file_path*}), or None for the route of unmatched paths
+    """
+
+    def __init__(self, handler, inline, path):
+        self.handler = handler
+        self.inline = inline
+        self.path = path
+
+
+class RouteNode:
+    """
+    A node in the trie of the router, which matches a single segment of the path (the part between two slashes).
+    It has:
+    static_children - a dictionary of the children that match a fixed segment, the key is the segment (string)
+    parameter_child - the child that matches any single segment (a {name} segment in the route), or None
+    wildcard_child - the child that matches all the rest of the path (a {name*} segment in the route), or None
+    parameter_name, wildcard_name - the names the matched parts of the path get in the path parameters
+    routes - a dictionary of the routes of the path that ends in this node, key is the method (string)
+    method_not_allowed_route - the route used for other methods of this path (405 with the Allow header)
+    """
+
+    def __init__(self):
+        self.static_children = {}
+        self.parameter_child = None
+        self.parameter_name = None
+        self.wildcard_child = None
+        self.wildcard_name = None
+        self.routes = {}
+        self.method_not_allowed_route = None
+
+
+def apply_middleware(middleware, handler):
+    """
+    Wraps a request handler with a middleware function.
+    A middleware gets the request and the next handler, and returns the response
+    (so it can change the request before calling the handler, change the response after it, or respond by itself).
+    Returns the wrapped handler.
+    """
+    def handle_with_middleware(request: HttpRequest) -> HttpResponse:
+        return middleware(request, handler)
+    return handle_with_middleware
+
+
+def get_method_not_allowed_handler(allowed_methods: list[str]):
+    """
+    Returns a handler that responds with 405 Method Not Allowed, with an Allow header of the given methods.
+    """
+    allow_header = ", ".join(allowed_methods)
+
+    def method_not_allowed(request: HttpRequest) -> HttpResponse:
+        return HttpResponse(METHOD_NOT_ALLOWED_STATUS_CODE, METHOD_NOT_ALLOWED_REASON_PHRASE, {"Allow": allow_header}, b"")
+    return method_not_allowed
+
+
+def not_found(request: HttpRequest) -> HttpResponse:
+    """
+    Used for requests whose path doesn't match any route.
+    """
+    return HttpResponse(NOT_FOUND_STATUS_CODE, NOT_FOUND_REASON_PHRASE, {}, b"")
+
+
+class Router:
+    """
+    This class finds the endpoint of each request by its path and method.
+    Routes are compiled into a trie with a node for each segment of the path, so finding a route takes a
+    single pass on the segments of the request path, no matter how many routes there are.
+    A segment of a route's path can be fixed text, {name} to match any single segment,
+    or {name*} (only as the last segment) to match all the rest of the path, including nothing.
+    The matched parts are given to the handler as the path parameters of the request.
+    Fixed segments are preferred over parameters, and parameters are preferred over wildcards.
+    A path that has a GET route answers HEAD too, with the GET handler (the server drops the body of the response,
+    see remove_response_body), unless a HEAD route is registered for it.
+    """
+
+    def __init__(self):
+        self.__root = RouteNode()
+        self.__not_found_route = Route(not_found, True, None)
+
+    def add_route(self, method: str, path: str, handler, middleware=(), inline: bool = False):
+        """
+        Registers a handler for requests with the given method and path.
+        middleware is a list of middleware functions (see apply_middleware), the first one is called first.
+        inline should be True only if the handler never blocks.
+        Raises ValueError if the path is invalid or the route is registered already.
+        """
+        segments = path.split("/")[1:]
+        node = self.__root
+        for index, segment in enumerate(segments):
+            if segment.startswith("{") and segment.endswith("*}"):
+                if index != len(segments) - 1:
+                    raise ValueError(f"Wildcard isn't the last segment of the route {path}")
+                if node.wildcard_child is None:
+                    node.wildcard_child = RouteNode()
+                    node.wildcard_name = segment[1:-2]
+                elif node.wildcard_name != segment[1:-2]:
+                    raise ValueError(f"Conflicting wildcard names in the route {path}")
+                node = node.wildcard_child
+            elif segment.startswith("{") and segment.endswith("}"):
+                if node.parameter_child is None:
+                    node.parameter_child = RouteNode()
+                    node.parameter_name = segment[1:-1]
+                elif node.parameter_name != segment[1:-1]:
+                    raise ValueError(f"Conflicting parameter names in the route {path}")
+                node = node.parameter_child
+            else:
+                node = node.static_children.setdefault(segment, RouteNode())
+        if method in node.routes:
+            raise ValueError(f"The route {method} {path} is registered already")
+        # the middleware is applied once here, the first middleware is the outermost
+        for hook in reversed(middleware):
+            handler = apply_middleware(hook, handler)
+        node.routes[method] = Route(handler, inline, path)
+        allowed_methods = set(node.routes)
+        if "GET" in allowed_methods:
+            allowed_methods.add("HEAD")
+        node.method_not_allowed_route = Route(
+            get_method_not_allowed_handler(sorted(allowed_methods)), True, path)
+
+    def route(self, method: str, path: str, middleware=(), inline: bool = False):
+        """
+        A decorator that registers the decorated function with add_route.
+        """
+        def register(handler):
+            self.add_route(method, path, handler, middleware, inline)
+            return handler
+        return register
+
+    def __find_node(self, node: RouteNode, segments: list[str], index: int, path_parameters: dict[str, str]):
+        """
+        Finds the node of the route that matches segments[index:] under the given node.
+        The path parameters of the match are added to path_parameters.
+        Returns the node, or None if nothing matches.
+        """
+        if index == len(segments):
+            if node.routes:
+                return node
+            if node.wildcard_child is not None:  # a wildcard matches the empty rest of the path too
+                path_parameters[node.wildcard_name] = ""
+                return node.wildcard_child
+            return None
+        segment = segments[index]
+        child = node.static_children.get(segment)
+        if child is not None:
+            found_node = self.__find_node(
+                child, segments, index + 1, path_parameters)
+            if found_node is not None:
+                return found_node
+        # fall back to a parameter when the fixed segment doesn't lead to a route
+        if node.parameter_child is not None and segment != "":
+            found_node = self.__find_node(
+                node.parameter_child, segments, index + 1, path_parameters)
+            if found_node is not None:
+                path_parameters[node.parameter_name] = segment
+                return found_node
+        if node.wildcard_child is not None:
+            path_parameters[node.wildcard_name] = "/".join(segments[index:])
+            return node.wildcard_child
+        return None
+
+    def resolve(self, request: HttpRequest) -> Route:
+        """
+        Finds the route of a request, and sets the path parameters of the request.
+        Returns a route that responds with 404 Not Found if no route matches the path,
+        or 405 Method Not Allowed if the path matches but not the method.
+        A HEAD request without a HEAD route gets the GET route of the path.
+        """
+        path_parameters = {}
+        node = self.__find_node(self.__root, request.get_request_path().split("/")[1:], 0, path_parameters)
+        if node is None:
+            return self.__not_found_route
+        route = node.routes.get(request.get_method())
+        if route is None and request.get_method() == "HEAD":
+            route = node.routes.get("GET")
+        if route is None:
+            return node.method_not_allowed_route
+        request.set_path_parameters(path_parameters)
+        return route
+
+
+# the routes of the server, endpoints register themselves with the ROUTER.route decorator
+ROUTER = Router()
+
+
+ROOT_DIRECTORY = "webroot"
+UPLOADS_PATH = "/uploaded_imgs"
+
+
+@ROUTER.route("GET", "/calculate-next", inline=True)
+def calculate_next(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /calculate-next endpoint.
+    Gets a HttpRequest, gets an integer num as a query parameter.
+    Returns num + 1 (as a HttpResponse)
+    """
+    parameters = request.get_query_parameters()
+    num_str = try_retrieve_from_dictionary(
+        parameters, "num", "Missing num")  # get num from the query parameters
+    num = try_parse_int(num_str, "num isn't integer")  # convert it to int
+    response_body = str(num + 1).encode()
+    response_headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
+
+
+@ROUTER.route("GET", "/calculate-area", inline=True)
+def calculate_area(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /calculate-area endpoint.
+    Gets a HttpRequest, gets integers height and width as query parameters.
+    Returns the area of a triangle with the given height and width (in a HttpRespones).
+    That is, height * width / 2
     """
     parameters = request.get_query_parameters()
     height_str = try_retrieve_from_dictionary(
@@ -410,6 +1906,99 @@ def calculate_area(request: HttpRequest) -> HttpResponse:
     return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
 
 
+def get_batch_items(request: HttpRequest, parameter_names: list[str]) -> list[list[str]]:
+    """
+    Gets the items of a batch request: rows of the values of the given parameters.
+    A GET request has them as repeated query parameters (the first value of every parameter is the first row, etc.).
+    A POST request has them in its body, in CSV format: a row per line, with the values seperated by commas
+    (a batch of a single parameter may also have several values in a line, seperated by commas).
+    Raises BadRequest if a row doesn't have a value for every parameter,
+    and PayloadTooLarge if there are more than BATCH_MAX_ITEMS rows.
+    """
+    if request.get_method() == "GET":
+        columns = [get_query_parameter_values(request.get_query_string(), name) for name in parameter_names]
+        if any(len(column) != len(columns[0]) for column in columns):
+            raise BadRequest("Every item needs " + " and ".join(parameter_names))
+        rows = [list(row) for row in zip(*columns)]
+    else:
+        body = request.get_body()
+        if body is None:  # verify that there is a request body.
+            raise BadRequest("Missing request body")
+        try:
+            lines = body.decode().splitlines()
+        except UnicodeDecodeError:
+            raise BadRequest("Invalid characters in request body")
+        if len(parameter_names) == 1:
+            rows = [[value] for line in lines for value in line.split(",") if value.strip() != ""]
+        else:
+            rows = [line.split(",") for line in lines if line.strip() != ""]
+            if any(len(row) != len(parameter_names) for row in rows):
+                raise BadRequest("Every item needs " + " and ".join(parameter_names))
+    if len(rows) > BATCH_MAX_ITEMS:
+        raise PayloadTooLarge()
+    return rows
+
+
+def fits_int64(numbers: list[int], bound: int) -> bool:
+    """
+    Checks if numpy can compute with the given numbers as int64 without overflowing:
+    it can if their absolute values are smaller than bound.
+    """
+    return numpy is not None and all(-bound < number < bound for number in numbers)
+
+
+def stream_lines(lines: list[str]):
+    """
+    Yields the given lines as the chunks of a streamed response body, BATCH_RESPONSE_CHUNK_LINES lines at a time.
+    """
+    for start in range(0, len(lines), BATCH_RESPONSE_CHUNK_LINES):
+        yield ("\n".join(lines[start:start + BATCH_RESPONSE_CHUNK_LINES]) + "\n").encode()
+
+
+@ROUTER.route("GET", "/calculate-next-batch", inline=True)
+@ROUTER.route("POST", "/calculate-next-batch")
+def calculate_next_batch(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /calculate-next-batch endpoint.
+    Gets a HttpRequest with many integers num (see get_batch_items).
+    Returns num + 1 of each of them, a line each, exactly like /calculate-next would (streamed as they're formatted).
+    """
+    nums = [try_parse_int(num_str, "num isn't integer")
+            for num_str, in get_batch_items(request, ["num"])]
+    if fits_int64(nums, 2 ** 62):
+        results = (numpy.array(nums, dtype=numpy.int64) + 1).tolist()
+    else:  # python ints don't overflow
+        results = [num + 1 for num in nums]
+    response_headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+    response_body = stream_lines([str(result) for result in results])
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
+
+
+@ROUTER.route("GET", "/calculate-area-batch", inline=True)
+@ROUTER.route("POST", "/calculate-area-batch")
+def calculate_area_batch(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /calculate-area-batch endpoint.
+    Gets a HttpRequest with many pairs of integers height and width (see get_batch_items).
+    Returns the area of the triangle of each pair, a line each, exactly like /calculate-area would
+    (streamed as they're formatted).
+    """
+    heights = []
+    widths = []
+    for height_str, width_str in get_batch_items(request, ["height", "width"]):
+        heights.append(try_parse_int(height_str, "height isn't integer"))
+        widths.append(try_parse_int(width_str, "width isn't integer"))
+    # the products fit in int64 if both factors are under 2 ** 31.
+    # converting a product to float64 rounds it like python's division does, and halving it is exact
+    if fits_int64(heights, 2 ** 31) and fits_int64(widths, 2 ** 31):
+        areas = ((numpy.array(heights, dtype=numpy.int64) * numpy.array(widths, dtype=numpy.int64)) / 2).tolist()
+    else:
+        areas = [(height * width) / 2 for height, width in zip(heights, widths)]
+    response_headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+    response_body = stream_lines([str(area) for area in areas])
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
+
+
 FILENAME_FORBIDDEN_CHARACTERS = "/\\?*:|\"<>"
 FORBIDDEN_LAST_FILENAME_CHARACTERS = ". "
 
@@ -429,53 +2018,264 @@ def is_valid_filename(name: str) -> bool:
     return True  # if the name passes all of those checks, it's valid
 
 
-def upload(request: HttpRequest) -> HttpResponse:
+def is_upload_temporary_file(file_path: str) -> bool:
     """
-    Used for the /upload endpoint (in POST method).
-    Gets a file in the request body (from a form, in form-data format).
-    It uploads the file to the server, in {WEBROOT}/{UPLOADS_PATH}
-    Returns HTTP Response with status code 201 Created to indicate success.
+    Checks if a path (or file name) is of a temporary file that write_file_atomically writes an upload to.
+    Such a file is incomplete, so it isn't served, and an upload can't be named like one.
     """
-    form_data_headers, form_data_content = parse_form_data(
-        request.get_body(), request.get_headers())  # parse the form data body
-    # retrieve file name from the Content-Disposition header (as a parameter)
-    content_disposition_header = try_retrieve_from_dictionary(
-        form_data_headers, "Content-Disposition", "Missing Content-Disposition header in request body")
-    _, content_disposition_params = parse_header_value_parameters(
-        content_disposition_header)
-    file_name = try_retrieve_from_dictionary(
-        content_disposition_params, "filename", "Missing filename in Content-Disposition header in request body")
-    # Validate that the file name is actualyl valid
-    if not is_valid_filename(file_name):
-        raise BadRequest("Invalid filename")
-    file_path = f"{ROOT_DIRECTORY}{UPLOADS_PATH}/{file_name}"
-    # write the file to the server.
-    write_to_file(file_path, form_data_content)
-    headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
-    return HttpResponse(CREATED_STATUS_CODE, CREATED_REASON_PHRASE, headers, b"Upload Sucessful")
+    file_name = os.path.basename(file_path)
+    return file_name.startswith(UPLOAD_TEMPORARY_PREFIX) and file_name.endswith(UPLOAD_TEMPORARY_SUFFIX)
 
 
-def get_content_type(file_name: str) -> str:
+def get_umask() -> int:
     """
-    This method returns the Content Type that should be used for a given file by it's name.
-    It checks it according to the extension and defaults to text/plain in case of no extension or extension that isn't specified.
-    Gets the file_name as string and returns the content type as string.
+    Returns the umask of the process. It can only be read by setting it (and setting it back),
+    so it should be read once at startup, before there are threads that create files.
     """
-    extension_seperator = file_name.rfind(".")  # the last dot in the name
-    if extension_seperator != -1:  # If there's an extension
-        extension = file_name[extension_seperator + 1:]  # after the last dot
-        # If the extension exists in the CONTENT_TYPE_BY_EXTENSION dictionary, return the matching entry.
-        if extension in CONTENT_TYPE_BY_EXTENSION:
-            return CONTENT_TYPE_BY_EXTENSION[extension]
-    # In case of no extension or extension not in dictionary, return PLAINTEXT_CONTENT_TYPE by default.
-    return PLAINTEXT_CONTENT_TYPE
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
 
 
-def get_image(request: HttpRequest) -> HttpResponse:
+def write_file_atomically(file_path: str, write_content):
     """
-    Used for the /image endpoint.
-    Gets a HttpRequest. Gets image-name as a query parameter.
-    Returns the uploaded file with this name (if exists).
+    Writes a file so no one ever sees it partially written: write_content(file) writes the contents
+    to a temporary file in the same directory, which replaces the file only when it's complete.
+    The file gets UPLOAD_FILE_MODE, since the temporary file is created readable only by the server's user.
+    The temporary file is removed if write_content raises.
+    The file (and the directory, for the rename) is synced to the disk according to UPLOAD_FSYNC_POLICY.
+    """
+    trace = get_request_trace()
+    start = time.perf_counter() if trace is not None else 0.0
+    temporary_file_descriptor, temporary_path = tempfile.mkstemp(
+        prefix=UPLOAD_TEMPORARY_PREFIX, suffix=UPLOAD_TEMPORARY_SUFFIX, dir=os.path.dirname(file_path))
+    try:
+        with open(temporary_file_descriptor, "wb") as temporary_file:
+            os.fchmod(temporary_file_descriptor, UPLOAD_FILE_MODE)
+            write_content(temporary_file)
+            if UPLOAD_FSYNC_POLICY != "none":
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    if UPLOAD_FSYNC_POLICY == "full":  # the rename is durable only when the directory is synced
+        directory_descriptor = os.open(os.path.dirname(file_path), os.O_RDONLY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+    if trace is not None:
+        trace.add_stage("write_file", start)
+
+
+class UploadWriter:
+    """
+    This class writes uploaded files to the disk in the background (write-behind), so handling an upload
+    only takes recieving it. Until a file is written, it's served from the file cache.
+    The files are written by worker_count threads. Every path is always written by the same thread, in the order
+    the uploads were submitted, so the last upload of a file is the one that stays.
+    Up to max_pending_bytes bytes may wait to be written, an upload has to reserve its size before it's recieved.
+    The threads are started on the first upload, so they belong to the worker process that uses them.
+    """
+
+    def __init__(self, worker_count: int, max_pending_bytes: int):
+        self.__worker_count = worker_count
+        self.__max_pending_bytes = max_pending_bytes
+        self.__pending_bytes = 0
+        self.__lock = threading.Lock()
+        self.__queues = None
+        self.__threads = []
+
+    def reserve(self, size: int) -> bool:
+        """
+        Reserves room for an upload of the given size.
+        Returns False if there's no room, then the client should retry later.
+        """
+        with self.__lock:
+            if self.__pending_bytes + size > self.__max_pending_bytes:
+                return False
+            self.__pending_bytes += size
+            return True
+
+    def release(self, size: int):
+        """
+        Releases the room reserved for an upload that was written, or wasn't submitted after all.
+        """
+        with self.__lock:
+            self.__pending_bytes -= size
+
+    def submit(self, file_path: str, content: bytes, reserved_size: int):
+        """
+        Queues a file to be written, and puts it in the file cache until then.
+        The reserved size is released once the file is written.
+        """
+        if WEBROOT_INDEX is not None:  # the index has the old version of the file
+            WEBROOT_INDEX.invalidate(file_path)
+        pending_entry = FILE_CACHE.store_pending(file_path, content)
+        with self.__lock:
+            if self.__queues is None:
+                self.__start()
+            jobs = self.__queues[hash(file_path) % self.__worker_count]
+        jobs.put((file_path, content, pending_entry, reserved_size))
+
+    def shutdown(self):
+        """
+        Waits until all the submitted files are written, and stops the threads.
+        """
+        with self.__lock:
+            queues, threads = self.__queues, self.__threads
+            self.__queues, self.__threads = None, []
+        for jobs in queues or []:
+            jobs.put(None)  # tells the thread to stop after the files before it
+        for thread in threads:
+            thread.join()
+
+    def __start(self):
+        """
+        Starts the writing threads. Must be called with the lock held.
+        """
+        self.__queues = [queue.Queue() for _ in range(self.__worker_count)]
+        for jobs in self.__queues:
+            thread = threading.Thread(
+                target=self.__write_files, args=(jobs,), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __write_files(self, jobs: queue.Queue):
+        """
+        Writes the files queued to one thread, until it's told to stop.
+        """
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            file_path, content, pending_entry, reserved_size = job
+            file_stat = None
+            try:
+                write_file_atomically(
+                    file_path, lambda temporary_file: temporary_file.write(content))
+                file_stat = get_file_stat(file_path)
+            except OSError:  # the client was told the upload succeeded already, so the error can only be logged
+                traceback.print_exc()
+            finally:
+                if WEBROOT_INDEX is not None:  # a walk during the write might have indexed the old version
+                    WEBROOT_INDEX.invalidate(file_path)
+                FILE_CACHE.finish_pending(file_path, pending_entry, file_stat)
+                self.release(reserved_size)
+
+
+@ROUTER.route("POST", "/upload")
+def upload(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /upload endpoint (in POST method).
+    Gets a file in the request body (from a form, in form-data format).
+    It uploads the file to the server, in {WEBROOT}/{UPLOADS_PATH}
+    Uploads up to UPLOAD_WRITE_BEHIND_MAX_SIZE bytes are recieved to memory and written by the UPLOAD_WRITER
+    in the background, bigger ones are written to the disk while they're recieved.
+    Raises ServiceUnavailable if the UPLOAD_WRITER has too many bytes waiting to be written.
+    Returns HTTP Response with status code 201 Created to indicate success.
+    """
+    body = request.get_body_stream()
+    if body is None:  # verify that there is a request body.
+        raise BadRequest("Missing request body")
+    # reserve room for the upload before recieving it (the body is a bit bigger than the file).
+    # the size of a chunked body isn't known in advance, so it's written while it's recieved
+    write_behind = body.get_length() is not None and body.get_length() <= UPLOAD_WRITE_BEHIND_MAX_SIZE
+    if write_behind and not UPLOAD_WRITER.reserve(body.get_length()):
+        raise ServiceUnavailable(UPLOAD_RETRY_AFTER)
+    try:
+        form_data = FormDataReader(body, get_form_data_boundary(
+            request.get_headers()))  # parse the form data body while it's recieved
+        form_data_headers = form_data.next_part()
+        if form_data_headers is None:
+            raise BadRequest("Invalid body structure")
+        # retrieve file name from the Content-Disposition header (as a parameter)
+        content_disposition_header = try_retrieve_from_dictionary(
+            form_data_headers, "Content-Disposition", "Missing Content-Disposition header in request body")
+        _, content_disposition_params = parse_header_value_parameters(
+            content_disposition_header)
+        file_name = try_retrieve_from_dictionary(
+            content_disposition_params, "filename", "Missing filename in Content-Disposition header in request body")
+        # Validate that the file name is actualyl valid
+        if not is_valid_filename(file_name) or is_upload_temporary_file(file_name):
+            raise BadRequest("Invalid filename")
+        file_path = os.path.normpath(
+            f"{ROOT_DIRECTORY}{UPLOADS_PATH}/{file_name}")
+
+        def write_part_content(file):
+            content = form_data.read_part_content(RECIEVE_CHUNK_SIZE)
+            while content != b"":
+                file.write(content)
+                content = form_data.read_part_content(RECIEVE_CHUNK_SIZE)
+            # make sure the body is valid until its end before saving the file
+            while form_data.next_part() is not None:
+                pass
+        if write_behind:
+            file_content = io.BytesIO()
+            write_part_content(file_content)
+            UPLOAD_WRITER.submit(
+                file_path, file_content.getvalue(), body.get_length())
+        else:
+            write_file_atomically(file_path, write_part_content)
+            # the cache may remember that the file didn't exist, or an older version of it
+            invalidate_static_file(file_path)
+    except BaseException:
+        if write_behind:  # the upload wasn't submitted
+            UPLOAD_WRITER.release(body.get_length())
+        raise
+    headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+    return HttpResponse(CREATED_STATUS_CODE, CREATED_REASON_PHRASE, headers, b"Upload Sucessful")
+
+
+def get_content_type(file_name: str) -> str:
+    """
+    This method returns the Content Type that should be used for a given file by it's name.
+    It checks it according to the extension and defaults to text/plain in case of no extension or extension that isn't specified.
+    Gets the file_name as string and returns the content type as string.
+    """
+    extension_seperator = file_name.rfind(".")  # the last dot in the name
+    if extension_seperator != -1:  # If there's an extension
+        extension = file_name[extension_seperator + 1:]  # after the last dot
+        # If the extension exists in the CONTENT_TYPE_BY_EXTENSION dictionary, return the matching entry.
+        if extension in CONTENT_TYPE_BY_EXTENSION:
+            return CONTENT_TYPE_BY_EXTENSION[extension]
+    # In case of no extension or extension not in dictionary, return PLAINTEXT_CONTENT_TYPE by default.
+    return PLAINTEXT_CONTENT_TYPE
+
+
+def get_static_file(file_path: str) -> CachedFile:
+    """
+    Returns the CachedFile of a normalized path under the root directory,
+    from the WEBROOT_INDEX if it's enabled and has the path, and from the FILE_CACHE otherwise.
+    The temporary files of uploads are never found.
+    """
+    if is_upload_temporary_file(file_path):
+        return load_cached_file(file_path, None, 0, time.monotonic())
+    if WEBROOT_INDEX is not None:
+        cached_file = WEBROOT_INDEX.get_file(file_path)
+        if cached_file is not None:
+            return cached_file
+    return FILE_CACHE.get(file_path)
+
+
+def invalidate_static_file(file_path: str):
+    """
+    Makes the next lookups of a normalized path under the root directory read it from the disk,
+    after the server changed the file.
+    """
+    if WEBROOT_INDEX is not None:
+        WEBROOT_INDEX.invalidate(file_path)
+    FILE_CACHE.invalidate(file_path)
+
+
+@ROUTER.route("GET", "/image")
+def get_image(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the /image endpoint.
+    Gets a HttpRequest. Gets image-name as a query parameter.
+    Returns the uploaded file with this name (if exists).
     Returns 404 if it doesn't exist.
     Generates a HttpResponse and returns it.
     """
@@ -484,97 +2284,1998 @@ def get_image(request: HttpRequest) -> HttpResponse:
     # validate that the image name is an actually valid file name
     if not is_valid_filename(image_name):
         raise BadRequest("Invalid image name")
-    image_path = f"{ROOT_DIRECTORY}{UPLOADS_PATH}/{image_name}"
+    image_path = os.path.normpath(
+        f"{ROOT_DIRECTORY}{UPLOADS_PATH}/{image_name}")
+    cached_image = get_static_file(image_path)
     # if a file with this name exists, return it in the response.
-    if os.path.exists(image_path):
-        image_content = get_file_content(image_path)
-        # use the content type according to the image type.
-        headers = {"Content-Type": get_content_type(image_name)}
-        return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, image_content)
-    else:  # if it doesn't exist, return 404.
-        headers = {}
-        return HttpResponse(NOT_FOUND_STATUS_CODE, NOT_FOUND_REASON_PHRASE, headers, b"")
+    if cached_image.is_file:
+        response = get_cached_file_response(
+            request, image_path, cached_image)
+        if response is not None:
+            return response
+    # if it doesn't exist, return 404.
+    headers = {}
+    return HttpResponse(NOT_FOUND_STATUS_CODE, NOT_FOUND_REASON_PHRASE, headers, b"")
+
+
+def get_cache_control(request_path: str) -> str:
+    """
+    Returns the Cache-Control header value for a requested path, by the first rule in CACHE_CONTROL_RULES
+    whose prefix the path starts with (or DEFAULT_CACHE_CONTROL if none matches).
+    """
+    for path_prefix, cache_control in CACHE_CONTROL_RULES:
+        if request_path.startswith(path_prefix):
+            return cache_control
+    return DEFAULT_CACHE_CONTROL
+
+
+def is_not_modified(request: HttpRequest, etag: str, mtime: int) -> bool:
+    """
+    Checks the conditional headers of a request against the current version of a file, given by its etag and mtime.
+    Returns True if the client's copy is up to date, so 304 Not Modified should be returned.
+    As mentioned in rfc 7232 6, If-Modified-Since is only evaluated when there's no If-None-Match.
+    """
+    headers = request.get_headers()
+    if "If-None-Match" in headers:
+        # weak comparison: the W/ prefix doesn't matter
+        etags = [trim_linear_whitespaces(etag).removeprefix("W/")
+                 for etag in headers["If-None-Match"].split(",")]
+        return "*" in etags or etag in etags
+    if "If-Modified-Since" in headers:
+        since = email.utils.parsedate_tz(headers["If-Modified-Since"])
+        if since is None:  # an invalid date is ignored
+            return False
+        return mtime // 10 ** 9 <= email.utils.mktime_tz(since)
+    return False
+
+
+# the most ranges a single request can ask for, more are answered with the whole file
+MAX_RANGE_COUNT = 16
+# how much of a file a multipart/byteranges body (ByteRangesBody) reads at a time
+BYTE_RANGES_CHUNK_SIZE = 65536
+
+
+def parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses the value of a Range header (rfc 7233 2.1), for a file of the given size.
+    Returns a list of (first byte, length) pairs of the satisfiable ranges (an empty list if none is satisfiable).
+    Returns None if the header should be ignored: it's invalid, asks for units other than bytes,
+    has too many ranges, or its ranges together are more than the whole file (overlapping ranges).
+    """
+    unit, _, range_set = range_header.partition("=")
+    if trim_linear_whitespaces(unit) != "bytes":
+        return None
+    range_specs = range_set.split(",")
+    if len(range_specs) > MAX_RANGE_COUNT:
+        return None
+    ranges = []
+    for range_spec in range_specs:
+        first, dash, last = trim_linear_whitespaces(range_spec).partition("-")
+        if dash == "" or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":  # a suffix range: the last bytes of the file
+            if last == "":
+                return None
+            length = min(int(last), file_size)
+            if length > 0:
+                ranges.append((file_size - length, length))
+            continue
+        first = int(first)
+        if last == "":  # from the first byte to the end of the file
+            last = file_size - 1
+        else:
+            last = int(last)
+            if last < first:
+                return None
+            last = min(last, file_size - 1)
+        if first < file_size:  # ranges that start after the end of the file can't be satisfied
+            ranges.append((first, last - first + 1))
+    if sum(length for _, length in ranges) > file_size:
+        return None
+    return ranges
+
+
+def is_range_allowed(request: HttpRequest, cached_file: CachedFile) -> bool:
+    """
+    Checks the If-Range header of a request (rfc 7233 3.2): a range is only sent if the client's copy of the file
+    matches the current version, by its etag or its Last-Modified date. Without If-Range, ranges are always allowed.
+    """
+    if_range = request.get_headers().get("If-Range")
+    if if_range is None:
+        return True
+    if_range = trim_linear_whitespaces(if_range)
+    if if_range.startswith("W/"):  # weak etags can't be used for ranges
+        return False
+    if if_range.startswith('"'):
+        return if_range == cached_file.etag
+    return if_range == cached_file.last_modified
+
+
+def get_partial_file_response(file_path: str, cached_file: CachedFile, ranges: list[tuple[int, int]],
+                              headers: dict[str, str]) -> HttpResponse | None:
+    """
+    Generates the 206 Partial Content response with the given ranges of a file, given as (first byte, length) pairs.
+    A single range is sent as is (with sendfile if the file isn't in memory), and several ranges are sent as
+    a multipart/byteranges body, which is streamed from the file (opened once) if it isn't in memory.
+    Only the requested parts are read from the disk.
+    Returns None if the file was deleted since it was cached.
+    """
+    headers["Accept-Ranges"] = "bytes"
+    headers["ETag"] = cached_file.etag
+    headers["Last-Modified"] = cached_file.last_modified
+    if len(ranges) == 1:
+        first, length = ranges[0]
+        if cached_file.content is not None:
+            body = memoryview(cached_file.content)[first:first + length]
+        else:
+            body = get_file_body(file_path, first, length)
+            if body is None:
+                return None
+        headers["Content-Type"] = cached_file.content_type
+        headers["Content-Range"] = f"bytes {first}-{first + length - 1}/{cached_file.size}"
+        return HttpResponse(PARTIAL_CONTENT_STATUS_CODE, PARTIAL_CONTENT_REASON_PHRASE, headers, body)
+    boundary = os.urandom(16).hex()
+    parts = [((f"\r\n--{boundary}\r\nContent-Type: {cached_file.content_type}\r\n"
+               f"Content-Range: bytes {first}-{first + length - 1}/{cached_file.size}\r\n\r\n").encode(), first, length)
+             for first, length in ranges]
+    closing_boundary = f"\r\n--{boundary}--\r\n".encode()
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    content = cached_file.content
+    if content is None:
+        file_body = get_file_body(file_path)
+        if file_body is None:
+            return None
+        if isinstance(file_body, FileBody):
+            return HttpResponse(PARTIAL_CONTENT_STATUS_CODE, PARTIAL_CONTENT_REASON_PHRASE, headers,
+                                ByteRangesBody(file_body.get_file(), parts, closing_boundary))
+        content = file_body  # a file that isn't regular is read to memory anyway
+    body = bytearray()
+    for part_head, first, length in parts:
+        body += part_head
+        body += memoryview(content)[first:first + length]
+    body += closing_boundary
+    return HttpResponse(PARTIAL_CONTENT_STATUS_CODE, PARTIAL_CONTENT_REASON_PHRASE, headers, bytes(body))
+
+
+def is_compressible(cached_file: CachedFile) -> bool:
+    """
+    Checks if it's worth compressing a file: its format isn't compressed already, and it isn't too small.
+    """
+    return cached_file.content_type not in COMPRESSED_CONTENT_TYPES and cached_file.size >= COMPRESSION_MIN_SIZE
+
+
+def choose_content_encoding(request: HttpRequest) -> str | None:
+    """
+    Chooses the content encoding of the response by the Accept-Encoding header of the request (rfc 7231 5.3.4).
+    Returns the acceptable encoding with the highest q-value (the order of CONTENT_ENCODINGS breaks ties),
+    or None if the response shouldn't be compressed.
+    The header is only a preference, so invalid members of it are ignored instead of failing the request.
+    """
+    accept_encoding = request.get_headers().get("Accept-Encoding")
+    if accept_encoding is None:
+        return None
+    q_values = {}
+    for accepted in accept_encoding.split(","):
+        try:
+            name, parameters = parse_header_value_parameters(accepted)
+            q_value = float(parameters.get("q", "1"))
+        except (BadRequest, ValueError):
+            continue
+        if 0 <= q_value <= 1:  # also skips nan
+            q_values[name.lower()] = q_value
+    chosen_encoding, chosen_q_value = None, 0
+    for encoding in CONTENT_ENCODINGS:
+        q_value = q_values.get(encoding, q_values.get("*", 0))
+        if q_value > chosen_q_value:
+            chosen_encoding, chosen_q_value = encoding, q_value
+    return chosen_encoding
+
+
+def get_compressed_file_response(request: HttpRequest, file_path: str, cached_file: CachedFile, encoding: str,
+                                 headers: dict[str, str]) -> HttpResponse | None:
+    """
+    Generates the response of a file compressed by the given content encoding (200 OK, or 304 Not Modified).
+    A precompressed file next to it (like index.html.gz) is preferred if it isn't older than the file.
+    Otherwise the contents in the cache are compressed (once), and files that aren't in memory aren't compressed.
+    Returns None if there's no compressed version, so the file should be sent as is.
+    """
+    precompressed_path = file_path + PRECOMPRESSED_EXTENSIONS[encoding]
+    precompressed_file = get_static_file(precompressed_path)
+    if precompressed_file.is_file and precompressed_file.mtime >= cached_file.mtime:
+        etag = precompressed_file.etag
+        body = precompressed_file.content
+        if body is None:
+            body = get_file_body(precompressed_path)
+            if body is None:
+                return None
+    elif cached_file.content is not None:
+        body = FILE_CACHE.get_compressed_content(
+            file_path, cached_file, encoding)
+        if body is None:
+            return None
+        # every encoding of a file is a different representation, with its own etag
+        etag = f'{cached_file.etag[:-1]}-{encoding}"'
+    else:
+        return None
+    validator_headers = f"ETag: {etag}\r\nLast-Modified: {cached_file.last_modified}\r\n".encode()
+    try:
+        not_modified = request.get_method() in ("GET", "HEAD") and is_not_modified(request, etag, cached_file.mtime)
+    except BaseException:  # the file is closed when the response is sent, and there won't be one
+        if isinstance(body, FileBody):
+            body.close()
+        raise
+    if not_modified:
+        if isinstance(body, FileBody):
+            body.close()
+        return HttpResponse(NOT_MODIFIED_STATUS_CODE, NOT_MODIFIED_REASON_PHRASE, headers, b"", validator_headers)
+    headers["Content-Type"] = cached_file.content_type
+    headers["Content-Encoding"] = encoding
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, body,
+                        f"Content-Length: {len(body)}\r\n".encode() + validator_headers)
+
 
+def get_cached_file_response(request: HttpRequest, file_path: str, cached_file: CachedFile) -> HttpResponse | None:
+    """
+    Generates the response of a file from the file cache: 200 OK with the file (compressed if the client accepts it),
+    304 Not Modified without a body if the request's conditional headers show the client has this version already,
+    or 206 Partial Content / 416 Range Not Satisfiable if the request asks for ranges of the file.
+    If the cache has the contents, the Content-Type (according to the file name), Content-Length, ETag and
+    Last-Modified headers were serialized by the cache already. Otherwise the file is sent from the disk with get_file_body.
+    Returns None if the file was deleted since it was cached.
+    """
+    headers = {"Cache-Control": get_cache_control(request.get_request_path())}
+    range_header = request.get_headers().get("Range")
+    if is_compressible(cached_file):
+        # the response depends on Accept-Encoding, even when the file isn't compressed for this request
+        headers["Vary"] = "Accept-Encoding"
+        # ranges are sent from the uncompressed file
+        encoding = choose_content_encoding(request)
+        if encoding is not None and not (request.get_method() == "GET" and range_header is not None):
+            response = get_compressed_file_response(
+                request, file_path, cached_file, encoding, headers)
+            if response is not None:
+                return response
+    if request.get_method() in ("GET", "HEAD") and is_not_modified(request, cached_file.etag, cached_file.mtime):
+        return HttpResponse(NOT_MODIFIED_STATUS_CODE, NOT_MODIFIED_REASON_PHRASE, headers, b"",
+                            cached_file.validator_headers)
+    if request.get_method() == "GET" and range_header is not None and is_range_allowed(request, cached_file):
+        ranges = parse_range_header(range_header, cached_file.size)
+        if ranges == []:  # none of the ranges is inside the file
+            headers["Content-Range"] = f"bytes */{cached_file.size}"
+            return HttpResponse(RANGE_NOT_SATISFIABLE_STATUS_CODE, RANGE_NOT_SATISFIABLE_REASON_PHRASE, headers, b"")
+        if ranges is not None:
+            return get_partial_file_response(file_path, cached_file, ranges, headers)
+    if cached_file.content is not None:
+        return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, cached_file.content,
+                            cached_file.serialized_headers)
+    body = get_file_body(file_path)
+    if body is None:
+        return None
+    headers["Content-Type"] = cached_file.content_type
+    headers["Accept-Ranges"] = "bytes"
+    headers["ETag"] = cached_file.etag
+    headers["Last-Modified"] = cached_file.last_modified
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, body)
 
-def get_file(request_path: str) -> HttpResponse:
+
+@ROUTER.route("GET", "/{file_path*}")
+def get_file(request: HttpRequest) -> HttpResponse:
     """
-    Used in case the request doesn't match a previous specifically-handled endpoint.
-    Gets a str of the request path.
+    Used in case the request doesn't match a previous specifically-handled endpoint (it's the least specific route).
+    Gets a HttpRequest, and uses its path.
     Gets the requested resource from the server and returns it in the HttpResponse.
     In case it doesn't exist, return 404.
     Also returns 403 in case of an attempt to access directory
     Generates a HttpResponse and returns it.
     """
-    file_path = ROOT_DIRECTORY + request_path
-    # test if there's a directory traversal attempt
-    root_directory_absolute_path = os.path.abspath(
-        ROOT_DIRECTORY + "/")  # absolute path of the root directory
-    # absolute path of the requested file.
-    request_absolute_path = os.path.abspath(file_path)
-    # verify the abs path of the requested resource starts with the abs path of the root directory (which mean's its inside the root directory)
-    if os.path.commonprefix([root_directory_absolute_path, request_absolute_path]) != root_directory_absolute_path:
-        # In case it doesn't, return Forbidden HTTP response
+    # a path in the webroot index is normalized already, so it's inside the root directory
+    indexed_file = WEBROOT_INDEX.get(request.get_request_path()) if WEBROOT_INDEX is not None else None
+    if indexed_file is not None:
+        file_path, cached_file = indexed_file
+        if cached_file.is_directory:
+            return HttpResponse(FORBIDDEN_STATUS_CODE, FORBIDDEN_REASON_PHRASE, {}, b"")
+        response = get_cached_file_response(request, file_path, cached_file)
+        if response is not None:
+            return response
+    # normalizing resolves the .. parts of the path without touching the disk
+    file_path = os.path.normpath(ROOT_DIRECTORY + request.get_request_path())
+    root_directory_path = os.path.normpath(ROOT_DIRECTORY)
+    # test if there's a directory traversal attempt: the resolved path has to be inside the root directory
+    if file_path != root_directory_path and not file_path.startswith(root_directory_path + os.sep):
+        # In case it isn't, return Forbidden HTTP response
         return HttpResponse(FORBIDDEN_STATUS_CODE, FORBIDDEN_REASON_PHRASE, {}, b"")
-    if os.path.isdir(file_path):  # If the user asks for a directory, also return Forbidden
+    cached_file = get_static_file(file_path)
+    if cached_file.is_directory:  # If the user asks for a directory, also return Forbidden
         return HttpResponse(FORBIDDEN_STATUS_CODE, FORBIDDEN_REASON_PHRASE, {}, b"")
     # If the user asks for a valid file and it exists, return it.
-    if os.path.exists(file_path):
-        response_body = get_file_content(file_path)
-        # use content type according to the file name.
-        response_headers = {"Content-Type": get_content_type(file_path)}
-        return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, response_headers, response_body)
+    if cached_file.is_file:
+        response = get_cached_file_response(request, file_path, cached_file)
+        if response is not None:
+            return response
     # if the file doesn't exist, return 404.
     headers = {}
     return HttpResponse(NOT_FOUND_STATUS_CODE, NOT_FOUND_REASON_PHRASE, headers, b"")
 
 
-# a dictionary of each custom api endpoint, key is (method, path) and value is the function to call for this endpoint.
-API_METHODS = {
-    ("GET", "/calculate-next"): calculate_next,
-    ("GET", "/calculate-area"): calculate_area,
-    ("POST", "/upload"): upload,
-    ("GET", "/image"): get_image
-}
+class LatencyHistogram:
+    """
+    This class counts durations (in seconds) in buckets, for a histogram in the Prometheus format.
+    It has:
+    bucket_counts - the amount of durations in each bucket: the durations up to each bucket's upper bound
+    (but above the previous one), and the durations above all of the bounds in the last one.
+    total - the sum of all the durations.
+    count - the amount of durations.
+    """
+    __slots__ = ("bucket_counts", "total", "count")
+
+    def __init__(self, bucket_count: int):
+        self.bucket_counts = [0] * (bucket_count + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+def format_metric_labels(labels: dict[str, str]) -> str:
+    """
+    Formats the labels of a metric sample in the Prometheus text format, like {route="/image",status="200"}.
+    """
+    formatted_labels = []
+    for name, value in labels.items():
+        # backslashes, quotes and line breaks are escaped in label values
+        value = str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+        formatted_labels.append(f'{name}="{value}"')
+    return "{" + ",".join(formatted_labels) + "}"
+
+
+class ServerMetrics:
+    """
+    This class keeps the metrics of the server: request counts by route and status code, bytes recieved and sent,
+    latency histograms of every stage of a request by route (parse - recieving and parsing the request,
+    handler - generating the response, write - sending the response) and gauges of open connections and
+    connections that are handling a request (the others wait for the next request), requests that timed out by the part
+    of the request that was late (header or body), and connections that were shed because of the connection limits.
+    Routes are identified by the path they were registered with, so the amount of series is bounded.
+    Recording only updates a few counters under a lock, the text format is generated only when it's requested.
+    Every worker process has its own metrics, and a scrape reaches whichever worker accepts it. So if per_process
+    is True (with several workers), every sample has a worker label (the pid), which keeps the counters of every
+    worker a series of its own (they can be summed, like sum(rate(...)) by the other labels).
+    """
+
+    def __init__(self, latency_buckets: list[float], per_process: bool):
+        self.__latency_buckets = latency_buckets
+        self.__per_process = per_process
+        self.__lock = threading.Lock()
+        self.__request_counts = collections.Counter()  # (route, status code) to amount of requests
+        self.__latencies = {}  # (route, stage) to LatencyHistogram
+        self.__recieved_bytes = 0
+        self.__sent_bytes = 0
+        self.__open_connections = 0
+        self.__active_connections = 0
+        self.__request_timeouts = collections.Counter()  # part of the request to amount of timeouts
+        self.__rejected_connections = collections.Counter()  # limit to amount of connections
+
+    def connection_opened(self):
+        with self.__lock:
+            self.__open_connections += 1
+
+    def connection_closed(self):
+        with self.__lock:
+            self.__open_connections -= 1
+
+    def connection_rejected(self, limit: str):
+        """
+        Records a connection that was shed because of the given limit ("max_connections" or "max_connections_per_ip").
+        """
+        with self.__lock:
+            self.__rejected_connections[limit] += 1
+
+    def request_started(self):
+        with self.__lock:
+            self.__active_connections += 1
+
+    def request_ended(self):
+        with self.__lock:
+            self.__active_connections -= 1
+
+    def __observe(self, route_label: str, stage: str, duration: float):
+        """
+        Adds a duration to the histogram of the given route and stage. The lock has to be held.
+        """
+        histogram = self.__latencies.get((route_label, stage))
+        if histogram is None:
+            histogram = LatencyHistogram(len(self.__latency_buckets))
+            self.__latencies[(route_label, stage)] = histogram
+        # the first bucket whose upper bound isn't smaller than the duration
+        histogram.bucket_counts[bisect.bisect_left(
+            self.__latency_buckets, duration)] += 1
+        histogram.total += duration
+        histogram.count += 1
+
+    def record_request(self, route: Route | None, request: HttpRequest | None, status_code: int, sent_byte_count: int,
+                       parse_start: float, handler_start: float | None, write_start: float, write_end: float):
+        """
+        Records a request that was responded to.
+        route and request are None if the request couldn't be recieved (then the response is an error),
+        and handler_start is None if the handler wasn't called. The times are of time.perf_counter.
+        Requests that timed out (408 Request Timeout) are counted as header timeouts if they couldn't be recieved,
+        and as body timeouts otherwise.
+        """
+        if request is None:
+            route_label = "invalid"
+            recieved_byte_count = 0
+        else:
+            # requests that matched no route are counted together
+            route_label = route.path if route is not None and route.path is not None else "unmatched"
+            recieved_byte_count = request.get_head_size()
+            body = request.get_body_stream()
+            if body is not None:
+                recieved_byte_count += body.get_recieved_length()
+        with self.__lock:
+            self.__request_counts[(route_label, status_code)] += 1
+            self.__recieved_bytes += recieved_byte_count
+            self.__sent_bytes += sent_byte_count
+            if status_code == REQUEST_TIMEOUT_STATUS_CODE:
+                self.__request_timeouts["header" if request is None else "body"] += 1
+            if handler_start is None:
+                self.__observe(route_label, "parse", write_start - parse_start)
+            else:
+                self.__observe(route_label, "parse", handler_start - parse_start)
+                self.__observe(route_label, "handler", write_start - handler_start)
+            self.__observe(route_label, "write", write_end - write_start)
+
+    def render(self, cache_statistics: dict[str, int], access_log_statistics: dict[str, int] | None) -> bytes:
+        """
+        Returns the metrics in the Prometheus text format, with the given statistics of the file cache
+        and of the access log (None if it's disabled).
+        """
+        with self.__lock:
+            request_counts = dict(self.__request_counts)
+            latencies = [(key, list(histogram.bucket_counts), histogram.total, histogram.count)
+                         for key, histogram in self.__latencies.items()]
+            recieved_bytes, sent_bytes = self.__recieved_bytes, self.__sent_bytes
+            open_connections, active_connections = self.__open_connections, self.__active_connections
+            request_timeouts = dict(self.__request_timeouts)
+            rejected_connections = dict(self.__rejected_connections)
+        # the pid is taken when rendering, since the metrics are created before the workers are forked
+        worker_labels = {"worker": os.getpid()} if self.__per_process else {}
+        unlabeled = format_metric_labels(worker_labels) if worker_labels else ""
+        lines = ["# HELP http_requests_total Requests responded to, by route and status code.",
+                 "# TYPE http_requests_total counter"]
+        for (route_label, status_code), count in sorted(request_counts.items()):
+            labels = format_metric_labels(
+                {**worker_labels, "route": route_label, "status": status_code})
+            lines.append(f"http_requests_total{labels} {count}")
+        lines += ["# HELP http_request_duration_seconds Duration of each stage of requests, by route.",
+                  "# TYPE http_request_duration_seconds histogram"]
+        for (route_label, stage), bucket_counts, total, count in sorted(latencies):
+            # the buckets of the text format are cumulative
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.__latency_buckets + ["+Inf"], bucket_counts):
+                cumulative_count += bucket_count
+                labels = format_metric_labels(
+                    {**worker_labels, "route": route_label, "stage": stage, "le": upper_bound})
+                lines.append(
+                    f"http_request_duration_seconds_bucket{labels} {cumulative_count}")
+            labels = format_metric_labels({**worker_labels, "route": route_label, "stage": stage})
+            lines.append(f"http_request_duration_seconds_sum{labels} {total}")
+            lines.append(f"http_request_duration_seconds_count{labels} {count}")
+        lines += ["# HELP http_received_bytes_total Bytes of requests received.",
+                  "# TYPE http_received_bytes_total counter",
+                  f"http_received_bytes_total{unlabeled} {recieved_bytes}",
+                  "# HELP http_sent_bytes_total Bytes of responses sent.",
+                  "# TYPE http_sent_bytes_total counter",
+                  f"http_sent_bytes_total{unlabeled} {sent_bytes}",
+                  "# HELP http_open_connections Open client connections.",
+                  "# TYPE http_open_connections gauge",
+                  f"http_open_connections{unlabeled} {open_connections}",
+                  "# HELP http_active_connections Client connections in the middle of a request.",
+                  "# TYPE http_active_connections gauge",
+                  f"http_active_connections{unlabeled} {active_connections}",
+                  "# HELP http_request_timeouts_total Requests that weren't received in time, by the late part.",
+                  "# TYPE http_request_timeouts_total counter"]
+        for part, count in sorted(request_timeouts.items()):
+            lines.append(f"http_request_timeouts_total{format_metric_labels({**worker_labels, 'part': part})} {count}")
+        lines += ["# HELP http_rejected_connections_total Connections shed at accept, by the limit they exceeded.",
+                  "# TYPE http_rejected_connections_total counter"]
+        for limit, count in sorted(rejected_connections.items()):
+            labels = format_metric_labels({**worker_labels, "limit": limit})
+            lines.append(f"http_rejected_connections_total{labels} {count}")
+        for name, value in cache_statistics.items():
+            # the amount of entries and bytes can go down, the rest only count up
+            if name in ("entries", "missing_entries", "bytes"):
+                lines += [f"# TYPE file_cache_{name} gauge", f"file_cache_{name}{unlabeled} {value}"]
+            else:
+                lines += [f"# TYPE file_cache_{name}_total counter",
+                          f"file_cache_{name}_total{unlabeled} {value}"]
+        for name, value in (access_log_statistics or {}).items():
+            lines += [f"# TYPE access_log_{name}_total counter", f"access_log_{name}_total{unlabeled} {value}"]
+        return ("\n".join(lines) + "\n").encode()
+
+
+def get_metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Used for the metrics endpoint (METRICS_PATH), which is registered by enable_metrics.
+    Returns the metrics of the server in the Prometheus text format.
+    """
+    access_log_statistics = ACCESS_LOG.get_statistics() if ACCESS_LOG is not None else None
+    body = METRICS.render(FILE_CACHE.get_statistics(), access_log_statistics)
+    headers = {"Content-Type": METRICS_CONTENT_TYPE, "Cache-Control": "no-store"}
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, body)
+
+
+def enable_metrics(metrics_path: str, per_process: bool):
+    """
+    Starts recording the metrics of the server, and registers the metrics endpoint at the given path.
+    Until it's called nothing is recorded at all. per_process labels the metrics by worker (see ServerMetrics).
+    """
+    global METRICS
+    METRICS = ServerMetrics(METRICS_LATENCY_BUCKETS, per_process)
+    ROUTER.add_route("GET", metrics_path, get_metrics, inline=True)
+
+
+class AccessLog:
+    """
+    This class writes a structured access log: a JSON line for every request, with the time, client address, method,
+    path, status code, bytes recieved and sent, and the duration of every stage (like the metrics).
+    Recording only puts the record in a ring buffer of up to capacity records, and a background thread formats
+    and writes the records in batches (every flush_interval seconds, or once batch_size records are waiting),
+    so writing the log never delays a response. When the buffer is full, the overflow policy decides which
+    record is dropped: "drop_newest" drops the new one, "drop_oldest" the oldest one waiting. Dropped records are counted.
+    The log is rotated when it reaches max_bytes or is older than rotate_interval seconds (unless it's empty):
+    the file is renamed to {path}.1 (and older files shift to .2 and so on, up to backup_count files).
+    If per_process is True, every process writes its own log, {path}.{pid} (for worker processes).
+    Records that can't be written (like when the log can't be opened) are counted as dropped too.
+    Raises ValueError if the overflow policy isn't one of ACCESS_LOG_OVERFLOW_POLICIES.
+    """
+
+    def __init__(self, path: str, capacity: int, batch_size: int, flush_interval: float, overflow_policy: str,
+                 max_bytes: int, rotate_interval: float, backup_count: int, per_process: bool):
+        if overflow_policy not in ACCESS_LOG_OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown access log overflow policy {overflow_policy}")
+        self.__path = path
+        self.__capacity = capacity
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__overflow_policy = overflow_policy
+        self.__max_bytes = max_bytes
+        self.__rotate_interval = rotate_interval
+        self.__backup_count = backup_count
+        self.__per_process = per_process
+        self.__records = collections.deque(maxlen=capacity)
+        self.__lock = threading.Lock()
+        self.__statistics = {"records": 0, "dropped_records": 0}
+        self.__wake_writer = threading.Event()
+        self.__stopping = False
+        self.__writer = None
+        self.__file = None
+        self.__opened_at = 0
+
+    def record(self, request: HttpRequest | None, client_address: str, status_code: int, sent_byte_count: int,
+               parse_start: float, handler_start: float | None, write_start: float, write_end: float):
+        """
+        Records a request that was responded to, with the same arguments as ServerMetrics.record_request
+        (and the address of the client).
+        """
+        # only what the log needs is kept, not the request (which may have a big body)
+        method = path = None
+        recieved_byte_count = 0
+        if request is not None:
+            method, path = request.get_method(), request.get_request_path()
+            recieved_byte_count = request.get_head_size()
+            if request.get_body_stream() is not None:
+                recieved_byte_count += request.get_body_stream().get_recieved_length()
+        if handler_start is None:  # the request couldn't be recieved, or the handler wasn't called
+            parse_duration, handler_duration = write_start - parse_start, None
+        else:
+            parse_duration, handler_duration = handler_start - parse_start, write_start - handler_start
+        record = (time.time(), client_address, method, path, status_code, recieved_byte_count, sent_byte_count,
+                  parse_duration, handler_duration, write_end - write_start)
+        with self.__lock:
+            if len(self.__records) == self.__capacity:
+                self.__statistics["dropped_records"] += 1
+                if self.__overflow_policy == "drop_newest":
+                    return
+            self.__records.append(record)  # the deque drops the oldest record when it's full
+            self.__statistics["records"] += 1
+            waiting_count = len(self.__records)
+        if waiting_count == self.__batch_size:
+            self.__wake_writer.set()
+
+    def get_statistics(self) -> dict[str, int]:
+        """
+        Returns the amount of records that were recorded, and that were dropped.
+        """
+        with self.__lock:
+            return dict(self.__statistics)
+
+    def start(self):
+        """
+        Opens the log and starts the thread that writes it.
+        It has to be started in every process that records, since threads don't survive fork.
+        """
+        if self.__per_process:
+            self.__path = f"{self.__path}.{os.getpid()}"
+        self.__open()
+        self.__stopping = False
+        self.__writer = threading.Thread(target=self.__write_records, daemon=True)
+        self.__writer.start()
+
+    def stop(self):
+        """
+        Writes the records that are still waiting, stops the writing thread and closes the log.
+        """
+        if self.__writer is None:
+            return
+        self.__stopping = True
+        self.__wake_writer.set()
+        self.__writer.join()
+        self.__writer = None
+        self.__file.close()
+
+    def __write_records(self):
+        while True:
+            self.__wake_writer.wait(self.__flush_interval)
+            self.__wake_writer.clear()
+            stopping = self.__stopping  # the records recorded before stopping are written
+            with self.__lock:
+                records = list(self.__records)
+                self.__records.clear()
+            if records:
+                try:
+                    if self.__file.closed:  # reopening failed before, try again
+                        self.__open()
+                    self.__file.write("".join(format_access_log_record(*record) for record in records))
+                    self.__file.flush()
+                except Exception:  # the records are lost, but the server goes on
+                    traceback.print_exc()
+                    with self.__lock:
+                        self.__statistics["dropped_records"] += len(records)
+            try:
+                if not self.__file.closed and self.__file.tell() >= self.__max_bytes:
+                    self.__rotate()
+                elif not self.__file.closed and time.monotonic() - self.__opened_at >= self.__rotate_interval:
+                    if self.__file.tell() > 0:
+                        self.__rotate()
+                    else:  # an empty log isn't rotated (it would push a log with records out), its period starts over
+                        self.__opened_at = time.monotonic()
+            except Exception:
+                traceback.print_exc()
+            if stopping:
+                return
+
+    def __open(self):
+        self.__file = open(self.__path, "a", encoding="utf-8")
+        self.__opened_at = time.monotonic()
+
+    def __rotate(self):
+        """
+        Renames the log to {path}.1, after renaming the older logs to the next number (the oldest one is replaced),
+        and starts a new one.
+        The log is opened again even if renaming fails (like when it was moved away), so writing goes on.
+        """
+        self.__file.close()
+        try:
+            if self.__backup_count > 0:
+                for number in range(self.__backup_count - 1, 0, -1):
+                    if os.path.exists(f"{self.__path}.{number}"):
+                        os.replace(f"{self.__path}.{number}", f"{self.__path}.{number + 1}")
+                os.replace(self.__path, f"{self.__path}.1")
+            else:
+                os.remove(self.__path)
+        finally:
+            self.__open()
+
+
+def format_access_log_record(logged_at: float, client_address: str, method: str | None, path: str | None,
+                             status_code: int, recieved_byte_count: int, sent_byte_count: int, parse_duration: float,
+                             handler_duration: float | None, write_duration: float) -> str:
+    """
+    Formats an access log record as a JSON line. The durations (in seconds) are written in milliseconds.
+    The method and path are None if the request couldn't be recieved, and the handler duration if it wasn't called.
+    """
+    logged_at_text = datetime.datetime.fromtimestamp(
+        logged_at, datetime.timezone.utc).isoformat(timespec="milliseconds")
+    record = {"time": logged_at_text, "client": client_address, "method": method, "path": path, "status": status_code,
+              "received_bytes": recieved_byte_count, "sent_bytes": sent_byte_count,
+              "parse_ms": round(parse_duration * 1000, 3),
+              "handler_ms": round(handler_duration * 1000, 3) if handler_duration is not None else None,
+              "write_ms": round(write_duration * 1000, 3)}
+    return json.dumps(record) + "\n"
+
+
+def enable_access_log(path: str, per_process: bool):
+    """
+    Starts recording the access log, to the given path (see AccessLog). It's written once run_server starts.
+    """
+    global ACCESS_LOG
+    ACCESS_LOG = AccessLog(path, ACCESS_LOG_CAPACITY, ACCESS_LOG_BATCH_SIZE, ACCESS_LOG_FLUSH_INTERVAL,
+                           ACCESS_LOG_OVERFLOW_POLICY, ACCESS_LOG_MAX_BYTES, ACCESS_LOG_ROTATE_INTERVAL,
+                           ACCESS_LOG_BACKUP_COUNT, per_process)
+
+
+class RequestTrace:
+    """
+    This class collects how long the stages inside the handler of a single request took, for the SlowRequestTracer.
+    The code of the stages worth seeing (reading the body, reading, compressing and writing files, waiting for the
+    executor) adds its time with add_stage, while the trace is the current one of the thread (see get_request_trace).
+    A stage may happen several times, and may contain others (a streamed upload reads the body while writing the file).
+    """
+
+    def __init__(self):
+        self.stages = {}  # stage to [total duration, amount of times]
+
+    def add_stage(self, stage: str, start: float):
+        """
+        Adds the time since start (of time.perf_counter) to the given stage.
+        """
+        duration = time.perf_counter() - start
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [duration, 1]
+        else:
+            totals[0] += duration
+            totals[1] += 1
+
+
+def get_request_trace() -> RequestTrace | None:
+    """
+    Returns the trace of the request this thread is handling, or None if it isn't traced
+    (always None while the SLOW_REQUEST_TRACER is disabled, which is all the tracing costs then).
+    """
+    if SLOW_REQUEST_TRACER is None:
+        return None
+    return getattr(REQUEST_TRACE_CONTEXT, "trace", None)
+
+
+def set_request_trace(trace: RequestTrace | None):
+    """
+    Makes the given trace the current one of this thread (None when the thread is done with the request).
+    """
+    REQUEST_TRACE_CONTEXT.trace = trace
+
+
+def run_traced(trace: RequestTrace, submitted_at: float, function, *args):
+    """
+    Calls function(*args) in an executor thread with the given trace as the current one, adding the time since the call
+    was submitted (of time.perf_counter) as the "executor_wait" stage. Returns what the function returns.
+    """
+    trace.add_stage("executor_wait", submitted_at)
+    set_request_trace(trace)
+    try:
+        return function(*args)
+    finally:
+        set_request_trace(None)
+
+
+class SlowRequestTracer:
+    """
+    This class keeps the traces of the slow requests: the ones that took at least threshold seconds from the start of
+    recieving them to the end of sending the response. Every trace has the time every stage took: the parse, handler
+    and write stages of the metrics, and the stages inside the handler (see RequestTrace).
+    Up to capacity of the latest traces are kept. Requests that aren't slow are only compared to the threshold.
+    """
+
+    def __init__(self, threshold: float, capacity: int):
+        self.__threshold = threshold
+        self.__traces = collections.deque(maxlen=capacity)
+        self.__lock = threading.Lock()
+        self.__slow_request_count = 0
+
+    def get_threshold(self) -> float:
+        return self.__threshold
+
+    def record(self, trace: RequestTrace, request: HttpRequest | None, client_address: str, status_code: int,
+               parse_start: float, handler_start: float | None, write_start: float, write_end: float):
+        """
+        Records the trace of a request if it was slow, with the same arguments as AccessLog.record
+        (and the trace of the request).
+        """
+        if write_end - parse_start < self.__threshold:
+            return
+        if handler_start is None:  # the request couldn't be recieved, or the handler wasn't called
+            parse_duration, handler_duration = write_start - parse_start, None
+        else:
+            parse_duration, handler_duration = handler_start - parse_start, write_start - handler_start
+        logged_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds")
+        slow_request = {"time": logged_at, "client": client_address,
+                        "method": request.get_method() if request is not None else None,
+                        "path": request.get_request_path() if request is not None else None,
+                        "status": status_code, "duration_ms": round((write_end - parse_start) * 1000, 3),
+                        "parse_ms": round(parse_duration * 1000, 3),
+                        "handler_ms": round(handler_duration * 1000, 3) if handler_duration is not None else None,
+                        "write_ms": round((write_end - write_start) * 1000, 3),
+                        "handler_stages": {stage: {"ms": round(duration * 1000, 3), "count": count}
+                                           for stage, (duration, count) in trace.stages.items()}}
+        with self.__lock:
+            self.__traces.append(slow_request)
+            self.__slow_request_count += 1
+
+    def get_traces(self) -> tuple[int, list[dict]]:
+        """
+        Returns the amount of slow requests recorded, and the traces that are kept (the oldest first).
+        """
+        with self.__lock:
+            return self.__slow_request_count, list(self.__traces)
+
+
+class SamplingProfiler:
+    """
+    This class is a sampling profiler that runs on demand: while it runs, a thread samples the stacks of all the other
+    threads every interval seconds, and counts how many times every stack was seen.
+    The counts are returned as collapsed stacks, the input format of flame graph tools: a line per stack, with the
+    thread name and the frames from the outermost one, seperated by semicolons, followed by the count.
+    The profiler stops by itself after the duration it was started for. While it doesn't run, nothing runs at all.
+    """
+
+    def __init__(self, interval: float):
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__stack_counts = collections.Counter()
+        self.__sampler = None
+        self.__frame_names = {}  # code object to its name in the stacks
+
+    def is_running(self) -> bool:
+        return self.__sampler is not None and self.__sampler.is_alive()
+
+    def start(self, duration: float) -> bool:
+        """
+        Starts sampling for duration seconds, forgetting the stacks of the previous profile.
+        Returns False (and does nothing) if the profiler is running already.
+        """
+        with self.__lock:
+            if self.is_running():
+                return False
+            self.__stack_counts = collections.Counter()
+            self.__sampler = threading.Thread(
+                target=self.__sample, args=(time.monotonic() + duration,), daemon=True)
+            self.__sampler.start()
+        return True
+
+    def get_collapsed_stacks(self) -> str:
+        """
+        Returns the stacks sampled so far (of the running profile, or of the last one), the most frequent first.
+        """
+        with self.__lock:
+            stack_counts = self.__stack_counts.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stack_counts)
+
+    def __sample(self, end_time: float):
+        sampler_id = threading.get_ident()
+        while time.monotonic() < end_time:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                frame_names = []
+                while frame is not None:
+                    frame_names.append(self.__get_frame_name(frame.f_code))
+                    frame = frame.f_back
+                frame_names.append(thread_names.get(thread_id, str(thread_id)))
+                stacks.append(";".join(reversed(frame_names)))
+            with self.__lock:
+                self.__stack_counts.update(stacks)
+            time.sleep(self.__interval)
+
+    def __get_frame_name(self, code) -> str:
+        name = self.__frame_names.get(code)
+        if name is None:
+            name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+            self.__frame_names[code] = name
+        return name
+
+
+def is_loopback_address(address: str) -> bool:
+    """
+    Returns True if the given IP address (as string) is a loopback address, including an IPv4 loopback address
+    mapped to IPv6 (::ffff:127.0.0.1), which is how a dual-stack socket sees an IPv4 client.
+    """
+    try:
+        ip_address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    if ip_address.version == 6 and ip_address.ipv4_mapped is not None:
+        ip_address = ip_address.ipv4_mapped
+    return ip_address.is_loopback
+
+
+def allow_only_loopback_clients(request: HttpRequest, handler) -> HttpResponse:
+    """
+    A middleware that responds with 403 to clients that didn't connect from the loopback interface,
+    for the endpoints that only the operator of the server should reach.
+    """
+    if not is_loopback_address(request.get_client_address()):
+        return HttpResponse(FORBIDDEN_STATUS_CODE, FORBIDDEN_REASON_PHRASE, {}, b"")
+    return handler(request)
+
+
+def get_slow_requests(request: HttpRequest) -> HttpResponse:
+    """
+    Used for GET on the slow requests endpoint ({DEBUG_PATH}/slow-requests), which is registered by enable_debug_endpoints.
+    Returns whether slow requests are traced, the threshold in milliseconds, the amount of slow requests,
+    and the traces that are kept, as JSON.
+    """
+    tracer = SLOW_REQUEST_TRACER
+    description = {"enabled": tracer is not None}
+    if tracer is not None:
+        slow_request_count, traces = tracer.get_traces()
+        description.update({"threshold_ms": tracer.get_threshold() * 1000, "slow_requests": slow_request_count,
+                            "traces": traces})
+    headers = {"Content-Type": JSON_CONTENT_TYPE, "Cache-Control": "no-store"}
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, json.dumps(description).encode())
+
+
+def start_tracing_slow_requests(request: HttpRequest) -> HttpResponse:
+    """
+    Used for POST on the slow requests endpoint.
+    Gets the threshold in milliseconds as the query parameter threshold_ms (SLOW_REQUEST_THRESHOLD by default),
+    and starts tracing the requests that take longer than it (forgetting the traces so far).
+    Returns like get_slow_requests.
+    """
+    threshold_ms_str = request.get_query_parameters().get("threshold_ms")
+    threshold = SLOW_REQUEST_THRESHOLD
+    if threshold_ms_str is not None:
+        threshold = try_parse_int(threshold_ms_str, "threshold_ms isn't integer") / 1000
+    enable_slow_request_tracer(threshold)
+    return get_slow_requests(request)
+
+
+def stop_tracing_slow_requests(request: HttpRequest) -> HttpResponse:
+    """
+    Used for DELETE on the slow requests endpoint. Stops tracing requests, and forgets the traces.
+    """
+    global SLOW_REQUEST_TRACER
+    SLOW_REQUEST_TRACER = None
+    return get_slow_requests(request)
+
+
+def get_profile(request: HttpRequest) -> HttpResponse:
+    """
+    Used for GET on the profile endpoint ({DEBUG_PATH}/profile), which is registered by enable_debug_endpoints.
+    Returns the collapsed stacks of the running profile, or of the last one (empty if there was none).
+    """
+    headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE, "Cache-Control": "no-store"}
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, PROFILER.get_collapsed_stacks().encode())
+
+
+def start_profile(request: HttpRequest) -> HttpResponse:
+    """
+    Used for POST on the profile endpoint.
+    Gets the duration of the profile as the query parameter seconds (PROFILE_DURATION by default, at most
+    PROFILE_MAX_DURATION), and starts profiling this process for that long. The stacks are fetched with GET later.
+    Returns 409 Conflict if a profile is running already.
+    """
+    seconds_str = request.get_query_parameters().get("seconds")
+    seconds = PROFILE_DURATION
+    if seconds_str is not None:
+        seconds = try_parse_int(seconds_str, "seconds isn't integer")
+    if seconds <= 0 or seconds > PROFILE_MAX_DURATION:
+        raise BadRequest(f"seconds should be between 1 and {PROFILE_MAX_DURATION}")
+    if not PROFILER.start(seconds):
+        return HttpResponse(CONFLICT_STATUS_CODE, CONFLICT_REASON_PHRASE, {"Content-Type": PLAINTEXT_CONTENT_TYPE},
+                            b"A profile is running already")
+    headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+    return HttpResponse(OK_STATUS_CODE, OK_REASON_PHRASE, headers, f"Profiling for {seconds} seconds".encode())
+
+
+def enable_slow_request_tracer(threshold: float):
+    """
+    Starts tracing the requests that take at least threshold seconds (see SlowRequestTracer).
+    Until it's called (or after the tracing is stopped) requests aren't traced at all.
+    """
+    global SLOW_REQUEST_TRACER
+    SLOW_REQUEST_TRACER = SlowRequestTracer(threshold, SLOW_REQUEST_CAPACITY)
+
+
+def enable_debug_endpoints(debug_path: str):
+    """
+    Registers the debug endpoints under the given path, which switch the profiling of the server on and off
+    while it runs: {debug_path}/profile runs the SamplingProfiler for a while (POST) and returns its stacks (GET),
+    and {debug_path}/slow-requests starts (POST) and stops (DELETE) tracing slow requests, and returns them (GET).
+    With several workers, every worker is profiled and traces its requests by itself, so the endpoints reach
+    the worker that happens to accept the connection (tracing can be started in all of them at startup instead).
+    The endpoints expose the code and the requests of the server, so they answer only clients on the server machine
+    itself (others get 403), and reaching them from elsewhere takes a tunnel, for example ssh -L.
+    """
+    global PROFILER
+    PROFILER = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+    middleware = [allow_only_loopback_clients]
+    ROUTER.add_route("GET", f"{debug_path}/profile", get_profile, middleware, inline=True)
+    ROUTER.add_route("POST", f"{debug_path}/profile", start_profile, middleware, inline=True)
+    ROUTER.add_route("GET", f"{debug_path}/slow-requests", get_slow_requests, middleware, inline=True)
+    ROUTER.add_route("POST", f"{debug_path}/slow-requests", start_tracing_slow_requests, middleware, inline=True)
+    ROUTER.add_route("DELETE", f"{debug_path}/slow-requests", stop_tracing_slow_requests, middleware, inline=True)
+
 
 # the server configuration: host address, port and client timeout
 HOST_ADDRESS = "localhost"
 PORT = 80
 CLIENT_TIMEOUT = 2
+# the amount of worker processes serving clients. with more than one, a master process supervises them.
+# with REUSE_PORT each worker binds its own socket with SO_REUSEPORT, otherwise they all share the master's socket.
+WORKER_COUNT = 1
+REUSE_PORT = False
+# how long a stopping server waits for the requests in progress to finish
+DRAIN_TIMEOUT = 10
+# graceful reload (on SIGHUP): how long to wait for the new process to start, and the environment variables that pass it
+# the fd of the listening socket and the fd it reports it's ready on
+RELOAD_READY_TIMEOUT = 10
+LISTEN_FD_ENVIRONMENT_VARIABLE = "WEB_SERVER_LISTEN_FD"
+READY_FD_ENVIRONMENT_VARIABLE = "WEB_SERVER_READY_FD"
+# how long the master waits before restarting a worker that exited, so a crashing worker doesn't spin
+WORKER_RESTART_DELAY = 1
+# the static file cache: its budget in bytes, the biggest file it keeps in memory (bigger files are sent with sendfile),
+# how long an entry is trusted
+# before checking the file's mtime and size again, and the budget each entry costs on top of its contents.
+# the paths that don't exist (or are directories) are remembered apart, up to FILE_CACHE_MAX_MISSING_ENTRIES of them
+FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FILE_CACHE_MAX_FILE_SIZE = 1024 * 1024
+FILE_CACHE_REVALIDATE_INTERVAL = 1
+FILE_CACHE_ENTRY_OVERHEAD = 256
+FILE_CACHE_MAX_MISSING_ENTRIES = 4096
+FILE_CACHE = FileCache(FILE_CACHE_MAX_BYTES, FILE_CACHE_MAX_FILE_SIZE, FILE_CACHE_REVALIDATE_INTERVAL,
+                       FILE_CACHE_MAX_MISSING_ENTRIES)
+# the webroot index (optional): when it's enabled, everything under the root directory is indexed at startup, with the
+# contents of files up to FILE_CACHE_MAX_FILE_SIZE while they fit in WEBROOT_INDEX_MAX_BYTES, and the root directory is
+# walked again every WEBROOT_INDEX_POLL_INTERVAL seconds to pick up changes. the FILE_CACHE serves what isn't indexed.
+WEBROOT_INDEX_ENABLED = False
+WEBROOT_INDEX_MAX_BYTES = 64 * 1024 * 1024
+WEBROOT_INDEX_POLL_INTERVAL = 2
+# the index, set by enable_webroot_index (None while it's disabled)
+WEBROOT_INDEX = None
+# the Cache-Control header of files, by the prefix of the requested path (the first matching rule is used).
+# the assets that rarely change can be kept by browsers for a day, everything else is revalidated on every use
+# (which is cheap, since an unchanged file gets 304 Not Modified without a body).
+CACHE_CONTROL_RULES = [
+    ("/imgs/", "public, max-age=86400"),
+    ("/js/", "public, max-age=86400"),
+    ("/css/", "public, max-age=86400")
+]
+DEFAULT_CACHE_CONTROL = "no-cache"
+# response compression: the supported content encodings by preference (brotli only if it's installed),
+# the extensions of precompressed files for each encoding, and the smallest file worth compressing
+CONTENT_ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+PRECOMPRESSED_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+COMPRESSION_MIN_SIZE = 1024
+# uploads: uploads up to UPLOAD_WRITE_BEHIND_MAX_SIZE bytes are recieved to memory, and written to the disk in the
+# background by UPLOAD_WRITER_THREADS threads (bigger uploads are written while they're recieved).
+# up to UPLOAD_MAX_PENDING_BYTES bytes may wait to be written, more uploads get 503 Service Unavailable
+# with a Retry-After of UPLOAD_RETRY_AFTER seconds.
+# UPLOAD_FSYNC_POLICY is "none" to leave writing to the disk to the OS, "file" to sync every file before it
+# replaces the old one, or "full" to also sync the directory, so the new file survives a crash.
+# a file is written to a temporary file next to it (named by the prefix and suffix), which the server never serves.
+# uploaded files get the permissions open() would give them (0666 without the bits of the umask).
+UPLOAD_WRITE_BEHIND_MAX_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_PENDING_BYTES = 64 * 1024 * 1024
+UPLOAD_WRITER_THREADS = 2
+UPLOAD_RETRY_AFTER = 1
+UPLOAD_FSYNC_POLICY = "file"
+UPLOAD_TEMPORARY_PREFIX = ".upload-"
+UPLOAD_TEMPORARY_SUFFIX = ".tmp"
+UPLOAD_FILE_MODE = 0o666 & ~get_umask()
+UPLOAD_WRITER = UploadWriter(UPLOAD_WRITER_THREADS, UPLOAD_MAX_PENDING_BYTES)
+# limits on the request line and headers: their total size in bytes, and the amount of headers
+MAX_HEADER_SIZE = 65536
+MAX_HEADER_COUNT = 100
+# the biggest request body the server accepts, in bytes. bigger requests get 413 Payload Too Large.
+MAX_BODY_SIZE = 100 * 1024 * 1024
+# protection from slow clients: the whole request head has to arrive within HEADER_TIMEOUT seconds,
+# and a body within BODY_TIMEOUT seconds plus a second for every MIN_BODY_RATE bytes of it that arrived (so slower
+# clients are cut off, whatever length they declared), on top of the CLIENT_TIMEOUT of every recv.
+# requests that miss their deadline get 408 Request Timeout.
+HEADER_TIMEOUT = 10
+BODY_TIMEOUT = 10
+MIN_BODY_RATE = 64 * 1024
+# how many connections may wait to be accepted (the kernel caps it by net.core.somaxconn)
+LISTEN_BACKLOG = 1024
+# the async server's connection limits: how many connections it serves at once, and from a single address.
+# the connections beyond them are shed when they're accepted, by CONNECTION_OVERFLOW_POLICY:
+# "reject" sends 503 Service Unavailable (with a Retry-After of CONNECTION_RETRY_AFTER seconds), "close" just closes them.
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 64
+CONNECTION_OVERFLOW_POLICY = "reject"
+CONNECTION_RETRY_AFTER = 1
+# the response to shed connections, serialized once
+OVERLOADED_RESPONSE = serialize_response_head(HttpResponse(
+    SERVICE_UNAVAILABLE_STATUS_CODE, SERVICE_UNAVAILABLE_REASON_PHRASE,
+    {"Retry-After": CONNECTION_RETRY_AFTER, "Connection": "close"}, b""))
+# persistent connections: how long to wait for the next request on an idle connection,
+# and how many requests to serve on a single connection before closing it
+KEEP_ALIVE_TIMEOUT = 5
+MAX_KEEP_ALIVE_REQUESTS = 100
+# how clients are served: "serial" handles one connection at a time,
+# "async" handles all the connections concurrently on an asyncio event loop.
+SERVER_MODE = "serial"
+SERVER_MODES = ("serial", "async")
+# the amount of threads the async server uses for blocking work (reading and writing files),
+# and how many of them may handle requests with a body at once (a handler waits for the client while reading it)
+ASYNC_EXECUTOR_WORKERS = 16
+ASYNC_BODY_READERS = 8
+# the batch endpoints: the most items a single request may have, and how many results are sent in each chunk
+BATCH_MAX_ITEMS = 100000
+BATCH_RESPONSE_CHUNK_LINES = 4096
+# the metrics endpoint: whether metrics are recorded at all, the path they're served at in the Prometheus text format,
+# and the upper bounds of the buckets of the latency histograms (in seconds)
+METRICS_ENABLED = True
+METRICS_PATH = "/metrics"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+METRICS_LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+# the metrics of this process, set by enable_metrics (None while metrics are disabled)
+METRICS = None
+# the access log (off unless a path is given): up to ACCESS_LOG_CAPACITY records wait in memory, they're written every
+# ACCESS_LOG_FLUSH_INTERVAL seconds or once ACCESS_LOG_BATCH_SIZE are waiting. when too many are waiting,
+# ACCESS_LOG_OVERFLOW_POLICY decides which ones are dropped ("drop_newest" or "drop_oldest").
+# the log is rotated when it reaches ACCESS_LOG_MAX_BYTES or every ACCESS_LOG_ROTATE_INTERVAL seconds (if it has
+# records), keeping ACCESS_LOG_BACKUP_COUNT old logs
+ACCESS_LOG_PATH = None
+ACCESS_LOG_CAPACITY = 65536
+ACCESS_LOG_BATCH_SIZE = 1024
+ACCESS_LOG_FLUSH_INTERVAL = 1
+ACCESS_LOG_OVERFLOW_POLICY = "drop_newest"
+ACCESS_LOG_OVERFLOW_POLICIES = ("drop_newest", "drop_oldest")
+ACCESS_LOG_MAX_BYTES = 64 * 1024 * 1024
+ACCESS_LOG_ROTATE_INTERVAL = 24 * 60 * 60
+ACCESS_LOG_BACKUP_COUNT = 5
+# the access log of this process, set by enable_access_log (None while it's disabled)
+ACCESS_LOG = None
+# the debug endpoints (off unless a path is given) switch on the profiling surface while the server runs:
+# the sampling profiler samples the stacks every PROFILE_SAMPLE_INTERVAL seconds, for PROFILE_DURATION seconds unless
+# asked otherwise (and up to PROFILE_MAX_DURATION), and the slow request tracer keeps the traces of the latest
+# SLOW_REQUEST_CAPACITY requests that took at least SLOW_REQUEST_THRESHOLD seconds (unless asked otherwise)
+DEBUG_PATH = None
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DURATION = 30
+PROFILE_MAX_DURATION = 600
+SLOW_REQUEST_THRESHOLD = 0.5
+SLOW_REQUEST_CAPACITY = 1000
+# the profiler of this process, set by enable_debug_endpoints
+PROFILER = None
+# the slow request tracer of this process, set by enable_slow_request_tracer (None while requests aren't traced),
+# and the trace of the request every thread is handling
+SLOW_REQUEST_TRACER = None
+REQUEST_TRACE_CONTEXT = threading.local()
 
 
-def main():
-    server = HttpServer(HOST_ADDRESS, PORT, CLIENT_TIMEOUT)
-    while True:
-        conn = server.accept_client()
-        try:
-            request = conn.recieve_request()  # recieve a request
-            request_path = request.get_request_path()
-            request_method = request.get_method()
-            # if the request matches an api endpoint call the matching functoin
-            if (request_method, request_path) in API_METHODS:
-                response = API_METHODS[(request_method, request_path)](request)
-            else:  # otherwise try to get the path as file.
-                response = get_file(request_path)
-            conn.send_response(response)
-        except socket.timeout:  # In case of timeout when recieving the request, send a Request Timeout response
-            # Signal to close the connection, as mentioned in rfc 7231 6.5.7
-            response_headers = {"Connection": "close"}
-            response = HttpResponse(
-                REQUEST_TIMEOUT_STATUS_CODE, REQUEST_TIMEOUT_REASON_PHRASE, response_headers, b"")
-            conn.send_response(response)
-        # In the case of a bad request exception (raised when the request is invalid), send bad request response with the error message
-        except BadRequest as e:
-            body = e.message.encode()
-            headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
-            response = HttpResponse(
-                BAD_REQUEST_STATUS_CODE, BAD_REQUEST_REASON_PHRASE, headers, body)
-            conn.send_response(response)
-        except Exception as e:  # In case there was some error during the processing of the request
-            response = HttpResponse(
-                INTERNAL_SERVER_ERROR_STATUS_CODE, INTERNAL_SERVER_ERROR_REASON_PHRASE, {}, b"")
-            # return Internal Server Error response
-            conn.send_response(response)
+def enable_webroot_index():
+    """
+    Builds the WEBROOT_INDEX by walking the root directory. Until it's called static files are found with the FILE_CACHE only.
+    It's watched for changes once run_server starts.
+    """
+    global WEBROOT_INDEX
+    WEBROOT_INDEX = WebrootIndex(ROOT_DIRECTORY, WEBROOT_INDEX_MAX_BYTES, FILE_CACHE_MAX_FILE_SIZE,
+                                 WEBROOT_INDEX_POLL_INTERVAL)
+    WEBROOT_INDEX.refresh()
+
+
+def handle_request(request: HttpRequest, route: Route | None = None) -> HttpResponse:
+    """
+    Generates the response for a single request, by calling the handler of its route.
+    The route is found with the ROUTER, unless it was found already and given.
+    """
+    if route is None:
+        route = ROUTER.resolve(request)
+    return route.handler(request)
+
+
+def respond_to_request(request: HttpRequest, route: Route | None = None) -> HttpResponse:
+    """
+    Generates the response for a single request with handle_request, then reads the part of the request body
+    the handler didn't read, so the connection is ready for the next request.
+    """
+    response = handle_request(request, route)
+    if request.get_body_stream() is not None:
+        request.get_body_stream().discard()
+    return response
+
+
+def get_error_response(error: Exception) -> HttpResponse:
+    """
+    Generates the response to send when handling a request raised the given exception.
+    """
+    if isinstance(error, socket.timeout):  # In case of timeout when recieving the request, send a Request Timeout response
+        # Signal to close the connection, as mentioned in rfc 7231 6.5.7
+        response_headers = {"Connection": "close"}
+        return HttpResponse(REQUEST_TIMEOUT_STATUS_CODE, REQUEST_TIMEOUT_REASON_PHRASE, response_headers, b"")
+    # In the case of a bad request exception (raised when the request is invalid), send bad request response with the error message
+    if isinstance(error, BadRequest):
+        body = error.message.encode()
+        headers = {"Content-Type": PLAINTEXT_CONTENT_TYPE}
+        return HttpResponse(BAD_REQUEST_STATUS_CODE, BAD_REQUEST_REASON_PHRASE, headers, body)
+    # In case the request body is too big, send Payload Too Large and close the connection instead of reading the body
+    if isinstance(error, PayloadTooLarge):
+        response_headers = {"Connection": "close"}
+        return HttpResponse(PAYLOAD_TOO_LARGE_STATUS_CODE, PAYLOAD_TOO_LARGE_REASON_PHRASE, response_headers, b"")
+    # In case the request body is sent in a way the server can't read, close the connection instead of reading it
+    if isinstance(error, UnsupportedTransferCoding):
+        response_headers = {"Connection": "close"}
+        return HttpResponse(NOT_IMPLEMENTED_STATUS_CODE, NOT_IMPLEMENTED_REASON_PHRASE, response_headers, b"")
+    # In case the server is too busy, ask the client to retry later. the request body wasn't read, so close the connection
+    if isinstance(error, ServiceUnavailable):
+        response_headers = {"Retry-After": error.retry_after, "Connection": "close"}
+        return HttpResponse(SERVICE_UNAVAILABLE_STATUS_CODE, SERVICE_UNAVAILABLE_REASON_PHRASE, response_headers, b"")
+    # In case there was some other error during the processing of the request, return Internal Server Error response.
+    # it's a bug in the server, so the error is logged
+    traceback.print_exception(error)
+    return HttpResponse(INTERNAL_SERVER_ERROR_STATUS_CODE, INTERNAL_SERVER_ERROR_REASON_PHRASE, {}, b"")
+
+
+def should_keep_alive(request: HttpRequest) -> bool:
+    """
+    Checks if the client wants the connection to stay open after the given request (rfc 7230 6.3).
+    HTTP/1.1 connections are persistent unless the client sends Connection: close,
+    and HTTP/1.0 connections are persistent only if the client sends Connection: keep-alive.
+    """
+    connection_options = [trim_linear_whitespaces(option).lower()
+                          for option in request.get_headers().get("Connection", "").split(",")]
+    if request.get_http_version() == "HTTP/1.0":
+        return "keep-alive" in connection_options
+    return "close" not in connection_options
+
+
+def handle_client(server: HttpServer, conn: ClientConnection, keep_alive_timeout: float, max_keep_alive_requests: int):
+    """
+    Serves all the requests of a single client connection, in the order they arrive (including pipelined requests).
+    The connection is kept open between requests, until the client asks to close it, stays idle for
+    keep_alive_timeout seconds, sends max_keep_alive_requests requests, the server drains or an error happens.
+    Closes the connection at the end.
+    The requests are recorded in the METRICS and the ACCESS_LOG, if they're enabled,
+    and traced while the SLOW_REQUEST_TRACER is.
+    """
+    metrics = METRICS
+    access_log = ACCESS_LOG
+    if metrics is not None:
+        metrics.connection_opened()
+    try:
+        for request_number in range(1, max_keep_alive_requests + 1):
+            # the first request is waited for with the regular client timeout, the next ones with the idle timeout
+            if request_number > 1 and not conn.wait_for_request(keep_alive_timeout):
+                break
+            if metrics is not None:
+                metrics.request_started()
+            tracer = SLOW_REQUEST_TRACER
+            trace = None
+            if tracer is not None:
+                trace = RequestTrace()
+                set_request_trace(trace)
+            try:
+                parse_start = time.perf_counter()
+                request = route = handler_start = None
+                try:
+                    request = conn.recieve_request()  # recieve a request
+                    handler_start = time.perf_counter()
+                    route = ROUTER.resolve(request)
+                    response = respond_to_request(request, route)
+                    keep_alive = should_keep_alive(
+                        request) and request_number < max_keep_alive_requests and not server.is_draining()
+                except ClientDisconnected:  # the client left, there is no one to respond to
+                    break
+                except Exception as e:
+                    # the request might not have been recieved completely, so the connection can't be reused
+                    response = get_error_response(e)
+                    keep_alive = False
+                if request is not None and request.get_method() == "HEAD":
+                    response = remove_response_body(response)
+                if isinstance(response.get_body(), collections.abc.Iterator) and \
+                        not prepare_streamed_response(request, response):
+                    keep_alive = False
+                response.get_headers()["Connection"] = "keep-alive" if keep_alive else "close"
+                write_start = time.perf_counter()
+                sent_byte_count = conn.send_response(response)
+                write_end = time.perf_counter()
+                if metrics is not None:
+                    metrics.record_request(route, request, response.get_status_code(), sent_byte_count,
+                                           parse_start, handler_start, write_start, write_end)
+                if access_log is not None:
+                    access_log.record(request, conn.get_client_address(), response.get_status_code(), sent_byte_count,
+                                      parse_start, handler_start, write_start, write_end)
+                if trace is not None:
+                    tracer.record(trace, request, conn.get_client_address(), response.get_status_code(),
+                                  parse_start, handler_start, write_start, write_end)
+            finally:
+                if metrics is not None:
+                    metrics.request_ended()
+                if trace is not None:
+                    set_request_trace(None)
+            if not keep_alive:
+                break
+    except OSError:  # the connection broke while sending the response
+        pass
+    finally:
         conn.close()
+        if metrics is not None:
+            metrics.connection_closed()
+
+
+def serve_clients(server: HttpServer):
+    """
+    Accepts clients from the server until it drains, serving each one until its connection is closed.
+    """
+    while not server.is_draining():
+        try:
+            conn = server.accept_client()
+        except socket.timeout:  # no client yet, check again whether the server is draining
+            continue
+        handle_client(server, conn, KEEP_ALIVE_TIMEOUT,
+                      MAX_KEEP_ALIVE_REQUESTS)
+
+
+class AsyncHttpServer:
+    """
+    This class represents a HTTP Server that serves all its clients concurrently on an asyncio event loop.
+    It handles the same requests as HttpServer and produces the same responses, using handle_request.
+    Requests that may block (anything without an inline route) are handled in a thread pool executor.
+    A handler that reads the request body holds its thread while the client sends it, so only max_body_readers
+    requests with a body are handled at once (the others wait on the event loop), and the rest of the threads stay
+    free for the requests without one.
+    Gets host address, port, timeout for clients, the limits on the request headers and the keep-alive settings as parameters,
+    and the request deadlines like HttpServer.
+    It serves up to max_connections connections at once, and up to max_connections_per_ip from a single address.
+    The connections beyond the limits are shed as soon as they're accepted, by overflow_policy:
+    "reject" sends 503 Service Unavailable and closes the connection, "close" closes it right away.
+    Optionally gets an already listening socket to accept clients from, instead of binding a new one
+    (otherwise a socket is bound, with the given listen backlog).
+    """
+
+    def __init__(self, host: str, port: int, client_timeout: float, max_header_size: int, max_header_count: int,
+                 max_body_size: int, header_timeout: float, body_timeout: float, min_body_rate: int, backlog: int,
+                 max_connections: int, max_connections_per_ip: int, overflow_policy: str, keep_alive_timeout: float,
+                 max_keep_alive_requests: int, executor_workers: int, max_body_readers: int,
+                 listening_socket: socket.socket | None = None):
+        self.__host = host
+        self.__port = port
+        self.__listening_socket = listening_socket
+        self.__client_timeout = client_timeout
+        self.__max_header_size = max_header_size
+        self.__max_header_count = max_header_count
+        self.__max_body_size = max_body_size
+        self.__header_timeout = header_timeout
+        self.__body_timeout = body_timeout
+        self.__min_body_rate = min_body_rate
+        self.__backlog = backlog
+        self.__max_connections = max_connections
+        self.__max_connections_per_ip = max_connections_per_ip
+        self.__overflow_policy = overflow_policy
+        self.__keep_alive_timeout = keep_alive_timeout
+        self.__max_keep_alive_requests = max_keep_alive_requests
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=executor_workers)
+        self.__body_reader_slots = asyncio.Semaphore(max_body_readers)
+        self.__server = None
+        self.__draining = False
+        self.__stopped = asyncio.Event()
+        # the tasks of all open connections, and of the connections that are waiting for their next request
+        self.__connection_tasks = set()
+        self.__idle_connection_tasks = set()
+        # the amount of connections that are served from every client address (only the event loop touches it)
+        self.__connections_per_ip = collections.Counter()
+
+    async def start(self):
+        """
+        Starts listening for clients. They are served in the background while the event loop runs.
+        """
+        # the reader limit makes readuntil fail on a header block longer than max_header_size
+        if self.__listening_socket is not None:
+            self.__server = await asyncio.start_server(self.__handle_client, sock=self.__listening_socket,
+                                                       limit=self.__max_header_size, backlog=self.__backlog)
+        else:
+            self.__server = await asyncio.start_server(self.__handle_client, self.__host, self.__port,
+                                                       limit=self.__max_header_size, backlog=self.__backlog)
+
+    def get_port(self) -> int:
+        """
+        Returns the port the server listens on (useful when binding to port 0, which picks a free port).
+        """
+        return self.__server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        """
+        Starts the server (if it isn't started yet) and serves clients until it is shut down.
+        """
+        if self.__server is None:
+            await self.start()
+        await self.__stopped.wait()
+
+    async def shutdown(self, drain_timeout: float):
+        """
+        Stops accepting clients and closes the idle connections.
+        The connections in the middle of a request (or that were accepted and have yet to send the first one) get up to
+        drain_timeout seconds to finish it, then serve_forever returns.
+        """
+        self.__draining = True
+        # asyncio hands the connections it accepted to tasks that attach them to the server on their first step, and
+        # closing the server before that resets them, so stop accepting first and let those connections reach
+        # __handle_client (the task attaches the connection, then the protocol starts the handler task, which runs)
+        loop = asyncio.get_running_loop()
+        for listening_socket in self.__server.sockets:
+            loop.remove_reader(listening_socket.fileno())
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.__server.close()
+        for task in self.__idle_connection_tasks:
+            task.cancel()
+        if self.__connection_tasks:
+            await asyncio.wait(self.__connection_tasks, timeout=drain_timeout)
+        self.__executor.shutdown(wait=False)
+        self.__stopped.set()
+
+    async def __wait_for_request(self, reader: asyncio.StreamReader, idle_timeout: float, is_idle: bool) -> bytes:
+        """
+        Waits for the next request of the client to start, up to idle_timeout seconds
+        (otherwise ClientDisconnected is raised, to close the connection silently).
+        If is_idle is True (the connection served a request already), the wait is cancelled when the server shuts down.
+        A new connection isn't idle: its client is sending the first request, so closing it would reset the connection.
+        Returns the first byte of the request.
+        """
+        current_task = asyncio.current_task()
+        if is_idle:
+            self.__idle_connection_tasks.add(current_task)
+        try:
+            return await asyncio.wait_for(reader.readexactly(1), idle_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            raise ClientDisconnected()
+        finally:
+            self.__idle_connection_tasks.discard(current_task)
+
+    async def __recieve_request(self, reader: asyncio.StreamReader, first_byte: bytes,
+                                client_address: str) -> HttpRequest:
+        """
+        Recieves the rest of a request from the client (after its first byte) and returns it as a HttpRequest instance.
+        The head has to arrive within the header timeout, and the body has the same deadline as in HttpServer.
+        """
+        try:
+            header_block = b""
+            while header_block == b"":  # ignore empty lines before the request line, as mentioned in rfc 7230 3.5
+                header_block = first_byte + await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.__header_timeout)
+                header_block = header_block.removesuffix(
+                    b"\r\n\r\n").lstrip(b"\r\n")
+                first_byte = b""
+            head_size = len(header_block) + 4  # the head is followed by \r\n\r\n
+            method, request_path, http_version, query_string, headers = parse_request_head(
+                header_block, self.__max_header_count)
+            body = None
+            if is_chunked_request(headers):
+                recieve_some, recieve_line = self.__get_body_recievers(reader)
+                body = ChunkedRequestBody(recieve_some, recieve_line, self.__max_body_size)
+            else:
+                length = get_content_length(headers, self.__max_body_size)
+                if length is not None:
+                    recieve_some, _ = self.__get_body_recievers(reader)
+                    body = RequestBody(length, recieve_some)
+        except asyncio.LimitOverrunError:
+            raise BadRequest("Request headers too large")
+        except asyncio.IncompleteReadError:
+            raise ClientDisconnected()
+        return HttpRequest(method, request_path, http_version, query_string, headers, body, head_size, client_address)
+
+    def __get_body_recievers(self, reader: asyncio.StreamReader):
+        """
+        Returns the functions that recieve the request body, for RequestBody and ChunkedRequestBody:
+        one that recieves up to a given amount of bytes, and one that recieves a line (for the chunk sizes).
+        The body has the same deadline as in HttpServer, which starts when the handler first reads it:
+        every read waits up to the client timeout, but not past the deadline (time.monotonic).
+        The body is read by request handlers in the executor, so the functions wait for the event loop to do the reading.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None
+
+        def recieve(read_coroutine):
+            nonlocal deadline
+            if deadline is None:
+                deadline = time.monotonic() + self.__body_timeout
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                read_coroutine.close()
+                raise socket.timeout("Request deadline passed")
+            content = asyncio.run_coroutine_threadsafe(
+                asyncio.wait_for(read_coroutine, min(self.__client_timeout, remaining_time)), loop).result()
+            deadline += len(content) / self.__min_body_rate  # the client gets more time only for the bytes it sent
+            return content
+
+        def recieve_some(max_size: int) -> bytes:
+            content = recieve(reader.read(max_size))
+            if content == b"":  # the client closed the connection
+                raise ClientDisconnected()
+            return content
+
+        def recieve_line() -> str:
+            try:
+                line = recieve(reader.readuntil(b"\r\n"))
+            except asyncio.LimitOverrunError:
+                raise BadRequest("Line too long")
+            except asyncio.IncompleteReadError:
+                raise ClientDisconnected()
+            return decode_header_bytes(line[:-2])
+        return recieve_some, recieve_line
+
+    async def __respond_in_executor(self, request: HttpRequest, route: Route, trace: RequestTrace | None) -> HttpResponse:
+        """
+        Generates the response to a request with respond_to_request in the executor (traced if trace isn't None).
+        """
+        if trace is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.__executor, respond_to_request, request, route)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, run_traced, trace, time.perf_counter(), respond_to_request, request, route)
+
+    async def __send_streamed_body(self, writer: asyncio.StreamWriter, head: bytes, body, chunked: bool,
+                                   inline: bool) -> int:
+        """
+        Sends the head of a response and its streamed body, every chunk as soon as it's generated.
+        The next chunk is generated only once the transport's buffer drains (within the client timeout), so the body
+        isn't generated faster than the client reads it. Chunks of inline routes are generated on the event loop,
+        the others in the executor (like their handlers). Returns the amount of bytes sent.
+        """
+        loop = asyncio.get_running_loop()
+        writer.write(head)
+        sent_byte_count = len(head)
+        try:
+            while True:
+                if inline:
+                    chunk = get_next_chunk(body)
+                else:
+                    chunk = await loop.run_in_executor(self.__executor, get_next_chunk, body)
+                if chunk is None:
+                    break
+                buffers = serialize_chunk(chunk) if chunked else [chunk]
+                writer.writelines(buffers)
+                sent_byte_count += sum(len(buffer) for buffer in buffers)
+                await asyncio.wait_for(writer.drain(), self.__client_timeout)
+        finally:
+            if hasattr(body, "close"):  # stops a generator that wasn't exhausted
+                if inline:
+                    body.close()
+                else:
+                    await loop.run_in_executor(self.__executor, body.close)
+        if chunked:
+            writer.write(LAST_CHUNK)
+            sent_byte_count += len(LAST_CHUNK)
+        await asyncio.wait_for(writer.drain(), self.__client_timeout)
+        return sent_byte_count
+
+    async def __send_response(self, writer: asyncio.StreamWriter, response: HttpResponse, inline: bool) -> int:
+        """
+        Sends the response to the client, waiting up to the client timeout for it to be written
+        (a file body sent with sendfile also gets a second for every min_body_rate bytes of it).
+        A streamed body is generated in the executor, unless the response is of an inline route.
+        Returns the amount of bytes sent.
+        """
+        head = serialize_response_head(response)
+        body = response.get_body()
+        if isinstance(body, collections.abc.Iterator):
+            return await self.__send_streamed_body(writer, head, body, "Transfer-Encoding" in response.get_headers(),
+                                                   inline)
+        if isinstance(body, FileBody):
+            writer.write(head)
+            try:
+                await asyncio.wait_for(writer.drain(), self.__client_timeout)
+                # sent with sendfile when the transport supports it. the whole file is sent by a single call, so the
+                # client gets the client timeout plus a second for every min_body_rate bytes of it
+                sent = await asyncio.wait_for(
+                    asyncio.get_running_loop().sendfile(writer.transport, body.get_file(), body.get_offset(),
+                                                        len(body)),
+                    self.__client_timeout + len(body) / self.__min_body_rate)
+            finally:
+                body.close()
+            if sent < len(body):  # the file got shorter, the client can't know where the response ends
+                raise ConnectionError("File shrank while sending it")
+            return len(head) + sent
+        writer.writelines((head, body))
+        await asyncio.wait_for(writer.drain(), self.__client_timeout)
+        return len(head) + len(body)
+
+    def __get_exceeded_limit(self, address: str) -> str | None:
+        """
+        Returns the connection limit a new connection from the given address exceeds, or None if it may be served.
+        """
+        if len(self.__connection_tasks) >= self.__max_connections:
+            return "max_connections"
+        if self.__connections_per_ip[address] >= self.__max_connections_per_ip:
+            return "max_connections_per_ip"
+        return None
+
+    async def __shed_connection(self, writer: asyncio.StreamWriter):
+        """
+        Closes a connection that exceeds the connection limits, by the overflow policy.
+        """
+        if self.__overflow_policy == "close":
+            writer.transport.abort()
+            return
+        # the request isn't read, the response is sent as soon as the connection is accepted
+        writer.write(OVERLOADED_RESPONSE)
+        try:
+            await asyncio.wait_for(writer.drain(), self.__client_timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        writer.close()
+
+    async def __handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves all the requests of a single client connection, with the same keep-alive rules as handle_client.
+        Sheds the connection instead if it exceeds the connection limits.
+        """
+        metrics = METRICS
+        access_log = ACCESS_LOG
+        peer_address = writer.get_extra_info("peername")
+        address = peer_address[0] if peer_address else ""
+        exceeded_limit = self.__get_exceeded_limit(address)
+        if exceeded_limit is not None:
+            if metrics is not None:
+                metrics.connection_rejected(exceeded_limit)
+            await self.__shed_connection(writer)
+            return
+        current_task = asyncio.current_task()
+        self.__connection_tasks.add(current_task)
+        self.__connections_per_ip[address] += 1
+        if metrics is not None:
+            metrics.connection_opened()
+        try:
+            for request_number in range(1, self.__max_keep_alive_requests + 1):
+                # the first request is waited for with the regular client timeout, the next ones with the idle timeout
+                idle_timeout = self.__client_timeout if request_number == 1 else self.__keep_alive_timeout
+                try:
+                    first_byte = await self.__wait_for_request(reader, idle_timeout, request_number > 1)
+                except ClientDisconnected:  # the client left or stayed idle, there is no one to respond to
+                    break
+                if metrics is not None:
+                    metrics.request_started()
+                tracer = SLOW_REQUEST_TRACER
+                trace = RequestTrace() if tracer is not None else None
+                try:
+                    parse_start = time.perf_counter()
+                    request = route = handler_start = None
+                    try:
+                        request = await self.__recieve_request(reader, first_byte, address)
+                        handler_start = time.perf_counter()
+                        route = ROUTER.resolve(request)
+                        # a request body is read in the executor too, since reading it waits for the event loop
+                        if route.inline and request.get_body_stream() is None:
+                            if trace is None:
+                                response = handle_request(request, route)
+                            else:  # the handler doesn't await, so no other request runs on this thread meanwhile
+                                set_request_trace(trace)
+                                try:
+                                    response = handle_request(request, route)
+                                finally:
+                                    set_request_trace(None)
+                        elif request.get_body_stream() is None:
+                            response = await self.__respond_in_executor(request, route, trace)
+                        else:
+                            async with self.__body_reader_slots:
+                                response = await self.__respond_in_executor(request, route, trace)
+                        keep_alive = should_keep_alive(
+                            request) and request_number < self.__max_keep_alive_requests and not self.__draining
+                    except ClientDisconnected:  # the client left, there is no one to respond to
+                        break
+                    except Exception as e:
+                        # the request might not have been recieved completely, so the connection can't be reused
+                        response = get_error_response(e)
+                        keep_alive = False
+                    if request is not None and request.get_method() == "HEAD":
+                        response = remove_response_body(response)
+                    if isinstance(response.get_body(), collections.abc.Iterator) and \
+                            not prepare_streamed_response(request, response):
+                        keep_alive = False
+                    response.get_headers()["Connection"] = "keep-alive" if keep_alive else "close"
+                    write_start = time.perf_counter()
+                    sent_byte_count = await self.__send_response(writer, response, route is not None and route.inline)
+                    write_end = time.perf_counter()
+                    if metrics is not None:
+                        metrics.record_request(route, request, response.get_status_code(), sent_byte_count,
+                                               parse_start, handler_start, write_start, write_end)
+                    if access_log is not None:
+                        access_log.record(request, address, response.get_status_code(), sent_byte_count,
+                                          parse_start, handler_start, write_start, write_end)
+                    if trace is not None:
+                        tracer.record(trace, request, address, response.get_status_code(),
+                                      parse_start, handler_start, write_start, write_end)
+                finally:
+                    if metrics is not None:
+                        metrics.request_ended()
+                if not keep_alive:
+                    break
+        except (OSError, asyncio.TimeoutError):  # the connection broke or stalled while sending the response
+            pass
+        except asyncio.CancelledError:  # the server is shutting down while the connection is idle
+            pass
+        finally:
+            writer.close()
+            self.__connection_tasks.discard(current_task)
+            self.__connections_per_ip[address] -= 1
+            if self.__connections_per_ip[address] == 0:  # don't keep every address that ever connected
+                del self.__connections_per_ip[address]
+            if metrics is not None:
+                metrics.connection_closed()
+
+
+def start_replacement(listening_socket: socket.socket) -> bool:
+    """
+    Starts a new server process, with the current web_server.py (which may have changed since this process started)
+    and the same arguments, for a graceful reload.
+    The listening socket is passed to it (by fd inheritance), so connecting clients are never refused: until the new
+    process accepts them, they wait in the socket's backlog.
+    Waits up to RELOAD_READY_TIMEOUT seconds for the new process to report it's ready (see report_ready).
+    Returns True if it is, then this process should drain and exit. Otherwise the new process is killed.
+    """
+    ready_reader, ready_writer = os.pipe()
+    environment = dict(os.environ)
+    environment[READY_FD_ENVIRONMENT_VARIABLE] = str(ready_writer)
+    environment[LISTEN_FD_ENVIRONMENT_VARIABLE] = str(listening_socket.fileno())
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=environment,
+                                   pass_fds=[ready_writer, listening_socket.fileno()])
+    finally:
+        os.close(ready_writer)
+    try:
+        # the new process writes a byte when it's ready, the pipe ends without it if the process exits
+        readable, _, _ = select.select([ready_reader], [], [], RELOAD_READY_TIMEOUT)
+        is_ready = readable != [] and os.read(ready_reader, 1) == b"1"
+    finally:
+        os.close(ready_reader)
+    if not is_ready:
+        process.kill()
+        process.wait()
+        print(f"reload: new process {process.pid} didn't start, process {os.getpid()} keeps serving",
+              file=sys.stderr)
+        return False
+    print(f"reload: process {os.getpid()} handed the listening socket to process {process.pid}, "
+          f"draining for up to {DRAIN_TIMEOUT}s", file=sys.stderr)
+    return True
+
+
+def get_inherited_listening_socket() -> socket.socket | None:
+    """
+    Returns the listening socket passed by the process this one replaces (see start_replacement),
+    or None if this process wasn't started by a reload.
+    """
+    listening_fd = os.environ.pop(LISTEN_FD_ENVIRONMENT_VARIABLE, None)
+    if listening_fd is None:
+        return None
+    return socket.socket(fileno=int(listening_fd))
+
+
+def report_ready():
+    """
+    Tells the process this one replaces (if it was started by a reload) that it's ready to serve, so that one drains.
+    """
+    ready_fd = os.environ.pop(READY_FD_ENVIRONMENT_VARIABLE, None)
+    if ready_fd is not None:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+
+
+def run_server(mode: str, host: str, port: int, listening_socket: socket.socket | None,
+               reload_on_hangup: bool = False):
+    """
+    Runs a server in the given mode in the current process, until it gets SIGTERM.
+    Then the server drains: it stops accepting clients and finishes the requests in progress (within DRAIN_TIMEOUT
+    seconds) before returning.
+    If listening_socket is given, clients are accepted from it, otherwise a new socket is bound to host and port.
+    If reload_on_hangup is True, SIGHUP reloads the server: a new process takes over the listening socket
+    (see start_replacement), and then this one drains like on SIGTERM.
+    SIGHUP is ignored while a reload is in progress or the server is stopping, so the socket is handed over once.
+    The uploads that are still waiting to be written are written before returning.
+    The WEBROOT_INDEX (if it's enabled) is watched for changes while the server runs,
+    and the ACCESS_LOG (if it's enabled) is written until the server returns.
+    """
+    if WEBROOT_INDEX is not None:
+        WEBROOT_INDEX.start_watching()
+    if ACCESS_LOG is not None:
+        ACCESS_LOG.start()
+    try:
+        if mode == "async":
+            server = AsyncHttpServer(host, port, CLIENT_TIMEOUT, MAX_HEADER_SIZE, MAX_HEADER_COUNT, MAX_BODY_SIZE,
+                                     HEADER_TIMEOUT, BODY_TIMEOUT, MIN_BODY_RATE, LISTEN_BACKLOG, MAX_CONNECTIONS,
+                                     MAX_CONNECTIONS_PER_IP, CONNECTION_OVERFLOW_POLICY, KEEP_ALIVE_TIMEOUT,
+                                     MAX_KEEP_ALIVE_REQUESTS, ASYNC_EXECUTOR_WORKERS, ASYNC_BODY_READERS,
+                                     listening_socket)
+
+            stopping = False  # True once the server is reloading or draining
+
+            async def stop():
+                nonlocal stopping
+                stopping = True
+                await server.shutdown(DRAIN_TIMEOUT)
+
+            async def reload():
+                nonlocal stopping
+                if stopping:
+                    return
+                stopping = True
+                if await asyncio.get_running_loop().run_in_executor(None, start_replacement, listening_socket):
+                    await server.shutdown(DRAIN_TIMEOUT)
+                else:  # this process keeps serving, so it may be reloaded again
+                    stopping = False
+
+            async def serve_until_terminated():
+                loop = asyncio.get_running_loop()
+                loop.add_signal_handler(
+                    signal.SIGTERM, lambda: asyncio.ensure_future(stop()))
+                if reload_on_hangup:
+                    loop.add_signal_handler(
+                        signal.SIGHUP, lambda: asyncio.ensure_future(reload()))
+                await server.serve_forever()
+            asyncio.run(serve_until_terminated())
+        else:
+            server = HttpServer(host, port, CLIENT_TIMEOUT, MAX_HEADER_SIZE, MAX_HEADER_COUNT, MAX_BODY_SIZE,
+                                HEADER_TIMEOUT, BODY_TIMEOUT, MIN_BODY_RATE, LISTEN_BACKLOG, listening_socket)
+
+            def stop_draining(signum, frame):
+                raise SystemExit("drain timeout passed")
+
+            reloading = False
+
+            def drain():
+                # the connection in progress gets DRAIN_TIMEOUT seconds to finish
+                signal.alarm(max(1, round(DRAIN_TIMEOUT)))
+                server.drain()
+
+            def reload():
+                nonlocal reloading
+                if start_replacement(listening_socket):
+                    drain()
+                else:  # this process keeps serving, so it may be reloaded again
+                    reloading = False
+
+            def start_reload(signum, frame):
+                nonlocal reloading
+                if reloading or server.is_draining():
+                    return
+                reloading = True
+                # the new process is started by a thread, so the current connection is served meanwhile
+                threading.Thread(target=reload, daemon=True).start()
+            signal.signal(signal.SIGALRM, stop_draining)
+            signal.signal(signal.SIGTERM, lambda signum, frame: drain())
+            if reload_on_hangup:
+                signal.signal(signal.SIGHUP, start_reload)
+            serve_clients(server)
+            signal.alarm(0)
+    finally:
+        UPLOAD_WRITER.shutdown()
+        if WEBROOT_INDEX is not None:
+            WEBROOT_INDEX.stop_watching()
+        if ACCESS_LOG is not None:
+            ACCESS_LOG.stop()
+
+
+def run_worker_pool(worker_count: int, run_worker, drain_timeout: float, listening_socket: socket.socket | None):
+    """
+    Forks worker_count worker processes, each calling run_worker (which returns when the worker is done), and supervises them.
+    A worker that exits is restarted, until the master gets SIGTERM or SIGINT.
+    Then the master passes SIGTERM to the workers so they drain, and kills the ones that don't finish within drain_timeout.
+    On SIGHUP, a new master (with its own workers) takes over the listening socket the workers share (see
+    start_replacement), and then the workers drain like on SIGTERM.
+    Without a shared listening socket (with --reuse-port) SIGHUP is refused: every worker listens on its own socket,
+    and the connections waiting in its backlog would be reset when it closes.
+    """
+    workers = set()
+    shutting_down = False
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:  # in the worker
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                # Ctrl+C reaches the whole process group, the master handles it and tells the workers to stop
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)  # reloading is the master's job
+                run_worker()
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)  # never return to the master's code
+        workers.add(pid)
+
+    def signal_workers(signal_number: int):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal_number)
+            except ProcessLookupError:  # the worker exited and was waited for, but isn't removed from workers yet
+                pass
+
+    def kill_workers(signum, frame):
+        signal_workers(signal.SIGKILL)
+
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        if shutting_down:
+            return
+        shutting_down = True
+        signal_workers(signal.SIGTERM)
+        # workers that are still running when the drain timeout passes are killed
+        signal.signal(signal.SIGALRM, kill_workers)
+        signal.alarm(max(1, round(drain_timeout)))
+
+    def reload(signum, frame):
+        if shutting_down:
+            return
+        if listening_socket is None:
+            print("reload: not supported with --reuse-port, restart the server instead", file=sys.stderr)
+            return
+        if start_replacement(listening_socket):
+            shutdown(signum, frame)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, reload)
+    for _ in range(worker_count):
+        start_worker()
+    while workers:
+        pid, status = os.wait()
+        workers.discard(pid)
+        if not shutting_down:
+            print(f"worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting",
+                  file=sys.stderr)
+            time.sleep(WORKER_RESTART_DELAY)
+            if not shutting_down:
+                start_worker()
+    signal.alarm(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP server")
+    parser.add_argument("--host", default=HOST_ADDRESS,
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument("--mode", choices=SERVER_MODES, default=SERVER_MODE,
+                        help="how clients are served (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT,
+                        help="amount of worker processes (default: %(default)s)")
+    parser.add_argument("--reuse-port", action="store_true", default=REUSE_PORT,
+                        help="bind a SO_REUSEPORT socket in every worker instead of sharing one socket")
+    parser.add_argument("--metrics-path", default=METRICS_PATH,
+                        help="path of the metrics endpoint (default: %(default)s)")
+    parser.add_argument("--no-metrics", dest="metrics", action="store_false", default=METRICS_ENABLED,
+                        help="don't record metrics or serve the metrics endpoint")
+    parser.add_argument("--index-webroot", dest="index_webroot", action="store_true", default=WEBROOT_INDEX_ENABLED,
+                        help="index the webroot in memory at startup and watch it for changes")
+    parser.add_argument("--access-log", default=ACCESS_LOG_PATH,
+                        help="write an access log to this path (with several workers, one per worker: PATH.PID)")
+    parser.add_argument("--debug-path", default=DEBUG_PATH,
+                        help="serve the profiling and slow request tracing endpoints under this path (to local clients only)")
+    parser.add_argument("--trace-slow-requests", type=float, metavar="SECONDS",
+                        help="trace the requests that take at least this long from startup (in every worker)")
+    arguments = parser.parse_args()
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    if arguments.metrics:
+        enable_metrics(arguments.metrics_path, arguments.workers > 1)
+    if arguments.index_webroot:  # before forking, so the workers share the index
+        enable_webroot_index()
+    if arguments.access_log is not None:
+        enable_access_log(arguments.access_log, arguments.workers > 1)
+    if arguments.debug_path is not None:
+        enable_debug_endpoints(arguments.debug_path)
+    if arguments.trace_slow_requests is not None:
+        enable_slow_request_tracer(arguments.trace_slow_requests)
+    if arguments.workers > 1 and not hasattr(os, "fork"):
+        parser.error("multiple workers are only supported on systems with fork")
+    # after a reload, the socket is the one the replaced process listened on
+    shared_socket = get_inherited_listening_socket()
+    if shared_socket is None and not (arguments.workers > 1 and arguments.reuse_port):
+        shared_socket = create_listening_socket(
+            arguments.host, arguments.port, False, LISTEN_BACKLOG)
+    report_ready()
+    if arguments.workers == 1:
+        run_server(arguments.mode, arguments.host,
+                   arguments.port, shared_socket, True)
+        return
+    if arguments.reuse_port:
+        # every worker binds its own socket
+        def run_worker():
+            listening_socket = create_listening_socket(
+                arguments.host, arguments.port, True, LISTEN_BACKLOG)
+            run_server(arguments.mode, arguments.host,
+                       arguments.port, listening_socket)
+    else:
+        # the socket is bound once, before forking, and all the workers accept from it
+        def run_worker():
+            run_server(arguments.mode, arguments.host,
+                       arguments.port, shared_socket)
+    run_worker_pool(arguments.workers, run_worker,
+                    DRAIN_TIMEOUT, shared_socket)
 
 
 if __name__ == "__main__":